@@ -1,28 +1,56 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks, Response, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks, Query, Request, Response, UploadFile, File
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import CursorType, ReturnDocument, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
 import os
+import asyncio
 import logging
+import orjson
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Literal
+from typing import List, Optional, Literal, get_args, get_origin
+from functools import lru_cache
+from collections import OrderedDict
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
 import bcrypt
-from io import BytesIO
+from io import BytesIO, StringIO
 from docx import Document
 from docx.shared import Pt, RGBColor
 from mailmerge import MailMerge
+import csv
+import multiprocessing
 import random
+import re
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape as xml_escape
 import shutil
+import zlib
 import pandas as pd
+import numpy as np
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill
 
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+try:
+    import python_calamine  # noqa: F401 - enables pd.read_excel(engine='calamine')
+    EXCEL_ENGINE = 'calamine'
+except ImportError:  # openpyxl, which pandas opens read-only
+    EXCEL_ENGINE = 'openpyxl'
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
@@ -35,8 +63,20 @@ db = client[os.environ['DB_NAME']]
 JWT_SECRET = os.environ.get('JWT_SECRET', 'piperocket-secret-key-2025')
 JWT_ALGORITHM = 'HS256'
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
+
+def duplicate_key_message(details: Optional[dict]) -> str:
+    key_value = {name: value for name, value in ((details or {}).get('keyValue') or {}).items() if name != 'org_id'}
+    if not key_value:
+        return "A record with this key already exists"
+    return "A record with " + ", ".join(f"{name} {value}" for name, value in key_value.items()) + " already exists"
+
+@app.exception_handler(DuplicateKeyError)
+async def duplicate_key_handler(request: Request, exc: DuplicateKeyError):
+    # Raised by the unique natural-key indexes, e.g. creating a second employee
+    # with the same emp_id returns 409 instead of storing a duplicate
+    return ORJSONResponse(status_code=409, content={"detail": duplicate_key_message(exc.details)})
 security = HTTPBearer()
 
 # ============= MODELS =============
@@ -114,8 +154,10 @@ class Client(BaseModel):
     approver_user_id: str
     sign_status: Literal['Signed', 'Not signed'] = 'Not signed'
     client_status: Literal['Active', 'Churned'] = 'Active'
+    churned_at: Optional[str] = None  # set when client_status becomes Churned
     agreement_status: Literal['Live', 'Expired'] = 'Live'
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class ClientCreate(BaseModel):
     client_name: str
@@ -168,6 +210,7 @@ class Contractor(BaseModel):
     status: Literal['Active', 'Terminated'] = 'Active'
     agreement_status: Literal['Live', 'Expired'] = 'Live'
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class ContractorCreate(BaseModel):
     name: str
@@ -225,6 +268,7 @@ class Employee(BaseModel):
     approver_user_id: str
     status: Literal['Active', 'Terminated'] = 'Active'
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class EmployeeCreate(BaseModel):
     doj: str
@@ -325,6 +369,7 @@ class Asset(BaseModel):
     department: str  # Dynamic department from Service table
     warranty_status: str = "Active"
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class AssetCreate(BaseModel):
     asset_type: str
@@ -346,6 +391,7 @@ class Service(BaseModel):
     org_id: str
     name: str
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class ServiceCreate(BaseModel):
     name: str
@@ -366,6 +412,7 @@ class ClientOnboarding(BaseModel):
     proposal_status: Literal['Sent', 'Approved', 'Rejected', 'In Negotiation'] = 'Sent'
     onboarding_status: Literal['Onboarded', 'WIP', 'Not Onboarded'] = 'Not Onboarded'
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class ClientOnboardingCreate(BaseModel):
     client_name: str
@@ -402,6 +449,27 @@ class StockTransaction(BaseModel):
     price: Optional[float] = None  # For Stock In
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
+class StockSnapshot(BaseModel):
+    """Per-product stock checkpoint: stock_available after all ledger entries dated <= date"""
+    model_config = ConfigDict(extra="ignore")
+    org_id: str
+    product_name: str
+    date: str
+    stock_available: int
+    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+
+class StockAlert(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: f"alert_{uuid.uuid4().hex[:8]}")
+    org_id: str
+    product_name: str
+    stock_available: int
+    daily_consumption: float
+    days_of_stock_left: Optional[float] = None  # None when there is no recent consumption
+    reorder_by: Optional[str] = None
+    severity: Literal['Out of stock', 'Low stock']
+    computed_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+
 class StockInCreate(BaseModel):
     product_name: str
     quantity: int
@@ -418,6 +486,103 @@ class StockOutCreate(BaseModel):
     email: EmailStr
     date: str
 
+# ============= BULK MODELS =============
+
+class BulkSelection(BaseModel):
+    """Records to act on: explicit ids, an equality filter on model fields, or all: true"""
+    ids: Optional[List[str]] = None
+    filter: Optional[dict] = None
+    all: bool = False
+
+class BulkUpdateRequest(BulkSelection):
+    changes: dict
+
+# ============= JOB MODELS =============
+
+class Job(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: f"job_{uuid.uuid4().hex[:8]}")
+    org_id: str
+    type: str
+    requested_by: str
+    status: Literal['Queued', 'Running', 'Completed', 'Failed'] = 'Queued'
+    progress: dict = Field(default_factory=dict)  # {step: {"done": n, "total": n}}
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+
+# ============= PAYROLL MODELS =============
+
+# Monthly gross split, shared by offer letters and payroll runs
+SALARY_SPLIT = {"basic": 0.50, "hra": 0.30, "special": 0.20}
+EMPLOYER_PF_MONTHLY = 1800.0
+
+class PayrollRunRequest(BaseModel):
+    month: str  # YYYY-MM
+
+class PayrollRun(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: f"payrun_{uuid.uuid4().hex[:8]}")
+    org_id: str
+    month: str
+    employee_count: int
+    totals: dict  # component -> INR
+    by_department: dict  # department -> {"count": n, "gross": INR, "ctc": INR}
+    created_by: str
+    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+
+class PayoutBatch(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: f"payout_{uuid.uuid4().hex[:8]}")
+    org_id: str
+    month: str
+    contractor_count: int
+    total_inr: float
+    by_department: dict  # department -> {"count": n, "amount": INR}
+    created_by: str
+    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+
+# ============= INVOICE MODELS =============
+
+class InvoiceRunRequest(BaseModel):
+    month: str  # YYYY-MM
+    supplier_gstin: Optional[str] = None  # Decides CGST+SGST vs IGST by state code
+
+class InvoiceRun(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: f"invrun_{uuid.uuid4().hex[:8]}")
+    org_id: str
+    month: str
+    supplier_gstin: Optional[str] = None
+    # Running claims the (org, month) slot; Failed keeps numbers that could not be released
+    status: Literal['Running', 'Completed', 'Failed'] = 'Running'
+    financial_year: Optional[str] = None
+    first_sequence: Optional[int] = None  # reserved counter values, inclusive
+    last_sequence: Optional[int] = None
+    invoice_count: int = 0
+    first_number: Optional[str] = None
+    last_number: Optional[str] = None
+    totals: dict = Field(default_factory=dict)  # currency -> {"amount": x, "tax": x, "total": x}
+    error: Optional[str] = None
+    job_id: Optional[str] = None
+    created_by: str
+    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())  # heartbeat while Running
+
+# ============= REPORT MODELS =============
+
+class DepartmentSnapshot(BaseModel):
+    """Per-org month of department aggregates, refreshed until the month closes"""
+    model_config = ConfigDict(extra="ignore")
+    org_id: str
+    month: str  # YYYY-MM
+    as_of: str  # last day the figures were taken
+    # department -> {"employees", "employee_cost", "contractors", "contractor_cost", "clients", "revenue"}
+    departments: dict
+    fx_missing: List[str] = Field(default_factory=list)  # currencies with no rate, counted unconverted in revenue
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+
 # ============= HELPER FUNCTIONS =============
 
 def hash_password(password: str) -> str:
@@ -446,6 +611,170 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+# Flipped off the first time the server reports it cannot run transactions
+# (standalone mongod); later calls then skip straight to the non-session path.
+TRANSACTIONS_SUPPORTED = True
+
+async def run_in_transaction(callback):
+    """Run callback(session) inside a multi-document transaction.
+
+    On standalone deployments without transaction support the callback is run
+    with session=None, so single-document writes stay atomic but the group is not.
+    """
+    global TRANSACTIONS_SUPPORTED
+    if TRANSACTIONS_SUPPORTED:
+        try:
+            async with await client.start_session() as session:
+                return await session.with_transaction(callback)
+        except OperationFailure as e:
+            # 20 = IllegalOperation ("Transaction numbers are only allowed on a replica set member or mongos")
+            if e.code != 20:
+                raise
+            TRANSACTIONS_SUPPORTED = False
+            logger.warning("MongoDB transactions unavailable, running stock writes without a session")
+    return await callback(None)
+
+async def run_periodically(job, interval_hours: float):
+    """Background loop for batch jobs started at application startup"""
+    while True:
+        try:
+            await job()
+        except Exception as e:
+            logger.error(f"{job.__name__} error: {str(e)}")
+        await asyncio.sleep(interval_hours * 3600)
+
+@lru_cache(maxsize=None)
+def optional_model_fields(model) -> tuple:
+    return tuple(
+        (name, field.default, field.default_factory)
+        for name, field in model.model_fields.items()
+        if not field.is_required()
+    )
+
+# Named ?fields= views for list endpoints; "id" is always returned
+LIST_VIEWS = {
+    Client: {
+        "summary": ("client_name", "service", "amount_inr", "currency_preference", "start_date", "end_date",
+                    "client_status", "agreement_status", "sign_status"),
+    },
+    Contractor: {
+        "summary": ("name", "department", "designation", "monthly_retainer_inr", "start_date", "end_date",
+                    "status", "agreement_status", "sign_status"),
+    },
+    Employee: {
+        "summary": ("emp_id", "first_name", "last_name", "work_email", "department", "doj",
+                    "monthly_gross_inr", "status"),
+    },
+    Asset: {
+        "summary": ("asset_type", "model", "serial_number", "alloted_to", "department", "purchase_date",
+                    "warranty_status"),
+    },
+}
+
+def select_fields(model, fields: Optional[str]) -> Optional[tuple]:
+    """Parse ?fields= (field names and/or named views) into the fields to return, or None for all"""
+    if not fields:
+        return None
+    views = LIST_VIEWS.get(model, {})
+    selected = {"id"}
+    for name in (f.strip() for f in fields.split(',')):
+        if not name:
+            continue
+        if name in views:
+            selected.update(views[name])
+        elif name in model.model_fields:
+            selected.add(name)
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown field or view: {name}")
+    return tuple(name for name in model.model_fields if name in selected)
+
+def model_projection(model, exclude: tuple = (), fields: Optional[tuple] = None, extra: tuple = ()) -> dict:
+    """Mongo projection returning only the fields of a response model.
+
+    fields narrows it to a select_fields() subset; extra adds fields the
+    handler needs for sorting or derived values.
+    """
+    names = model.model_fields if fields is None else (*fields, *(e for e in extra if e in model.model_fields))
+    return {"_id": 0, **{name: 1 for name in names if name not in exclude}}
+
+def trusted_response(docs: list, model, fields: Optional[tuple] = None) -> ORJSONResponse:
+    """Serialise documents read from our own collections without re-validating them.
+
+    Everything in these collections was written through the same models, so
+    the only gap is defaults for fields added after a doc was stored. Pair
+    with model_projection() so no extra fields leak through.
+    """
+    if fields is not None:
+        # Drop anything fetched only for sorting or derived values
+        docs = [{name: doc[name] for name in fields if name in doc} for doc in docs]
+    return ORJSONResponse(fill_model_defaults(docs, model, fields))
+
+def fill_model_defaults(docs: list, model, fields: Optional[tuple] = None) -> list:
+    """Fill in defaults for model fields missing from stored documents, in place"""
+    optional = [
+        option for option in optional_model_fields(model)
+        if fields is None or option[0] in fields
+    ]
+    for doc in docs:
+        for name, default, factory in optional:
+            if name not in doc:
+                doc[name] = factory() if factory else default
+    return docs
+
+# Lists served with an ETag; every write handler for these bumps the org's counter
+VERSIONED_COLLECTIONS = ("clients", "contractors", "employees", "services")
+
+async def bump_version(org_id: str, *collections: str):
+    """Mark collections as changed for an org, invalidating their list ETags"""
+    for collection in collections:
+        await db.collection_versions.update_one(
+            {"org_id": org_id, "collection": collection},
+            {"$inc": {"version": 1}},
+            upsert=True
+        )
+
+async def collection_version(org_id: str, collection: str) -> int:
+    doc = await db.collection_versions.find_one({"org_id": org_id, "collection": collection}, {"_id": 0, "version": 1})
+    return doc['version'] if doc else 0
+
+async def list_etag(request: Request, org_id: str, collection: str) -> str:
+    """Weak ETag for a list response: the collection version plus the query string"""
+    version = await collection_version(org_id, collection)
+    params = zlib.crc32(str(sorted(request.query_params.multi_items())).encode('utf-8'))
+    # Weak, since compression changes the bytes but not the content
+    return f'W/"{collection}-{version}-{params:08x}"'
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """304 response if the client already holds this version, else None"""
+    if etag in (tag.strip() for tag in request.headers.get('if-none-match', '').split(',')):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    return None
+
+def with_etag(response: Response, etag: str) -> Response:
+    response.headers['ETag'] = etag
+    # Let the browser keep the copy but revalidate it on every use
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Collections served by /api/sync, with the model their records are read through
+SYNC_MODELS = {
+    "clients": Client,
+    "contractors": Contractor,
+    "employees": Employee,
+    "assets": Asset,
+    "services": Service,
+    "client_onboarding": ClientOnboarding,
+}
+
+async def record_tombstone(org_id: str, collection: str, record_id: str):
+    """Remember a deleted record so /api/sync can report it"""
+    await db.tombstones.insert_one({
+        "org_id": org_id,
+        "collection": collection,
+        "id": record_id,
+        "deleted_at": datetime.now(timezone.utc).isoformat()
+    })
+
 def calculate_end_date(start_date: str, tenure_months: int) -> str:
     from dateutil.relativedelta import relativedelta
     start = datetime.fromisoformat(start_date)
@@ -459,6 +788,209 @@ def check_agreement_status(end_date: str) -> str:
     end_date_only = end.date() if hasattr(end, 'date') else end
     return 'Live' if today <= end_date_only else 'Expired'
 
+# ============= SEARCH HELPERS =============
+# Searchable records carry a search_keys array: lowercased full values plus
+# their individual words. An anchored regex on it is an index range scan on
+# (org_id, search_keys), which serves typeahead; a per-collection text index
+# ranks free-text matches.
+
+SEARCH_SOURCES = {
+    "client": {
+        "collection": "clients",
+        "keys": ("client_name", "poc_name", "poc_email", "gst"),
+        "text": {"client_name": 10, "poc_name": 3, "poc_email": 3, "gst": 5},
+        "title": lambda d: d.get('client_name', ''),
+        "subtitle": lambda d: d.get('service', ''),
+        "display": ("client_name", "service"),
+    },
+    "contractor": {
+        "collection": "contractors",
+        "keys": ("name", "personal_email", "pan"),
+        "text": {"name": 10, "personal_email": 3, "pan": 5},
+        "title": lambda d: d.get('name', ''),
+        "subtitle": lambda d: d.get('department', ''),
+        "display": ("name", "department"),
+    },
+    "employee": {
+        "collection": "employees",
+        "keys": (("first_name", "last_name"), "work_email", "personal_email", "emp_id"),
+        "text": {"first_name": 10, "last_name": 10, "emp_id": 10, "work_email": 3, "personal_email": 3},
+        "title": lambda d: f"{d.get('first_name', '')} {d.get('last_name', '')}".strip(),
+        "subtitle": lambda d: f"{d.get('emp_id', '')} · {d.get('department', '')}",
+        "display": ("first_name", "last_name", "emp_id", "department"),
+    },
+    "asset": {
+        "collection": "assets",
+        "keys": ("serial_number", "vendor", "model", "alloted_to", "email"),
+        "text": {"serial_number": 10, "model": 5, "vendor": 5, "alloted_to": 3, "asset_type": 3},
+        "title": lambda d: f"{d.get('asset_type', '')} {d.get('model', '')}".strip(),
+        "subtitle": lambda d: d.get('serial_number', ''),
+        "display": ("asset_type", "model", "serial_number"),
+    },
+}
+
+def normalise_search(value) -> str:
+    return ' '.join(str(value).lower().split())
+
+def build_search_keys(item_type: str, doc: dict) -> List[str]:
+    keys = []
+    for field in SEARCH_SOURCES[item_type]['keys']:
+        # A tuple of fields is searched as one value, e.g. first + last name
+        parts = field if isinstance(field, tuple) else (field,)
+        value = normalise_search(' '.join(str(doc[p]) for p in parts if doc.get(p)))
+        if value:
+            keys.append(value)
+            keys.extend(value.split())
+    return list(dict.fromkeys(keys))
+
+def with_search_keys(item_type: str, doc: dict) -> dict:
+    doc['search_keys'] = build_search_keys(item_type, doc)
+    return doc
+
+async def backfill_search_keys():
+    """Add search_keys to records written before search existed"""
+    try:
+        for item_type, source in SEARCH_SOURCES.items():
+            collection = db[source['collection']]
+            while True:
+                batch = await collection.find({"search_keys": {"$exists": False}}).limit(JOB_BATCH_SIZE).to_list(JOB_BATCH_SIZE)
+                if not batch:
+                    break
+                await collection.bulk_write([
+                    UpdateOne({"_id": doc['_id']}, {"$set": {"search_keys": build_search_keys(item_type, doc)}})
+                    for doc in batch
+                ], ordered=False)
+    except Exception as e:
+        logger.error(f"Search key backfill error: {str(e)}")
+
+async def search_source(item_type: str, org_id: str, q: str, term: str, limit: int) -> List[dict]:
+    source = SEARCH_SOURCES[item_type]
+    collection = db[source['collection']]
+    projection = {"_id": 0, "id": 1, "search_keys": 1, **{f: 1 for f in source['display']}}
+    
+    prefix_docs, text_docs = await asyncio.gather(
+        collection.find(
+            {"org_id": org_id, "search_keys": {"$regex": f"^{re.escape(term)}"}}, projection
+        ).limit(limit).to_list(limit),
+        collection.find(
+            {"org_id": org_id, "$text": {"$search": q}},
+            {**projection, "score": {"$meta": "textScore"}}
+        ).sort([("score", {"$meta": "textScore"})]).limit(limit).to_list(limit)
+    )
+    
+    hits = {}
+    for doc in text_docs:
+        hits[doc['id']] = (1, doc.get('score', 0.0), doc)
+    for doc in prefix_docs:
+        rank = 3 if term in doc.get('search_keys', []) else 2
+        hits[doc['id']] = (rank, hits.get(doc['id'], (0, 0.0))[1], doc)
+    
+    return [
+        {
+            "type": item_type,
+            "id": doc_id,
+            "title": source['title'](doc),
+            "subtitle": source['subtitle'](doc),
+            "match": {3: "exact", 2: "prefix", 1: "text"}[rank],
+            "score": round(rank + score / (1 + score), 4)
+        }
+        for doc_id, (rank, score, doc) in hits.items()
+    ]
+
+# ============= TYPEAHEAD HELPERS =============
+# Completion tries are built per org on first use and kept in this worker's
+# memory. Write handlers drop the affected tries; the TTL bounds staleness
+# from writes handled by other workers.
+
+TYPEAHEAD_TOP_K = int(os.environ.get('TYPEAHEAD_TOP_K', '10'))
+TYPEAHEAD_TTL_SECONDS = float(os.environ.get('TYPEAHEAD_TTL_SECONDS', '300'))
+
+# kind -> (collection, field, extra filter); a name's weight is how often it appears
+TYPEAHEAD_SOURCES = {
+    "products": [
+        ("stock_availability", "product_name", {}),
+        ("stock_transactions", "product_name", {}),
+    ],
+    "vendors": [
+        ("stock_transactions", "vendor_name_or_issued_to", {"type": "Stock In"}),
+        ("assets", "vendor", {}),
+    ],
+    "clients": [
+        ("clients", "client_name", {}),
+        ("client_onboarding", "client_name", {}),
+    ],
+}
+
+TYPEAHEAD_TRIES = {}  # (org_id, kind) -> (CompletionTrie, built_at)
+
+class CompletionTrie:
+    """Case-insensitive prefix tree whose nodes keep their own top-k completions.
+
+    Names are inserted by descending weight, so each node's list is already
+    ranked and a lookup is a walk of len(prefix) steps. Every word start is
+    indexed, so "cab" also completes "USB Cables".
+    """
+    __slots__ = ('root', 'k')
+    
+    def __init__(self, weights: dict, k: int = TYPEAHEAD_TOP_K):
+        self.k = k
+        self.root = ({}, [])  # node = (children, top names)
+        for name in sorted(weights, key=lambda n: (-weights[n], n.lower())):
+            key = normalise_search(name)
+            starts = [0] + [i + 1 for i, ch in enumerate(key) if ch == ' ']
+            self._offer(self.root, name)
+            for start in starts:
+                node = self.root
+                for ch in key[start:]:
+                    node = node[0].setdefault(ch, ({}, []))
+                    self._offer(node, name)
+    
+    def _offer(self, node, name: str):
+        top = node[1]
+        if len(top) < self.k and name not in top:
+            top.append(name)
+    
+    def complete(self, prefix: str, limit: int) -> List[str]:
+        node = self.root
+        for ch in normalise_search(prefix):
+            node = node[0].get(ch)
+            if node is None:
+                return []
+        return node[1][:limit]
+
+async def build_typeahead(org_id: str, kind: str) -> CompletionTrie:
+    counts = {}
+    for collection, field, extra in TYPEAHEAD_SOURCES[kind]:
+        rows = await db[collection].aggregate([
+            {"$match": {"org_id": org_id, **extra}},
+            {"$group": {"_id": f"${field}", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        for row in rows:
+            if row['_id']:
+                name = str(row['_id']).strip()
+                counts[name] = counts.get(name, 0) + row['count']
+    
+    # Collapse case/spacing variants onto their most used spelling
+    weights = {}
+    spelling = {}
+    for name, count in sorted(counts.items(), key=lambda item: -item[1]):
+        key = normalise_search(name)
+        spelling.setdefault(key, name)
+        weights[spelling[key]] = weights.get(spelling[key], 0) + count
+    return CompletionTrie(weights)
+
+async def get_typeahead(org_id: str, kind: str) -> CompletionTrie:
+    cached = TYPEAHEAD_TRIES.get((org_id, kind))
+    if cached and time.monotonic() - cached[1] < TYPEAHEAD_TTL_SECONDS:
+        return cached[0]
+    trie = await build_typeahead(org_id, kind)
+    TYPEAHEAD_TRIES[(org_id, kind)] = (trie, time.monotonic())
+    return trie
+
+def invalidate_typeahead(org_id: str, *kinds: str):
+    for kind in kinds or TYPEAHEAD_SOURCES:
+        TYPEAHEAD_TRIES.pop((org_id, kind), None)
+
 # ============= AUTH ROUTES =============
 
 @api_router.post("/auth/signup")
@@ -601,8 +1133,8 @@ async def get_me(current_user: dict = Depends(get_current_user)):
 @api_router.get("/users", response_model=List[User])
 async def get_users(current_user: dict = Depends(get_current_user)):
     # Only return users from the same organization
-    users = await db.users.find({"org_id": current_user['org_id']}, {"_id": 0, "password_hash": 0}).to_list(1000)
-    return users
+    users = await db.users.find({"org_id": current_user['org_id']}, model_projection(User, exclude=('password_hash',))).to_list(1000)
+    return trusted_response(users, User)
 
 @api_router.post("/users", response_model=User)
 async def create_user(user_data: UserCreate, current_user: dict = Depends(get_current_user)):
@@ -626,6 +1158,7 @@ async def create_user(user_data: UserCreate, current_user: dict = Depends(get_cu
     
     doc = user.model_dump()
     await db.users.insert_one(doc)
+    invalidate_samples(current_user['org_id'])
     return user
 
 @api_router.patch("/users/{user_id}")
@@ -645,6 +1178,7 @@ async def update_user(user_id: str, role: str = None, status: str = None, curren
         update_data['status'] = status
     
     await db.users.update_one({"id": user_id}, {"$set": update_data})
+    invalidate_samples(current_user['org_id'])
     return {"message": "User updated successfully"}
 
 @api_router.delete("/users/{user_id}")
@@ -664,6 +1198,7 @@ async def delete_user(user_id: str, current_user: dict = Depends(get_current_use
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
     
+    invalidate_samples(current_user['org_id'])
     return {"message": "User deleted successfully"}
 
 
@@ -671,11 +1206,13 @@ async def delete_user(user_id: str, current_user: dict = Depends(get_current_use
 
 @api_router.get("/clients", response_model=List[Client])
 async def get_clients(
+    request: Request,
     current_user: dict = Depends(get_current_user),
     sort_by: str = None,
     sort_order: str = 'asc',
     filter_status: str = None,
-    filter_department: str = None
+    filter_department: str = None,
+    fields: str = None
 ):
     query = {"org_id": current_user['org_id']}  # Filter by org_id
     if filter_status:
@@ -683,14 +1220,20 @@ async def get_clients(
     if filter_department:
         query['service'] = filter_department
     
-    clients = await db.clients.find(query, {"_id": 0}).to_list(1000)
+    etag = await list_etag(request, current_user['org_id'], 'clients')
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    selected = select_fields(Client, fields)
+    clients = await db.clients.find(query, model_projection(Client, fields=selected, extra=(sort_by,))).to_list(1000)
     
     # Sorting
     if sort_by:
         reverse = sort_order == 'desc'
         clients.sort(key=lambda x: x.get(sort_by, ''), reverse=reverse)
     
-    return clients
+    return with_etag(trusted_response(clients, Client, selected), etag)
 
 @api_router.get("/clients/active-by-department")
 async def get_active_clients_by_department(
@@ -712,8 +1255,11 @@ async def create_client(client_data: ClientCreate, current_user: dict = Depends(
     client.end_date = calculate_end_date(client.start_date, client.tenure_months)
     client.agreement_status = check_agreement_status(client.end_date)
     
-    doc = client.model_dump()
+    doc = with_search_keys('client', client.model_dump())
     await db.clients.insert_one(doc)
+    await bump_version(current_user['org_id'], 'clients')
+    await publish_event(current_user['org_id'], 'clients', client.id, 'create', client.client_status)
+    invalidate_typeahead(current_user['org_id'], 'clients')
     return client
 
 @api_router.patch("/clients/{client_id}")
@@ -734,7 +1280,16 @@ async def update_client(client_id: str, update_data: dict, current_user: dict =
             update_data['end_date'] = end_date
             update_data['agreement_status'] = agreement_status
     
+    if 'client_status' in update_data and update_data['client_status'] != client.get('client_status'):
+        update_data['churned_at'] = datetime.now(timezone.utc).isoformat() if update_data['client_status'] == 'Churned' else None
+    
+    update_data['search_keys'] = build_search_keys('client', {**client, **update_data})
+    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
     await db.clients.update_one({"id": client_id, "org_id": current_user['org_id']}, {"$set": update_data})
+    await bump_version(current_user['org_id'], 'clients')
+    await publish_event(current_user['org_id'], 'clients', client_id, 'update', update_data.get('client_status'))
+    if 'client_name' in update_data:
+        invalidate_typeahead(current_user['org_id'], 'clients')
     return {"message": "Client updated successfully"}
 
 @api_router.delete("/clients/{client_id}")
@@ -747,6 +1302,10 @@ async def delete_client(client_id: str, current_user: dict = Depends(get_current
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Client not found in your organization")
     
+    await record_tombstone(current_user['org_id'], 'clients', client_id)
+    await bump_version(current_user['org_id'], 'clients')
+    await publish_event(current_user['org_id'], 'clients', client_id, 'delete')
+    invalidate_typeahead(current_user['org_id'], 'clients')
     return {"message": "Client deleted successfully"}
 
 @api_router.post("/clients/generate-sla")
@@ -911,11 +1470,13 @@ async def generate_nda(request: NDAGenerateRequest):
 
 @api_router.get("/contractors", response_model=List[Contractor])
 async def get_contractors(
+    request: Request,
     current_user: dict = Depends(get_current_user),
     sort_by: str = None,
     sort_order: str = 'asc',
     filter_status: str = None,
-    filter_department: str = None
+    filter_department: str = None,
+    fields: str = None
 ):
     query = {"org_id": current_user['org_id']}  # Filter by org_id
     if filter_status:
@@ -923,14 +1484,20 @@ async def get_contractors(
     if filter_department:
         query['department'] = filter_department
     
-    contractors = await db.contractors.find(query, {"_id": 0}).to_list(1000)
+    etag = await list_etag(request, current_user['org_id'], 'contractors')
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    selected = select_fields(Contractor, fields)
+    contractors = await db.contractors.find(query, model_projection(Contractor, fields=selected, extra=(sort_by,))).to_list(1000)
     
     # Sorting
     if sort_by:
         reverse = sort_order == 'desc'
         contractors.sort(key=lambda x: x.get(sort_by, ''), reverse=reverse)
     
-    return contractors
+    return with_etag(trusted_response(contractors, Contractor, selected), etag)
 
 @api_router.post("/contractors", response_model=Contractor)
 async def create_contractor(contractor_data: ContractorCreate, current_user: dict = Depends(get_current_user)):
@@ -938,8 +1505,10 @@ async def create_contractor(contractor_data: ContractorCreate, current_user: dic
     contractor.end_date = calculate_end_date(contractor.start_date, contractor.tenure_months)
     contractor.agreement_status = check_agreement_status(contractor.end_date)
     
-    doc = contractor.model_dump()
+    doc = with_search_keys('contractor', contractor.model_dump())
     await db.contractors.insert_one(doc)
+    await bump_version(current_user['org_id'], 'contractors')
+    await publish_event(current_user['org_id'], 'contractors', contractor.id, 'create', contractor.status)
     return contractor
 
 @api_router.patch("/contractors/{contractor_id}")
@@ -960,7 +1529,11 @@ async def update_contractor(contractor_id: str, update_data: dict, current_user:
             update_data['end_date'] = end_date
             update_data['agreement_status'] = agreement_status
     
+    update_data['search_keys'] = build_search_keys('contractor', {**contractor, **update_data})
+    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
     await db.contractors.update_one({"id": contractor_id, "org_id": current_user['org_id']}, {"$set": update_data})
+    await bump_version(current_user['org_id'], 'contractors')
+    await publish_event(current_user['org_id'], 'contractors', contractor_id, 'update', update_data.get('status'))
     return {"message": "Contractor updated successfully"}
 
 @api_router.delete("/contractors/{contractor_id}")
@@ -973,6 +1546,9 @@ async def delete_contractor(contractor_id: str, current_user: dict = Depends(get
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Contractor not found in your organization")
     
+    await record_tombstone(current_user['org_id'], 'contractors', contractor_id)
+    await bump_version(current_user['org_id'], 'contractors')
+    await publish_event(current_user['org_id'], 'contractors', contractor_id, 'delete')
     return {"message": "Contractor deleted successfully"}
 
 @api_router.post("/contractors/generate-ica")
@@ -1033,11 +1609,13 @@ async def generate_ica(request: ICAGenerateRequest):
 
 @api_router.get("/employees", response_model=List[Employee])
 async def get_employees(
+    request: Request,
     current_user: dict = Depends(get_current_user),
     sort_by: str = None,
     sort_order: str = 'asc',
     filter_status: str = None,
-    filter_department: str = None
+    filter_department: str = None,
+    fields: str = None
 ):
     query = {"org_id": current_user['org_id']}  # Filter by org_id
     if filter_status:
@@ -1045,21 +1623,29 @@ async def get_employees(
     if filter_department:
         query['department'] = filter_department
     
-    employees = await db.employees.find(query, {"_id": 0}).to_list(1000)
+    etag = await list_etag(request, current_user['org_id'], 'employees')
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    selected = select_fields(Employee, fields)
+    employees = await db.employees.find(query, model_projection(Employee, fields=selected, extra=(sort_by,))).to_list(1000)
     
     # Sorting
     if sort_by:
         reverse = sort_order == 'desc'
         employees.sort(key=lambda x: x.get(sort_by, ''), reverse=reverse)
     
-    return employees
+    return with_etag(trusted_response(employees, Employee, selected), etag)
 
 @api_router.post("/employees", response_model=Employee)
 async def create_employee(employee_data: EmployeeCreate, current_user: dict = Depends(get_current_user)):
     employee = Employee(**employee_data.model_dump(), org_id=current_user['org_id'])  # Add org_id
     
-    doc = employee.model_dump()
+    doc = with_search_keys('employee', employee.model_dump())
     await db.employees.insert_one(doc)
+    await bump_version(current_user['org_id'], 'employees')
+    await publish_event(current_user['org_id'], 'employees', employee.id, 'create', employee.status)
     return employee
 
 @api_router.patch("/employees/{employee_id}")
@@ -1069,7 +1655,11 @@ async def update_employee(employee_id: str, update_data: dict, current_user: dic
     if not employee:
         raise HTTPException(status_code=404, detail="Employee not found in your organization")
     
+    update_data['search_keys'] = build_search_keys('employee', {**employee, **update_data})
+    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
     await db.employees.update_one({"id": employee_id, "org_id": current_user['org_id']}, {"$set": update_data})
+    await bump_version(current_user['org_id'], 'employees')
+    await publish_event(current_user['org_id'], 'employees', employee_id, 'update', update_data.get('status'))
     return {"message": "Employee updated successfully"}
 
 @api_router.delete("/employees/{employee_id}")
@@ -1082,13 +1672,16 @@ async def delete_employee(employee_id: str, current_user: dict = Depends(get_cur
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Employee not found in your organization")
     
+    await record_tombstone(current_user['org_id'], 'employees', employee_id)
+    await bump_version(current_user['org_id'], 'employees')
+    await publish_event(current_user['org_id'], 'employees', employee_id, 'delete')
     return {"message": "Employee deleted successfully"}
 
 @api_router.post("/employees/generate-offer")
 async def generate_offer_letter(request: OfferLetterGenerateRequest):
     # Calculate CTC
     gross_annual = request.gross_salary_lpa * 100000
-    ctc_annual = gross_annual + 21600
+    ctc_annual = gross_annual + EMPLOYER_PF_MONTHLY * 12
     monthly_ctc = ctc_annual / 12
     monthly_gross = gross_annual / 12
     
@@ -1130,14 +1723,14 @@ async def generate_offer_letter(request: OfferLetterGenerateRequest):
     doc.add_paragraph("Monthly Salary Breakdown:")
     
     # Calculate components
-    basic = monthly_gross * 0.50
-    hra = monthly_gross * 0.30
-    special = monthly_gross * 0.20
+    basic = monthly_gross * SALARY_SPLIT['basic']
+    hra = monthly_gross * SALARY_SPLIT['hra']
+    special = monthly_gross * SALARY_SPLIT['special']
     
     doc.add_paragraph(f"• Basic Salary: INR {basic:,.2f}")
     doc.add_paragraph(f"• HRA: INR {hra:,.2f}")
     doc.add_paragraph(f"• Special Allowance: INR {special:,.2f}")
-    doc.add_paragraph(f"• Employer PF Contribution: INR 1,800.00")
+    doc.add_paragraph(f"• Employer PF Contribution: INR {EMPLOYER_PF_MONTHLY:,.2f}")
     doc.add_paragraph()
     
     doc.add_paragraph(f"Please sign and return this offer letter before {request.sign_before_date}.")
@@ -1166,6 +1759,816 @@ async def generate_offer_letter(request: OfferLetterGenerateRequest):
         headers={'Content-Disposition': f'attachment; filename="Offer_{request.employee_name.replace(" ", "_")}.docx"'}
     )
 
+# ============= PAYROLL ROUTES =============
+# A run computes every active employee's payslip for one month in a single
+# vectorised pass and stores them in payslips, one document per employee. The
+# bank file and payslip workbook are built from those stored rows, so they
+# always match the run even after salaries change.
+
+PAYSLIP_FIELDS = ["emp_id", "first_name", "last_name", "department", "doj", "work_email",
+                  "bank_name", "account_no", "ifsc", "monthly_gross_inr"]
+PAYSLIP_COMPONENTS = ["gross", "basic", "hra", "special", "employer_pf", "ctc"]
+
+def month_bounds(month: str):
+    """First and last day of a YYYY-MM month"""
+    try:
+        first = datetime.strptime(month, "%Y-%m").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+    last = (pd.Timestamp(first) + pd.offsets.MonthEnd(0)).date()
+    return first, last
+
+def compute_payslips(employees: List[dict], month: str) -> pd.DataFrame:
+    """One row per employee paid in the month, with salary components in INR.
+
+    Employees who joined during the month are paid for the days from their
+    date of joining, and employer PF is pro-rated the same way, so ctc is the
+    offer-letter figure for the days worked; those joining after it are left out.
+    """
+    first, last = month_bounds(month)
+    df = pd.DataFrame(employees, columns=["id"] + PAYSLIP_FIELDS)
+    doj = pd.to_datetime(df['doj'].astype(str).str[:10], format='%Y-%m-%d', errors='coerce').to_numpy(dtype='datetime64[D]')
+    # Unparseable joining dates are paid for the full month rather than dropped
+    doj = np.where(np.isnat(doj), np.datetime64(first, 'D'), doj)
+    joined = doj <= np.datetime64(last, 'D')
+    df = df[joined].reset_index(drop=True)
+    
+    days_in_month = last.day
+    paid_days = np.clip((np.datetime64(last, 'D') - doj[joined]).astype(int) + 1, 0, days_in_month)
+    gross = np.round(df['monthly_gross_inr'].astype(float).to_numpy() * paid_days / days_in_month, 2)
+    
+    df['month'] = month
+    df['paid_days'] = paid_days
+    df['gross'] = gross
+    df['basic'] = np.round(gross * SALARY_SPLIT['basic'], 2)
+    df['hra'] = np.round(gross * SALARY_SPLIT['hra'], 2)
+    # Remainder, so components always add back up to gross after rounding
+    df['special'] = np.round(gross - df['basic'] - df['hra'], 2)
+    df['employer_pf'] = np.round(EMPLOYER_PF_MONTHLY * paid_days / days_in_month, 2)
+    df['ctc'] = np.round(gross + df['employer_pf'], 2)
+    df['net_pay'] = gross
+    return df.rename(columns={"id": "employee_id"})
+
+def payroll_summary(df: pd.DataFrame) -> tuple:
+    totals = {name: round(float(df[name].sum()), 2) for name in PAYSLIP_COMPONENTS + ["net_pay"]}
+    by_department = {
+        str(department): {"count": int(len(group)), "gross": round(float(group['gross'].sum()), 2),
+                          "ctc": round(float(group['ctc'].sum()), 2)}
+        for department, group in df.groupby('department')
+    }
+    return totals, by_department
+
+BANK_FILE_CHUNK_BYTES = 64 * 1024
+
+async def stream_csv(rows):
+    """CSV text from an async iterable of rows, yielded in chunks of about BANK_FILE_CHUNK_BYTES"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    async for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= BANK_FILE_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+async def get_payroll_run_or_404(run_id: str, org_id: str) -> dict:
+    run = await db.payroll_runs.find_one({"id": run_id, "org_id": org_id}, {"_id": 0})
+    if not run:
+        raise HTTPException(status_code=404, detail="Payroll run not found")
+    return run
+
+@api_router.post("/payroll/runs")
+async def create_payroll_run(request: PayrollRunRequest, current_user: dict = Depends(get_current_user)):
+    """Compute and store payslips for every active employee (Admin only)"""
+    if current_user['role'] != 'Admin':
+        raise HTTPException(status_code=403, detail="Only Admin can run payroll")
+    
+    org_id = current_user['org_id']
+    month_bounds(request.month)
+    if await db.payroll_runs.find_one({"org_id": org_id, "month": request.month}, {"_id": 1}):
+        raise HTTPException(status_code=409, detail=f"Payroll for {request.month} has already been run")
+    
+    employees = await db.employees.find(
+        {"org_id": org_id, "status": "Active"},
+        {"_id": 0, "id": 1, **{field: 1 for field in PAYSLIP_FIELDS}}
+    ).to_list(None)
+    df = await asyncio.to_thread(compute_payslips, employees, request.month)
+    if df.empty:
+        raise HTTPException(status_code=400, detail=f"No active employees to pay for {request.month}")
+    
+    totals, by_department = payroll_summary(df)
+    run = PayrollRun(
+        org_id=org_id,
+        month=request.month,
+        employee_count=len(df),
+        totals=totals,
+        by_department=by_department,
+        created_by=current_user['user_id']
+    ).model_dump()
+    
+    df['org_id'] = org_id
+    df['run_id'] = run['id']
+    payslips = df.to_dict('records')
+    
+    async def write(session):
+        # The run document goes last: a run is only visible once all its payslips are in
+        for start in range(0, len(payslips), JOB_BATCH_SIZE):
+            await db.payslips.insert_many(payslips[start:start + JOB_BATCH_SIZE], ordered=False, session=session)
+        await db.payroll_runs.insert_one(dict(run), session=session)
+    
+    try:
+        await run_in_transaction(write)
+    except Exception:
+        # Without transactions, drop whatever part of the run was written
+        await db.payslips.delete_many({"org_id": org_id, "run_id": run['id']})
+        raise
+    
+    return run
+
+@api_router.get("/payroll/runs")
+async def get_payroll_runs(current_user: dict = Depends(get_current_user)):
+    runs = await db.payroll_runs.find({"org_id": current_user['org_id']}, {"_id": 0}).sort("month", -1).to_list(None)
+    return trusted_response(runs, PayrollRun)
+
+@api_router.get("/payroll/runs/{run_id}")
+async def get_payroll_run(run_id: str, current_user: dict = Depends(get_current_user)):
+    return await get_payroll_run_or_404(run_id, current_user['org_id'])
+
+@api_router.delete("/payroll/runs/{run_id}")
+async def delete_payroll_run(run_id: str, current_user: dict = Depends(get_current_user)):
+    """Discard a run and its payslips so the month can be run again (Admin only)"""
+    if current_user['role'] != 'Admin':
+        raise HTTPException(status_code=403, detail="Only Admin can delete payroll runs")
+    
+    org_id = current_user['org_id']
+    result = await db.payroll_runs.delete_one({"id": run_id, "org_id": org_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Payroll run not found")
+    await db.payslips.delete_many({"org_id": org_id, "run_id": run_id})
+    return {"message": "Payroll run deleted successfully"}
+
+@api_router.get("/payroll/runs/{run_id}/bank-file")
+async def get_payroll_bank_file(run_id: str, current_user: dict = Depends(get_current_user)):
+    """Salary transfer CSV for the bank, streamed straight from the stored payslips"""
+    org_id = current_user['org_id']
+    run = await get_payroll_run_or_404(run_id, org_id)
+    
+    async def rows():
+        yield ["Beneficiary Name", "Account Number", "IFSC", "Bank Name", "Amount", "Employee ID", "Narration"]
+        cursor = db.payslips.find(
+            {"org_id": org_id, "run_id": run_id},
+            {"_id": 0, "first_name": 1, "last_name": 1, "account_no": 1, "ifsc": 1, "bank_name": 1, "net_pay": 1, "emp_id": 1}
+        ).sort("emp_id", 1).batch_size(JOB_BATCH_SIZE)
+        async for slip in cursor:
+            yield [
+                f"{slip['first_name']} {slip['last_name']}", slip['account_no'], slip['ifsc'], slip['bank_name'],
+                f"{slip['net_pay']:.2f}", slip['emp_id'], f"Salary {run['month']}"
+            ]
+    
+    return StreamingResponse(
+        stream_csv(rows()),
+        media_type='text/csv',
+        headers={'Content-Disposition': f'attachment; filename="salary_transfer_{run["month"]}.csv"'}
+    )
+
+@api_router.get("/payroll/runs/{run_id}/payslips")
+async def get_payroll_payslips(run_id: str, current_user: dict = Depends(get_current_user)):
+    """All payslips of a run as one workbook, a row per employee"""
+    org_id = current_user['org_id']
+    run = await get_payroll_run_or_404(run_id, org_id)
+    payslips = await db.payslips.find(
+        {"org_id": org_id, "run_id": run_id},
+        {"_id": 0, "org_id": 0, "run_id": 0, "employee_id": 0}
+    ).sort("emp_id", 1).to_list(None)
+    
+    def render() -> bytes:
+        df = pd.DataFrame(payslips, columns=[
+            "month", "emp_id", "first_name", "last_name", "department", "doj", "work_email",
+            "monthly_gross_inr", "paid_days", *PAYSLIP_COMPONENTS, "net_pay", "bank_name", "account_no", "ifsc"
+        ])
+        output = BytesIO()
+        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+            df.to_excel(writer, index=False, sheet_name='Payslips')
+        return output.getvalue()
+    
+    return Response(
+        content=await asyncio.to_thread(render),
+        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        headers={'Content-Disposition': f'attachment; filename="payslips_{run["month"]}.xlsx"'}
+    )
+
+# ============= CONTRACTOR PAYOUT ROUTES =============
+# A payout batch pays each active contractor whose agreement runs during the
+# month, pro-rated by the days it covers. The agreement runs from start_date up
+# to the day before end_date (start + tenure), so a full tenure pays exactly
+# tenure_months of retainer. Contractors are read and payouts written a
+# JOB_BATCH_SIZE chunk at a time, so a batch never holds everyone in memory.
+
+PAYOUT_FIELDS = ["name", "pan", "department", "start_date", "end_date", "monthly_retainer_inr",
+                 "account_holder", "bank_name", "account_no", "ifsc"]
+
+def compute_payouts(contractors: List[dict], month: str) -> pd.DataFrame:
+    """Pro-rated payout rows for a chunk of contractors; those with no days in the month are dropped"""
+    first, last = month_bounds(month)
+    first_day, last_day = np.datetime64(first, 'D'), np.datetime64(last, 'D')
+    df = pd.DataFrame(contractors, columns=["id"] + PAYOUT_FIELDS)
+    
+    def days(column):
+        return pd.to_datetime(df[column].astype(str).str[:10], format='%Y-%m-%d', errors='coerce').to_numpy(dtype='datetime64[D]')
+    start, end = days('start_date'), days('end_date')
+    # Unparseable dates leave that side of the month open rather than dropping the contractor
+    paid_from = np.where(np.isnat(start), first_day, np.maximum(start, first_day))
+    paid_to = np.where(np.isnat(end), last_day, np.minimum(end - np.timedelta64(1, 'D'), last_day))
+    paid_days = np.clip((paid_to - paid_from).astype(int) + 1, 0, None)
+    
+    paid = paid_days > 0
+    df = df[paid].reset_index(drop=True)
+    df['month'] = month
+    df['paid_days'] = paid_days[paid]
+    df['amount_inr'] = np.round(df['monthly_retainer_inr'].astype(float).to_numpy() * df['paid_days'] / last.day, 2)
+    return df.rename(columns={"id": "contractor_id"})
+
+async def get_payout_batch_or_404(batch_id: str, org_id: str) -> dict:
+    batch = await db.payout_batches.find_one({"id": batch_id, "org_id": org_id}, {"_id": 0})
+    if not batch:
+        raise HTTPException(status_code=404, detail="Payout batch not found")
+    return batch
+
+@api_router.post("/payouts")
+async def create_payout_batch(request: PayrollRunRequest, current_user: dict = Depends(get_current_user)):
+    """Compute and record a month's contractor payouts (Admin only)"""
+    if current_user['role'] != 'Admin':
+        raise HTTPException(status_code=403, detail="Only Admin can create payout batches")
+    
+    org_id = current_user['org_id']
+    first, last = month_bounds(request.month)
+    if await db.payout_batches.find_one({"org_id": org_id, "month": request.month}, {"_id": 1}):
+        raise HTTPException(status_code=409, detail=f"Payouts for {request.month} have already been created")
+    
+    batch_id = f"payout_{uuid.uuid4().hex[:8]}"
+    query = {
+        "org_id": org_id,
+        "status": "Active",
+        "start_date": {"$lte": last.isoformat()},
+        "end_date": {"$gt": first.isoformat()}
+    }
+    projection = {"_id": 0, "id": 1, **{field: 1 for field in PAYOUT_FIELDS}}
+    
+    async def write(session):
+        count, total, by_department = 0, 0.0, {}
+        
+        async def add(chunk):
+            nonlocal count, total
+            df = compute_payouts(chunk, request.month)
+            if df.empty:
+                return
+            df['org_id'] = org_id
+            df['batch_id'] = batch_id
+            await db.contractor_payouts.insert_many(df.to_dict('records'), ordered=False, session=session)
+            count += len(df)
+            total += float(df['amount_inr'].sum())
+            for department, group in df.groupby('department'):
+                entry = by_department.setdefault(str(department), {"count": 0, "amount": 0.0})
+                entry['count'] += int(len(group))
+                entry['amount'] = round(entry['amount'] + float(group['amount_inr'].sum()), 2)
+        
+        chunk = []
+        async for contractor in db.contractors.find(query, projection, session=session).batch_size(JOB_BATCH_SIZE):
+            chunk.append(contractor)
+            if len(chunk) == JOB_BATCH_SIZE:
+                await add(chunk)
+                chunk = []
+        if chunk:
+            await add(chunk)
+        if not count:
+            raise HTTPException(status_code=400, detail=f"No contractors to pay for {request.month}")
+        
+        batch = PayoutBatch(
+            id=batch_id,
+            org_id=org_id,
+            month=request.month,
+            contractor_count=count,
+            total_inr=round(total, 2),
+            by_department=by_department,
+            created_by=current_user['user_id']
+        ).model_dump()
+        # The batch document goes last: a batch is only visible once all its payouts are in
+        await db.payout_batches.insert_one(dict(batch), session=session)
+        return batch
+    
+    try:
+        return await run_in_transaction(write)
+    except Exception:
+        # Without transactions, drop whatever part of the batch was written
+        await db.contractor_payouts.delete_many({"org_id": org_id, "batch_id": batch_id})
+        raise
+
+@api_router.get("/payouts")
+async def get_payout_batches(current_user: dict = Depends(get_current_user)):
+    batches = await db.payout_batches.find({"org_id": current_user['org_id']}, {"_id": 0}).sort("month", -1).to_list(None)
+    return trusted_response(batches, PayoutBatch)
+
+@api_router.get("/payouts/{batch_id}")
+async def get_payout_batch(batch_id: str, current_user: dict = Depends(get_current_user)):
+    return await get_payout_batch_or_404(batch_id, current_user['org_id'])
+
+@api_router.delete("/payouts/{batch_id}")
+async def delete_payout_batch(batch_id: str, current_user: dict = Depends(get_current_user)):
+    """Discard a batch and its payouts so the month can be created again (Admin only)"""
+    if current_user['role'] != 'Admin':
+        raise HTTPException(status_code=403, detail="Only Admin can delete payout batches")
+    
+    org_id = current_user['org_id']
+    result = await db.payout_batches.delete_one({"id": batch_id, "org_id": org_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Payout batch not found")
+    await db.contractor_payouts.delete_many({"org_id": org_id, "batch_id": batch_id})
+    return {"message": "Payout batch deleted successfully"}
+
+@api_router.get("/payouts/{batch_id}/bank-file")
+async def get_payout_bank_file(
+    batch_id: str,
+    format: Literal['csv', 'neft'] = 'csv',
+    current_user: dict = Depends(get_current_user)
+):
+    """Bank upload file for a batch, streamed from a cursor over its payouts.
+
+    csv has a header row and bank/department details; neft is the headerless
+    bulk NEFT layout: type, account, IFSC, beneficiary, amount, value date, narration.
+    """
+    org_id = current_user['org_id']
+    batch = await get_payout_batch_or_404(batch_id, org_id)
+    narration = f"Retainer {batch['month']}"
+    value_date = datetime.now(timezone.utc).strftime('%d/%m/%Y')
+    
+    async def rows():
+        if format == 'csv':
+            yield ["Beneficiary Name", "Account Number", "IFSC", "Bank Name", "Amount", "PAN", "Department", "Paid Days", "Narration"]
+        cursor = db.contractor_payouts.find(
+            {"org_id": org_id, "batch_id": batch_id},
+            {"_id": 0, "account_holder": 1, "account_no": 1, "ifsc": 1, "bank_name": 1, "amount_inr": 1,
+             "pan": 1, "department": 1, "paid_days": 1}
+        ).sort("pan", 1).batch_size(JOB_BATCH_SIZE)
+        async for payout in cursor:
+            amount = f"{payout['amount_inr']:.2f}"
+            if format == 'neft':
+                yield ["N", payout['account_no'], payout['ifsc'].upper(), payout['account_holder'], amount, value_date, narration]
+            else:
+                yield [payout['account_holder'], payout['account_no'], payout['ifsc'], payout['bank_name'], amount,
+                       payout['pan'], payout['department'], payout['paid_days'], narration]
+    
+    extension = 'txt' if format == 'neft' else 'csv'
+    return StreamingResponse(
+        stream_csv(rows()),
+        media_type='text/plain' if format == 'neft' else 'text/csv',
+        headers={'Content-Disposition': f'attachment; filename="contractor_payouts_{batch["month"]}.{extension}"'}
+    )
+
+# ============= INVOICE ROUTES =============
+# A monthly invoice run bills every active client whose agreement covers the
+# month. Invoice numbers are reserved as one block per run from a counter per
+# org and financial year (INV/2025-26/0001). GST series must be consecutive, so
+# a run first claims its (org, month) slot, and a block is only handed back to
+# the counter while it is still the latest one: on failure, or when the latest
+# run is deleted. A Running run refreshes updated_at after every chunk; one whose
+# job has ended or that has gone quiet for INVOICE_RUN_STALE_MINUTES (worker
+# restart mid-run) is taken over by delete or by a new run for the month.
+# The invoice docx is built once with placeholders and compiled into literal XML segments, so rendering an
+# invoice is a string join plus a zip write. Chunks of invoices render in
+# worker processes and are stored in the invoices collection as they finish.
+
+GST_RATE = 0.18
+INVOICE_WORKERS = int(os.environ.get('INVOICE_WORKERS', str(os.cpu_count() or 1)))
+INVOICE_CHUNK_SIZE = int(os.environ.get('INVOICE_CHUNK_SIZE', '25'))
+INVOICE_RUN_STALE_MINUTES = float(os.environ.get('INVOICE_RUN_STALE_MINUTES', '15'))
+INVOICE_FIELDS = ["id", "client_name", "address", "gst", "service", "currency_preference", "amount_inr"]
+
+def build_invoice_template() -> bytes:
+    """Invoice docx with {{field}} placeholders, each kept inside a single run"""
+    doc = Document()
+    title = doc.add_paragraph()
+    title_run = title.add_run('TAX INVOICE')
+    title_run.bold = True
+    title_run.font.size = Pt(18)
+    title.alignment = 1
+    
+    doc.add_paragraph("{{org_name}}").runs[0].bold = True
+    doc.add_paragraph("GSTIN: {{supplier_gstin}}")
+    doc.add_paragraph()
+    doc.add_paragraph("Invoice No: {{invoice_number}}")
+    doc.add_paragraph("Invoice Date: {{invoice_date}}")
+    doc.add_paragraph("Billing Period: {{period}}")
+    doc.add_paragraph()
+    doc.add_paragraph("Bill To:").runs[0].bold = True
+    doc.add_paragraph("{{client_name}}")
+    doc.add_paragraph("{{address}}")
+    doc.add_paragraph("GSTIN: {{gst}}")
+    doc.add_paragraph()
+    
+    table = doc.add_table(rows=4, cols=2)
+    table.style = 'Table Grid'
+    for row, (label, value) in enumerate([
+        ("Description", "Amount ({{currency}})"),
+        ("{{service}} services for {{period}}", "{{amount}}"),
+        ("{{tax_label}}", "{{tax}}"),
+        ("Total", "{{total}}"),
+    ]):
+        table.cell(row, 0).text = label
+        table.cell(row, 1).text = value
+    doc.add_paragraph()
+    doc.add_paragraph("{{tax_note}}")
+    doc.add_paragraph("This is a computer generated invoice.")
+    
+    bio = BytesIO()
+    doc.save(bio)
+    return bio.getvalue()
+
+def compile_docx_template(content: bytes) -> tuple:
+    """Split a docx into its zip parts, with word/document.xml cut at each {{field}}.
+
+    Returns (parts, segments): parts is [(name, bytes)] in archive order with
+    None standing in for document.xml; segments alternate literal XML and field names.
+    """
+    parts = []
+    with zipfile.ZipFile(BytesIO(content)) as archive:
+        for info in archive.infolist():
+            parts.append((info.filename, None if info.filename == 'word/document.xml' else archive.read(info)))
+        document = archive.read('word/document.xml').decode('utf-8')
+    return parts, re.split(r"\{\{(\w+)\}\}", document)
+
+def render_docx(template: tuple, values: dict) -> bytes:
+    parts, segments = template
+    document = "".join(
+        segment if i % 2 == 0 else xml_escape(str(values.get(segment, "")))
+        for i, segment in enumerate(segments)
+    ).encode('utf-8')
+    output = BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in parts:
+            archive.writestr(name, document if data is None else data)
+    return output.getvalue()
+
+@lru_cache(maxsize=None)
+def get_invoice_template() -> tuple:
+    return compile_docx_template(build_invoice_template())
+
+worker_invoice_template = None  # Set in each invoice worker process
+
+def init_invoice_worker(template: tuple):
+    global worker_invoice_template
+    worker_invoice_template = template
+
+def render_invoice_chunk(rows: List[dict], template: tuple = None) -> List[bytes]:
+    """Runs in an invoice worker process, or in a thread when INVOICE_WORKERS is 1"""
+    template = template or worker_invoice_template
+    return [render_docx(template, row) for row in rows]
+
+invoice_pool = None
+
+def get_invoice_pool() -> Optional[ProcessPoolExecutor]:
+    """Worker processes for invoice rendering, started on first use. spawn, since forking
+    a process with running threads and an event loop is unsafe"""
+    global invoice_pool
+    if invoice_pool is None and INVOICE_WORKERS > 1:
+        invoice_pool = ProcessPoolExecutor(
+            max_workers=INVOICE_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_invoice_worker,
+            initargs=(get_invoice_template(),)
+        )
+    return invoice_pool
+
+def financial_year(day) -> str:
+    """Indian financial year (April to March) of a date, e.g. 2025-26"""
+    start = day.year if day.month >= 4 else day.year - 1
+    return f"{start}-{str(start + 1)[2:]}"
+
+def invoice_rows(clients: List[dict], month: str, supplier_gstin: Optional[str]) -> pd.DataFrame:
+    """Amounts and tax for each client. INR invoices carry 18% GST, split CGST/SGST
+    when the place of supply is the supplier's state: the client's GSTIN state
+    code, or the supplier's own state for clients without a valid GSTIN. Other
+    currencies are zero-rated exports of services. supplier_gstin is required
+    whenever there are INR invoices"""
+    df = pd.DataFrame(clients, columns=INVOICE_FIELDS)
+    amount = np.round(df['amount_inr'].astype(float).to_numpy(), 2)
+    currency = df['currency_preference'].fillna(BASE_CURRENCY).to_numpy()
+    taxed = currency == BASE_CURRENCY
+    client_gstin = df['gst'].fillna("").astype(str).str.strip().str.upper()
+    supplier_state = (supplier_gstin or "")[:2]
+    place_of_supply = np.where(
+        client_gstin.str.fullmatch(IMPORT_PATTERNS['gst'][0]).to_numpy(), client_gstin.str[:2].to_numpy(), supplier_state
+    )
+    intra_state = taxed & bool(supplier_state) & (place_of_supply == supplier_state)
+    
+    half = np.round(amount * GST_RATE / 2, 2)
+    df['amount'] = amount
+    df['currency'] = currency
+    df['cgst'] = np.where(intra_state, half, 0.0)
+    df['sgst'] = df['cgst']
+    df['igst'] = np.where(taxed & ~intra_state, np.round(amount * GST_RATE, 2), 0.0)
+    df['tax'] = np.round(df['cgst'] + df['sgst'] + df['igst'], 2)
+    df['total'] = np.round(amount + df['tax'], 2)
+    df['tax_label'] = np.where(intra_state, "CGST 9% + SGST 9%", np.where(taxed, "IGST 18%", "IGST 0% (export of services)"))
+    df['tax_note'] = np.where(taxed, "", "Supply meant for export under LUT without payment of integrated tax.")
+    df['month'] = month
+    return df.rename(columns={"id": "client_id"})
+
+def invoice_client_query(org_id: str, month: str) -> dict:
+    first, last = month_bounds(month)
+    return {
+        "org_id": org_id,
+        "client_status": "Active",
+        "start_date": {"$lte": last.isoformat()},
+        "end_date": {"$gt": first.isoformat()}
+    }
+
+async def release_invoice_numbers(run: dict) -> bool:
+    """Hand a run's block back to the counter if no later block was reserved"""
+    if run.get('first_sequence') is None:
+        return True
+    count = run['last_sequence'] - run['first_sequence'] + 1
+    released = await db.invoice_counters.find_one_and_update(
+        {"org_id": run['org_id'], "financial_year": run['financial_year'], "next": run['last_sequence']},
+        {"$inc": {"next": -count}}
+    )
+    return released is not None
+
+async def touch_invoice_run(run_id: str, update: dict = None):
+    """Heartbeat for a Running run; raises once the run has been taken over"""
+    result = await db.invoice_runs.update_one(
+        {"id": run_id, "status": "Running"},
+        {"$set": {**(update or {}), "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    if result.matched_count == 0:
+        raise ValueError(f"Invoice run {run_id} was taken over")
+
+async def take_over_invoice_run(run: dict) -> Optional[dict]:
+    """Mark a Running run whose job ended or went quiet as Failed, so the job can
+    no longer write to it. Returns the run as taken over, or None if it is still live"""
+    job = await db.jobs.find_one({"id": run.get('job_id')}, {"_id": 0, "status": 1}) if run.get('job_id') else None
+    stale = (datetime.now(timezone.utc) - timedelta(minutes=INVOICE_RUN_STALE_MINUTES)).isoformat()
+    if not (job and job['status'] in ('Completed', 'Failed')) and run.get('updated_at', run['created_at']) >= stale:
+        return None
+    taken = await db.invoice_runs.find_one_and_update(
+        {"id": run['id'], "status": "Running", "updated_at": run.get('updated_at')},
+        {"$set": {"status": "Failed", "error": "Abandoned by its job", "updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if taken:
+        await db.invoices.delete_many({"org_id": run['org_id'], "run_id": run['id']})
+    return taken
+
+async def discard_invoice_run(run: dict) -> bool:
+    """Release a finished run's numbers and delete it with its invoices; False if
+    a later block was reserved, in which case nothing is deleted"""
+    if not await release_invoice_numbers(run):
+        return False
+    await db.invoice_runs.delete_one({"id": run['id'], "org_id": run['org_id']})
+    await db.invoices.delete_many({"org_id": run['org_id'], "run_id": run['id']})
+    return True
+
+async def generate_invoice_run(job_id: str, run: dict, request: InvoiceRunRequest) -> dict:
+    org_id, run_id = run['org_id'], run['id']
+    first, _ = month_bounds(request.month)
+    try:
+        clients = await db.clients.find(
+            invoice_client_query(org_id, request.month), {"_id": 0, **{field: 1 for field in INVOICE_FIELDS}}
+        ).sort("client_name", 1).to_list(None)
+        if not clients:
+            raise ValueError(f"No active clients to invoice for {request.month}")
+        org = await db.organizations.find_one({"org_id": org_id}, {"_id": 0, "org_name": 1}) or {}
+        
+        # Reserve a block of numbers in one atomic step, so concurrent runs never share one
+        year = financial_year(first)
+        counter = await db.invoice_counters.find_one_and_update(
+            {"org_id": org_id, "financial_year": year},
+            {"$inc": {"next": len(clients)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        run.update(financial_year=year, first_sequence=counter['next'] - len(clients) + 1, last_sequence=counter['next'])
+        recorded = await db.invoice_runs.update_one({"id": run_id, "status": "Running"}, {"$set": {
+            "financial_year": year, "first_sequence": run['first_sequence'], "last_sequence": run['last_sequence'],
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }})
+        if recorded.matched_count == 0:
+            # Taken over before the block was on record, so only this job can hand it back
+            if not await release_invoice_numbers(run):
+                logger.error(f"Invoice run {run_id} lost numbers {run['first_sequence']}-{run['last_sequence']}")
+            raise ValueError(f"Invoice run {run_id} was taken over")
+        numbers = range(run['first_sequence'], run['last_sequence'] + 1)
+        
+        df = invoice_rows(clients, request.month, request.supplier_gstin)
+        df['invoice_number'] = [f"INV/{year}/{n:04d}" for n in numbers]
+        df['id'] = [f"inv_{uuid.uuid4().hex[:8]}" for _ in numbers]
+        df['filename'] = [
+            f"{number.replace('/', '-')}_{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')}.docx"
+            for number, name in zip(df['invoice_number'], df['client_name'])
+        ]
+        invoices = df.to_dict('records')
+        
+        period = first.strftime('%B %Y')
+        values = [{
+            **invoice,
+            "org_name": org.get('org_name', ""),
+            "supplier_gstin": request.supplier_gstin or "",
+            "invoice_date": first.isoformat(),
+            "period": period,
+            **{field: f"{invoice[field]:,.2f}" for field in ("amount", "tax", "total")}
+        } for invoice in invoices]
+        
+        await update_job_progress(job_id, "invoices", 0, len(invoices))
+        pool = get_invoice_pool()
+        loop = asyncio.get_running_loop()
+        
+        async def render(start: int) -> int:
+            chunk = values[start:start + INVOICE_CHUNK_SIZE]
+            if pool:
+                rendered = await loop.run_in_executor(pool, render_invoice_chunk, chunk)
+            else:
+                rendered = await asyncio.to_thread(render_invoice_chunk, chunk, get_invoice_template())
+            await db.invoices.insert_many([
+                {**invoice, "org_id": org_id, "run_id": run_id, "content": content}
+                for invoice, content in zip(invoices[start:start + INVOICE_CHUNK_SIZE], rendered)
+            ], ordered=False)
+            await update_job_progress(job_id, "invoices", len(chunk))
+            await touch_invoice_run(run_id)
+            return len(chunk)
+        
+        await asyncio.gather(*(render(start) for start in range(0, len(invoices), INVOICE_CHUNK_SIZE)))
+        totals = {
+            str(currency): {name: round(float(group[name].sum()), 2) for name in ("amount", "tax", "total")}
+            for currency, group in df.groupby('currency')
+        }
+        await touch_invoice_run(run_id, {
+            "status": "Completed",
+            "invoice_count": len(invoices),
+            "first_number": invoices[0]['invoice_number'],
+            "last_number": invoices[-1]['invoice_number'],
+            "totals": totals
+        })
+    except Exception as e:
+        await db.invoices.delete_many({"org_id": org_id, "run_id": run_id})
+        if not await db.invoice_runs.find_one({"id": run_id, "status": "Running"}, {"_id": 1}):
+            # Taken over: the run and its numbers are no longer this job's to settle
+            raise
+        if await release_invoice_numbers(run):
+            # Nothing was issued: free the month for another run
+            await db.invoice_runs.delete_one({"id": run_id})
+        else:
+            # A later run holds the next block; keep the reserved numbers on record
+            logger.error(f"Invoice run {run_id} failed holding numbers {run['first_sequence']}-{run['last_sequence']}")
+            await db.invoice_runs.update_one({"id": run_id}, {"$set": {"status": "Failed", "error": str(e)}})
+        raise
+    return {"run_id": run_id, "invoice_count": len(invoices)}
+
+class ZipSink:
+    """Write-only file for zipfile that hands back what was written since the last take()"""
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+async def get_invoice_run_or_404(run_id: str, org_id: str) -> dict:
+    run = await db.invoice_runs.find_one({"id": run_id, "org_id": org_id}, {"_id": 0})
+    if not run:
+        raise HTTPException(status_code=404, detail="Invoice run not found")
+    return run
+
+@api_router.post("/invoices/runs")
+async def create_invoice_run(request: InvoiceRunRequest, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
+    """Start a month's invoice run (Admin only). Runs as a background job"""
+    if current_user['role'] != 'Admin':
+        raise HTTPException(status_code=403, detail="Only Admin can run invoicing")
+    
+    org_id = current_user['org_id']
+    month_bounds(request.month)
+    if request.supplier_gstin:
+        request.supplier_gstin = request.supplier_gstin.strip().upper()
+        if not re.fullmatch(IMPORT_PATTERNS['gst'][0], request.supplier_gstin):
+            raise HTTPException(status_code=400, detail="Invalid supplier GSTIN")
+    elif await db.clients.find_one(
+        {**invoice_client_query(org_id, request.month), "currency_preference": {"$in": [BASE_CURRENCY, None]}}, {"_id": 1}
+    ):
+        raise HTTPException(status_code=400, detail="supplier_gstin is required to raise GST invoices for INR clients")
+    
+    # Claim the month before any number is reserved; the unique (org_id, month)
+    # index turns a concurrent second run into a 409 here
+    run = InvoiceRun(
+        org_id=org_id, month=request.month, supplier_gstin=request.supplier_gstin, created_by=current_user['user_id']
+    ).model_dump()
+    try:
+        await db.invoice_runs.insert_one(dict(run))
+    except DuplicateKeyError:
+        # An abandoned run for the month gives way to this one if its numbers can go back
+        existing = await db.invoice_runs.find_one({"org_id": org_id, "month": request.month}, {"_id": 0})
+        taken = existing and existing['status'] == 'Running' and await take_over_invoice_run(existing)
+        if not taken or not await discard_invoice_run(taken):
+            raise HTTPException(status_code=409, detail=f"Invoices for {request.month} have already been raised")
+        try:
+            await db.invoice_runs.insert_one(dict(run))
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail=f"Invoices for {request.month} have already been raised")
+    
+    try:
+        job = await create_job(org_id, 'invoice_run', current_user['user_id'])
+        await db.invoice_runs.update_one({"id": run['id']}, {"$set": {"job_id": job['id']}})
+    except Exception:
+        # No job will ever settle this claim
+        await db.invoice_runs.delete_one({"id": run['id']})
+        raise
+    background_tasks.add_task(run_job, job['id'], generate_invoice_run, run, request)
+    return {"message": "Invoice run started", "job_id": job['id'], "run_id": run['id']}
+
+@api_router.get("/invoices/runs")
+async def get_invoice_runs(current_user: dict = Depends(get_current_user)):
+    runs = await db.invoice_runs.find({"org_id": current_user['org_id']}, {"_id": 0}).sort("month", -1).to_list(None)
+    return trusted_response(runs, InvoiceRun)
+
+@api_router.get("/invoices/runs/{run_id}")
+async def get_invoice_run(run_id: str, current_user: dict = Depends(get_current_user)):
+    """Run summary with its invoices, without the documents"""
+    run = await get_invoice_run_or_404(run_id, current_user['org_id'])
+    run['invoices'] = await db.invoices.find(
+        {"org_id": current_user['org_id'], "run_id": run_id},
+        {"_id": 0, "content": 0, "org_id": 0, "run_id": 0}
+    ).sort("invoice_number", 1).to_list(None)
+    return run
+
+@api_router.delete("/invoices/runs/{run_id}")
+async def delete_invoice_run(run_id: str, current_user: dict = Depends(get_current_user)):
+    """Discard a run and its invoices so the month can be run again (Admin only).
+
+    Only the latest run of a financial year can go, and its numbers are reused
+    by the next run, so the invoice series never has a gap.
+    """
+    if current_user['role'] != 'Admin':
+        raise HTTPException(status_code=403, detail="Only Admin can delete invoice runs")
+    
+    org_id = current_user['org_id']
+    run = await get_invoice_run_or_404(run_id, org_id)
+    if run['status'] == 'Running':
+        run = await take_over_invoice_run(run)
+        if not run:
+            raise HTTPException(status_code=409, detail="Invoice run is still in progress")
+    if not await discard_invoice_run(run):
+        raise HTTPException(
+            status_code=409,
+            detail="Only the latest invoice run of a financial year can be deleted, so invoice numbers stay consecutive"
+        )
+    return {"message": "Invoice run deleted successfully"}
+
+@api_router.get("/invoices/runs/{run_id}/zip")
+async def download_invoice_run(run_id: str, current_user: dict = Depends(get_current_user)):
+    """All invoices of a run as a ZIP, streamed one document at a time from a cursor"""
+    org_id = current_user['org_id']
+    run = await get_invoice_run_or_404(run_id, org_id)
+    if run['status'] != 'Completed':
+        raise HTTPException(status_code=409, detail=f"Invoice run is {run['status'].lower()}")
+    
+    async def body():
+        sink = ZipSink()
+        # docx files are already deflated, so store them as they are
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+            cursor = db.invoices.find(
+                {"org_id": org_id, "run_id": run_id}, {"_id": 0, "filename": 1, "content": 1}
+            ).sort("invoice_number", 1).batch_size(INVOICE_CHUNK_SIZE)
+            async for invoice in cursor:
+                archive.writestr(invoice['filename'], invoice['content'])
+                yield sink.take()
+        yield sink.take()
+    
+    return StreamingResponse(
+        body(),
+        media_type='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="invoices_{run["month"]}.zip"'}
+    )
+
+@api_router.get("/invoices/{invoice_id}")
+async def download_invoice(invoice_id: str, current_user: dict = Depends(get_current_user)):
+    invoice = await db.invoices.find_one(
+        {"id": invoice_id, "org_id": current_user['org_id']}, {"_id": 0, "filename": 1, "content": 1}
+    )
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    return Response(
+        content=invoice['content'],
+        media_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        headers={'Content-Disposition': f'attachment; filename="{invoice["filename"]}"'}
+    )
+
 # ============= APPROVAL ROUTES =============
 
 @api_router.get("/approvals", response_model=List[Approval])
@@ -1174,8 +2577,8 @@ async def get_approvals(current_user: dict = Depends(get_current_user)):
     # For now, we'll need to check the actual items, but for simplicity filter approvals by users in org
     org_users = await db.users.find({"org_id": current_user['org_id']}, {"id": 1}).to_list(1000)
     org_user_ids = [u['id'] for u in org_users]
-    approvals = await db.approvals.find({"requested_by": {"$in": org_user_ids}}, {"_id": 0}).to_list(1000)
-    return approvals
+    approvals = await db.approvals.find({"requested_by": {"$in": org_user_ids}}, model_projection(Approval)).to_list(1000)
+    return trusted_response(approvals, Approval)
 
 @api_router.post("/approvals/{item_type}/{item_id}/request")
 async def request_approval(item_type: str, item_id: str, request: ApprovalRequest, current_user: dict = Depends(get_current_user)):
@@ -1192,6 +2595,7 @@ async def request_approval(item_type: str, item_id: str, request: ApprovalReques
     
     doc = approval.model_dump()
     await db.approvals.insert_one(doc)
+    await publish_event(current_user['org_id'], 'approvals', approval.id, 'create', approval.status)
     return approval
 
 @api_router.post("/approvals/{approval_id}/action")
@@ -1211,6 +2615,7 @@ async def approval_action(approval_id: str, action: ApprovalAction, current_user
             "notes": action.notes
         }}
     )
+    await publish_event(current_user['org_id'], 'approvals', approval_id, 'update', status)
     
     return {"message": f"Approval {status.lower()} successfully"}
 
@@ -1224,8 +2629,76 @@ async def reset_approvals(current_user: dict = Depends(get_current_user)):
     org_users = await db.users.find({"org_id": current_user['org_id']}, {"id": 1}).to_list(1000)
     org_user_ids = [u['id'] for u in org_users]
     result = await db.approvals.delete_many({"requested_by": {"$in": org_user_ids}})
+    await publish_event(current_user['org_id'], 'approvals', None, 'reset')
     return {"message": f"Reset complete. Deleted {result.deleted_count} approval records"}
 
+# ============= FX HELPERS =============
+# Amounts are stored in the client's currency_preference. Reports convert them
+# to INR with the rate in force on the day: the latest rate dated on or before
+# it, or the earliest known rate for days before the table starts. Rates come
+# from FX_RATES_FILE plus any the org's admin uploaded, which win on the same
+# (currency, date). Tables are cached per worker for the day and rebuilt when
+# the org's fx_rates version moves, so an upload reaches every worker.
+
+BASE_CURRENCY = 'INR'
+FX_RATES_FILE = Path(os.environ.get('FX_RATES_FILE', str(ROOT_DIR / 'fx_rates.csv')))
+
+fx_tables = {}  # org_id -> ((day built, fx_rates version), {currency: (days, rates)})
+
+def load_fx_file() -> List[dict]:
+    if not FX_RATES_FILE.exists():
+        return []
+    return pd.read_csv(FX_RATES_FILE, dtype={"currency": str, "date": str}).to_dict('records')
+
+def build_fx_table(rows: List[dict]) -> dict:
+    if not rows:
+        return {}
+    df = pd.DataFrame(rows, columns=["date", "currency", "rate_inr"])
+    df['day'] = pd.to_datetime(df['date'], format='%Y-%m-%d').values.astype('datetime64[D]')
+    # Later rows (org uploads) replace earlier ones for the same day
+    df = df.drop_duplicates(["currency", "day"], keep='last').sort_values(["currency", "day"])
+    return {
+        currency: (group['day'].to_numpy(dtype='datetime64[D]'), group['rate_inr'].to_numpy(dtype=float))
+        for currency, group in df.groupby('currency')
+    }
+
+async def get_fx_table(org_id: str) -> dict:
+    stamp = (datetime.now(timezone.utc).date().isoformat(), await collection_version(org_id, 'fx_rates'))
+    cached = fx_tables.get(org_id)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    uploaded = await db.fx_rates.find(
+        {"org_id": org_id}, {"_id": 0, "date": 1, "currency": 1, "rate_inr": 1}
+    ).to_list(None)
+    table = build_fx_table(load_fx_file() + uploaded)
+    fx_tables[org_id] = (stamp, table)
+    return table
+
+def invalidate_fx(org_id: str):
+    fx_tables.pop(org_id, None)
+
+def fx_rates(table: dict, currency: str, days: np.ndarray) -> Optional[np.ndarray]:
+    """INR per unit of currency on each day, or None if the currency has no rates"""
+    if currency == BASE_CURRENCY:
+        return np.ones(len(days))
+    if currency not in table:
+        return None
+    known_days, rates = table[currency]
+    index = np.searchsorted(known_days, days, side='right') - 1
+    return rates[np.clip(index, 0, None)]
+
+def to_base_currency(amounts: np.ndarray, currencies: np.ndarray, day: np.datetime64, table: dict):
+    """Convert amounts to INR at one day's rates. Returns (amounts, currencies left unconverted)"""
+    converted = amounts.astype(float)
+    missing = []
+    for currency in np.unique(currencies):
+        rate = fx_rates(table, currency, np.array([day], dtype='datetime64[D]'))
+        if rate is None:
+            missing.append(str(currency))
+            continue
+        converted[currencies == currency] *= rate[0]
+    return converted, missing
+
 # ============= DASHBOARD ROUTES =============
 
 @api_router.get("/dashboard/summary")
@@ -1327,12 +2800,18 @@ async def get_dashboard_summary(current_user: dict = Depends(get_current_user)):
     
     # Revenue metrics (filter by org_id)
     clients = await db.clients.find({"client_status": "Active", "org_id": current_user['org_id']}).to_list(1000)
+    # USD retainers are converted at today's rate before summing
+    client_services = np.array([c.get('service') for c in clients], dtype=object)
+    client_amounts, _ = to_base_currency(
+        np.array([c.get('amount_inr', 0) for c in clients], dtype=float),
+        np.array([c.get('currency_preference') or BASE_CURRENCY for c in clients], dtype=object),
+        np.datetime64(today.date(), 'D'),
+        await get_fx_table(current_user['org_id'])
+    )
     revenue_by_dept = {}
     for dept in ['PPC', 'SEO', 'Content', 'Backlink', 'Business Development', 'Others']:
-        dept_clients = [c for c in clients if c.get('service') == dept]
-        count = len(dept_clients)
-        amount = sum(c.get('amount_inr', 0) for c in dept_clients)
-        revenue_by_dept[dept] = {"count": count, "amount": amount}
+        in_dept = client_services == dept
+        revenue_by_dept[dept] = {"count": int(in_dept.sum()), "amount": float(client_amounts[in_dept].sum())}
     
     # Employee metrics
     employee_by_dept = {}
@@ -1350,24 +2829,477 @@ async def get_dashboard_summary(current_user: dict = Depends(get_current_user)):
         cost = sum(c.get('monthly_retainer_inr', 0) for c in dept_contractors)
         contractor_by_dept[dept] = {"count": count, "cost": cost}
     
+    # Reorder alerts are precomputed by the stock forecast job
+    low_stock = await db.stock_alerts.find(
+        {"org_id": current_user['org_id']}, {"_id": 0, "org_id": 0}
+    ).sort("days_of_stock_left", 1).to_list(100)
+    
     return {
         "alerts": {
             "expiring_agreements": expiring_clients,
             "expired_agreements": expired_clients,
-            "upcoming_birthdays": upcoming_birthdays
+            "upcoming_birthdays": upcoming_birthdays,
+            "low_stock": low_stock
         },
         "revenue": revenue_by_dept,
         "employees": employee_by_dept,
         "contractors": contractor_by_dept
     }
 
-# ============= BULK EXPORT/IMPORT ROUTES =============
+# ============= REPORT ROUTES =============
+# Client contracts become monthly revenue schedules: a contract bills
+# amount_inr every month from its start month for tenure_months, and stops
+# early in the month it was churned. Months are integers (year * 12 + month - 1)
+# so whole schedules are built with NumPy difference arrays, not per-client loops.
 
-@api_router.get("/clients/export")
-async def export_clients(current_user: dict = Depends(get_current_user)):
-    """Export all clients to Excel"""
-    clients = await db.clients.find({"org_id": current_user['org_id']}, {"_id": 0}).to_list(1000)
-    
+REVENUE_CACHE_SIZE = int(os.environ.get('REVENUE_CACHE_SIZE', '128'))
+revenue_cache = OrderedDict()  # org_id -> (clients version, schedule), least recently used first
+
+def month_index(values: pd.Series) -> np.ndarray:
+    """Month numbers for date strings, -1 where a date is missing or unparseable"""
+    dates = pd.to_datetime(values.astype(str).str[:10], format='%Y-%m-%d', errors='coerce')
+    return np.where(dates.isna(), -1, dates.dt.year * 12 + dates.dt.month - 1).astype(np.int64)
+
+def month_label(index: int) -> str:
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def parse_month(value: Optional[str], name: str) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        parsed = datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be YYYY-MM")
+    return parsed.year * 12 + parsed.month - 1
+
+def revenue_schedule(clients: List[dict]) -> dict:
+    """Per-service monthly MRR, new, churned and expiring revenue for a set of clients"""
+    columns = ["service", "currency_preference", "start_date", "tenure_months", "amount_inr",
+               "client_status", "churned_at", "updated_at"]
+    df = pd.DataFrame(clients, columns=columns)
+    
+    start = month_index(df['start_date'])
+    tenure = pd.to_numeric(df['tenure_months'], errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+    amount = pd.to_numeric(df['amount_inr'], errors='coerce').fillna(0).to_numpy(dtype=float)
+    valid = (start >= 0) & (tenure > 0)
+    if not valid.any():
+        return {"first": None, "services": [], "currencies": [], "mrr": None, "new": None, "churned": None, "expiring": None}
+    
+    end = start + tenure  # first month no longer billed
+    # Churned before churned_at existed: fall back to the last edit
+    churn = month_index(df['churned_at'].fillna(df['updated_at']))
+    churn = np.where((df['client_status'] == 'Churned').to_numpy() & (churn >= 0), churn, np.iinfo(np.int64).max)
+    stop = np.clip(np.minimum(end, churn), start, None)
+    
+    services, service = np.unique(df['service'].fillna('Others').astype(str).to_numpy(), return_inverse=True)
+    currencies, currency = np.unique(df['currency_preference'].fillna(BASE_CURRENCY).astype(str).to_numpy(), return_inverse=True)
+    first = int(start[valid].min())
+    months = int(end[valid].max()) - first + 1
+    shape = (len(currencies), len(services), months)
+    
+    def grid(month: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        """Sum amount into a (currency, service, month) grid at the given months"""
+        cells = (currency[mask] * len(services) + service[mask]) * months + (month[mask] - first)
+        return np.bincount(cells, weights=amount[mask], minlength=np.prod(shape)).reshape(shape)
+    
+    new = grid(start, valid)
+    churned = valid & (churn >= start) & (churn < end)
+    return {
+        "first": first,
+        "services": services.tolist(),
+        "currencies": currencies.tolist(),
+        "mrr": np.cumsum(new - grid(stop, valid), axis=2),
+        "new": new,
+        "churned": grid(churn, churned),
+        "expiring": grid(end - 1, valid & ~churned),  # last billed month of contracts that run their term
+    }
+
+async def get_revenue_schedule(org_id: str) -> dict:
+    version = await collection_version(org_id, 'clients')
+    cached = revenue_cache.get(org_id)
+    if cached and cached[0] == version:
+        revenue_cache.move_to_end(org_id)
+        return cached[1]
+    
+    clients = await db.clients.find(
+        {"org_id": org_id},
+        {"_id": 0, "service": 1, "currency_preference": 1, "start_date": 1, "tenure_months": 1,
+         "amount_inr": 1, "client_status": 1, "churned_at": 1, "updated_at": 1}
+    ).to_list(None)
+    schedule = revenue_schedule(clients)
+    revenue_cache[org_id] = (version, schedule)
+    if len(revenue_cache) > REVENUE_CACHE_SIZE:
+        revenue_cache.popitem(last=False)
+    return schedule
+
+@api_router.get("/reports/revenue-timeseries")
+async def get_revenue_timeseries(
+    from_month: Optional[str] = Query(None, alias="from"),
+    to_month: Optional[str] = Query(None, alias="to"),
+    service: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Monthly MRR, new, churned and expiring revenue in INR, in total and per service"""
+    start, end = parse_month(from_month, "from"), parse_month(to_month, "to")
+    schedule = await get_revenue_schedule(current_user['org_id'])
+    
+    first = schedule['first']
+    if first is None:
+        return {"months": [], "total": {}, "by_service": {}, "fx_missing": []}
+    last = first + schedule['mrr'].shape[2] - 1
+    start = first if start is None else start
+    end = last if end is None else end
+    if end < start:
+        raise HTTPException(status_code=400, detail="to must not be before from")
+    
+    # Months outside the schedule have no revenue; pad rather than clip
+    months = np.arange(start, end + 1)
+    inside = (months >= first) & (months <= last)
+    columns = np.clip(months - first, 0, last - first)
+    
+    services = schedule['services']
+    rows = [services.index(service)] if service in services else [] if service else list(range(len(services)))
+    series = ("mrr", "new", "churned", "expiring")
+    
+    # Each month converts at the rate in force on its first day
+    fx = await get_fx_table(current_user['org_id'])
+    days = (np.arange(first, last + 1) - 1970 * 12).astype('datetime64[M]').astype('datetime64[D]')
+    rates = []
+    fx_missing = []
+    for currency in schedule['currencies']:
+        currency_rates = fx_rates(fx, currency, days)
+        if currency_rates is None:
+            fx_missing.append(currency)
+            currency_rates = np.ones(len(days))  # left unconverted, flagged in fx_missing
+        rates.append(currency_rates)
+    converted = {name: np.einsum('csm,cm->sm', schedule[name], np.array(rates)) for name in series}
+    
+    def window(values: np.ndarray) -> List[float]:
+        return np.round(np.where(inside, values[columns], 0.0), 2).tolist()
+    
+    return ORJSONResponse({
+        "months": [month_label(int(month)) for month in months],
+        "total": {name: window(converted[name][rows].sum(axis=0)) for name in series},
+        "by_service": {
+            services[row]: {name: window(converted[name][row]) for name in series}
+            for row in rows
+        },
+        "fx_missing": fx_missing
+    })
+
+# Department snapshots keep one document per org and month with active
+# headcount, monthly cost and monthly revenue (INR) per department. The job
+# rewrites the current month's document, so once a month has passed its
+# figures are frozen as they stood on its last snapshot day. Trend endpoints
+# read only these documents.
+
+DEPARTMENT_SNAPSHOT_INTERVAL_HOURS = float(os.environ.get('DEPARTMENT_SNAPSHOT_INTERVAL_HOURS', '24'))
+DEPARTMENT_METRICS = ("employees", "employee_cost", "contractors", "contractor_cost", "clients", "revenue")
+DEPARTMENT_TREND_MONTHS = 12
+DEPARTMENT_TREND_MAX_MONTHS = DEPARTMENT_TREND_MONTHS * 5
+
+async def take_department_snapshot(org_id: str, day=None) -> dict:
+    """Aggregate the org's active records by department into that month's snapshot"""
+    day = day or datetime.now(timezone.utc).date()
+    
+    def by_department(amount_field):
+        return [
+            {"$match": {"org_id": org_id, "status": "Active"}},
+            {"$group": {"_id": "$department", "count": {"$sum": 1}, "amount": {"$sum": f"${amount_field}"}}}
+        ]
+    employees, contractors, clients = await asyncio.gather(
+        db.employees.aggregate(by_department("monthly_gross_inr")).to_list(None),
+        db.contractors.aggregate(by_department("monthly_retainer_inr")).to_list(None),
+        db.clients.aggregate([
+            {"$match": {"org_id": org_id, "client_status": "Active"}},
+            {"$group": {
+                "_id": {"service": "$service", "currency": "$currency_preference"},
+                "count": {"$sum": 1},
+                "amount": {"$sum": "$amount_inr"}
+            }}
+        ]).to_list(None)
+    )
+    
+    departments = {}
+    def add(department, metrics):
+        entry = departments.setdefault(str(department or 'Others'), dict.fromkeys(DEPARTMENT_METRICS, 0))
+        for name, value in metrics.items():
+            entry[name] = round(entry[name] + value, 2)
+    
+    for group in employees:
+        add(group['_id'], {"employees": group['count'], "employee_cost": group['amount']})
+    for group in contractors:
+        add(group['_id'], {"contractors": group['count'], "contractor_cost": group['amount']})
+    revenue, fx_missing = to_base_currency(
+        np.array([group['amount'] or 0.0 for group in clients], dtype=float),
+        np.array([group['_id'].get('currency') or BASE_CURRENCY for group in clients], dtype=object),
+        np.datetime64(day, 'D'),
+        await get_fx_table(org_id)
+    )
+    for group, amount in zip(clients, revenue):
+        add(group['_id'].get('service'), {"clients": group['count'], "revenue": float(amount)})
+    
+    snapshot = DepartmentSnapshot(
+        org_id=org_id, month=day.strftime('%Y-%m'), as_of=day.isoformat(), departments=departments, fx_missing=fx_missing
+    ).model_dump()
+    await db.department_snapshots.update_one(
+        {"org_id": org_id, "month": snapshot['month']}, {"$set": snapshot}, upsert=True
+    )
+    return snapshot
+
+async def snapshot_all_departments():
+    """Refresh every org's snapshot for the current month"""
+    for org_id in await db.organizations.distinct("org_id"):
+        await take_department_snapshot(org_id)
+
+@api_router.post("/admin/department-snapshots")
+async def refresh_department_snapshot(current_user: dict = Depends(get_current_user)):
+    """Take this month's department snapshot now (Admin only)"""
+    if current_user['role'] != 'Admin':
+        raise HTTPException(status_code=403, detail="Only Admin can take snapshots")
+    snapshot = await take_department_snapshot(current_user['org_id'])
+    snapshot.pop('_id', None)
+    return snapshot
+
+@api_router.get("/reports/department-trends")
+async def get_department_trends(
+    from_month: Optional[str] = Query(None, alias="from"),
+    to_month: Optional[str] = Query(None, alias="to"),
+    department: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Monthly headcount, cost and revenue per department from the snapshots.
+
+    Defaults to the last DEPARTMENT_TREND_MONTHS months and spans at most
+    DEPARTMENT_TREND_MAX_MONTHS. Months without a snapshot are null rather than zero.
+    fx_missing lists, per month, currencies whose revenue was counted unconverted.
+    """
+    today = datetime.now(timezone.utc)
+    end = parse_month(to_month, "to")
+    end = today.year * 12 + today.month - 1 if end is None else end
+    start = parse_month(from_month, "from")
+    start = end - DEPARTMENT_TREND_MONTHS + 1 if start is None else start
+    if end < start:
+        raise HTTPException(status_code=400, detail="to must not be before from")
+    if end - start + 1 > DEPARTMENT_TREND_MAX_MONTHS:
+        raise HTTPException(status_code=400, detail=f"Range must not exceed {DEPARTMENT_TREND_MAX_MONTHS} months")
+    
+    months = [month_label(month) for month in range(start, end + 1)]
+    snapshots = await db.department_snapshots.find(
+        {"org_id": current_user['org_id'], "month": {"$gte": months[0], "$lte": months[-1]}},
+        {"_id": 0, "month": 1, "departments": 1, "fx_missing": 1}
+    ).to_list(None)
+    by_month = {snapshot['month']: snapshot['departments'] for snapshot in snapshots}
+    fx_missing = {snapshot['month']: snapshot.get('fx_missing', []) for snapshot in snapshots}
+    
+    names = sorted({name for departments in by_month.values() for name in departments})
+    if department:
+        names = [name for name in names if name == department]
+    
+    def series(pick) -> dict:
+        return {
+            metric: [pick(by_month[month], metric) if month in by_month else None for month in months]
+            for metric in DEPARTMENT_METRICS
+        }
+    
+    return ORJSONResponse({
+        "months": months,
+        "total": series(lambda departments, metric: round(sum(departments.get(name, {}).get(metric, 0) for name in names), 2)),
+        "by_department": {
+            name: series(lambda departments, metric, name=name: departments.get(name, {}).get(metric, 0))
+            for name in names
+        },
+        "fx_missing": [fx_missing.get(month, []) for month in months]
+    })
+
+# ============= BULK EXPORT/IMPORT ROUTES =============
+# ?mode=upsert imports match rows to existing records on a natural key, backed
+# by a unique (org_id, key) index. Only columns present in the spreadsheet (plus
+# what is derived from them) are overwritten; status fields, ids, created_at
+# and anything the sheet leaves out survive a re-upload. The same index makes
+# the default insert mode report a row whose key already exists as a row error
+# rather than storing a second copy.
+IMPORT_UPSERT = {
+    "clients": {"key": "gst", "search": "client", "fields": ClientCreate, "derived": ("end_date", "agreement_status")},
+    "contractors": {"key": "pan", "search": "contractor", "fields": ContractorCreate, "derived": ("end_date", "agreement_status")},
+    "employees": {"key": "emp_id", "search": "employee", "fields": EmployeeCreate, "derived": ()},
+    "assets": {"key": "serial_number", "search": "asset", "fields": AssetCreate, "derived": ("warranty_status",)},
+}
+
+IMPORT_EXTENSIONS = ('.xlsx', '.xls', '.csv')
+
+def read_import_file(filename: str, contents: bytes) -> pd.DataFrame:
+    """Parse an uploaded sheet. CPU bound, so imports call it via asyncio.to_thread"""
+    if filename.lower().endswith('.csv'):
+        # utf-8-sig drops the BOM Excel adds when saving as CSV. Cells stay text so
+        # account numbers, pincodes and ids keep leading zeros; the handlers
+        # convert numeric columns themselves.
+        return pd.read_csv(BytesIO(contents), encoding='utf-8-sig', dtype=str)
+    engine = EXCEL_ENGINE
+    if engine == 'openpyxl' and filename.lower().endswith('.xls'):
+        engine = None  # Legacy .xls needs xlrd; let pandas pick
+    return pd.read_excel(BytesIO(contents), engine=engine)
+
+# Column formats checked by ?dry_run=true, by column name
+IMPORT_PATTERNS = {
+    "pan": (r"[A-Z]{5}[0-9]{4}[A-Z]", "Invalid PAN"),
+    "ifsc": (r"[A-Z]{4}0[A-Z0-9]{6}", "Invalid IFSC"),
+    "gst": (r"[0-9]{2}[A-Z]{5}[0-9]{4}[A-Z][1-9A-Z]Z[0-9A-Z]", "Invalid GST number"),
+}
+EMAIL_PATTERN = r"[^@\s]+@[^@\s]+\.[^@\s]+"
+IMPORT_DATE_COLUMNS = ("start_date", "doj", "dob", "purchase_date")
+
+async def dry_run_import(entity: str, df: pd.DataFrame, org_id: str) -> dict:
+    """Validate a whole import sheet column by column without writing anything.
+
+    Returns an error matrix keyed by spreadsheet row number, then column; the
+    first problem found in a cell is the one reported.
+    """
+    config = IMPORT_UPSERT[entity]
+    model = config['fields']
+    required = [name for name, field in model.model_fields.items() if field.is_required()]
+    missing_columns = [name for name in required if name not in df.columns]
+    
+    checks = []  # (column, boolean mask over rows, message)
+    def check(column, mask, message):
+        checks.append((column, np.asarray(mask, dtype=bool), message))
+    
+    present = {}
+    text = {}
+    for name, field in model.model_fields.items():
+        if name not in df.columns:
+            continue
+        text[name] = df[name].astype(str).str.strip()
+        present[name] = df[name].notna().to_numpy() & (text[name] != '').to_numpy()
+        if name in required:
+            check(name, ~present[name], "Required")
+        
+        annotation = field.annotation
+        if type(None) in get_args(annotation):  # Optional[X]
+            annotation = next(arg for arg in get_args(annotation) if arg is not type(None))
+        if annotation is EmailStr:
+            check(name, present[name] & ~text[name].str.fullmatch(EMAIL_PATTERN).fillna(False).to_numpy(), "Invalid email")
+        elif annotation in (int, float):
+            numbers = pd.to_numeric(df[name], errors='coerce')
+            bad = numbers.isna().to_numpy()
+            if annotation is int:
+                bad = bad | (numbers % 1 != 0).to_numpy()
+            check(name, present[name] & bad, "Must be a whole number" if annotation is int else "Must be a number")
+        elif get_origin(annotation) is Literal:
+            check(name, present[name] & ~text[name].isin(get_args(annotation)).to_numpy(),
+                  f"Must be one of {', '.join(get_args(annotation))}")
+        if name in IMPORT_DATE_COLUMNS:
+            dates = pd.to_datetime(text[name].str[:10], format='%Y-%m-%d', errors='coerce')
+            check(name, present[name] & dates.isna().to_numpy(), "Invalid date, use YYYY-MM-DD")
+        if name in IMPORT_PATTERNS:
+            pattern, message = IMPORT_PATTERNS[name]
+            check(name, present[name] & ~text[name].str.upper().str.fullmatch(pattern).fillna(False).to_numpy(), message)
+    
+    # Lookups against the org: one query each
+    for column in ("service", "department"):
+        if column in text:
+            services = await db.services.distinct("name", {"org_id": org_id})
+            check(column, present[column] & ~text[column].isin(services).to_numpy(), "Unknown service")
+    if "approver_user_id" in text:
+        approvers = await db.users.distinct("id", {"org_id": org_id, "id": {"$in": text["approver_user_id"].unique().tolist()}})
+        check("approver_user_id", present["approver_user_id"] & ~text["approver_user_id"].isin(approvers).to_numpy(),
+              "Unknown approver")
+    
+    # Upsert imports match on this key, so it must be unique within the sheet
+    key = config['key']
+    if key in text:
+        keys = text[key].str.upper() if key in IMPORT_PATTERNS else text[key]
+        check(key, present[key] & keys.duplicated(keep=False).to_numpy(), f"Duplicate {key} in file")
+    
+    errors = {}
+    for column, mask, message in checks:
+        for index in np.flatnonzero(mask):
+            errors.setdefault(int(index) + 2, {}).setdefault(column, message)
+    return {
+        "dry_run": True,
+        "rows": len(df),
+        "valid_rows": 0 if missing_columns else len(df) - len(errors),
+        "missing_columns": missing_columns or None,
+        "errors": dict(sorted(errors.items())) or None
+    }
+
+async def upsert_import(entity: str, org_id: str, pending: list, errors: list, columns) -> dict:
+    """Insert new keys, update changed rows and skip identical ones, JOB_BATCH_SIZE rows per bulk_write.
+
+    columns are the sheet's column names; model fields outside them keep their stored values.
+    """
+    config = IMPORT_UPSERT[entity]
+    key = config['key']
+    owned = (*(name for name in config['fields'].model_fields if name in columns), *config['derived'])
+    
+    latest = {}  # key -> (row number, doc); a later row for the same key wins
+    for row_number, doc in pending:
+        value = doc.get(key)
+        if not value or value == 'nan':
+            errors.append(f"Row {row_number}: {key} is required to match existing records")
+            continue
+        if value in latest:
+            errors.append(f"Row {latest[value][0]}: {key} {value} repeats in row {row_number}, which was used")
+        latest[value] = (row_number, doc)
+    
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    rows = list(latest.values())
+    now = datetime.now(timezone.utc).isoformat()
+    for start in range(0, len(rows), JOB_BATCH_SIZE):
+        batch = rows[start:start + JOB_BATCH_SIZE]
+        existing = {
+            doc[key]: doc for doc in await db[entity].find(
+                {"org_id": org_id, key: {"$in": [doc[key] for _, doc in batch]}}, {"_id": 0}
+            ).to_list(None)
+        }
+        
+        operations = []
+        operation_rows = []
+        for row_number, doc in batch:
+            fields = {name: doc[name] for name in owned}
+            current = existing.get(doc[key])
+            if current is not None and all(current.get(name) == value for name, value in fields.items()):
+                counts['unchanged'] += 1
+                continue
+            operations.append(UpdateOne(
+                {"org_id": org_id, key: doc[key]},
+                {
+                    "$set": {
+                        **fields,
+                        "search_keys": build_search_keys(config['search'], {**(current or doc), **fields}),
+                        "updated_at": now
+                    },
+                    "$setOnInsert": {name: value for name, value in doc.items() if name not in fields and name != 'updated_at'}
+                },
+                upsert=True
+            ))
+            operation_rows.append(row_number)
+        if not operations:
+            continue
+        try:
+            result = await db[entity].bulk_write(operations, ordered=False)
+            counts['inserted'] += result.upserted_count
+            counts['updated'] += result.modified_count
+        except BulkWriteError as e:
+            # e.g. a concurrent upload inserted the same key between our read and write;
+            # the other rows of the batch were still written
+            counts['inserted'] += e.details.get('nUpserted', 0)
+            counts['updated'] += e.details.get('nModified', 0)
+            for write_error in e.details.get('writeErrors', []):
+                row_number = operation_rows[write_error['index']]
+                if write_error.get('code') == 11000:
+                    message = duplicate_key_message(write_error) + ", upload the sheet again to update it"
+                else:
+                    message = write_error.get('errmsg', 'Write failed')
+                errors.append(f"Row {row_number}: {message}")
+    return counts
+
+
+@api_router.get("/clients/export")
+async def export_clients(current_user: dict = Depends(get_current_user)):
+    """Export all clients to Excel"""
+    clients = await db.clients.find({"org_id": current_user['org_id']}, {"_id": 0, "search_keys": 0}).to_list(1000)
+    
     if not clients:
         raise HTTPException(status_code=404, detail="No clients to export")
     
@@ -1388,7 +3320,7 @@ async def export_clients(current_user: dict = Depends(get_current_user)):
 @api_router.get("/contractors/export")
 async def export_contractors(current_user: dict = Depends(get_current_user)):
     """Export all contractors to Excel"""
-    contractors = await db.contractors.find({"org_id": current_user['org_id']}, {"_id": 0}).to_list(1000)
+    contractors = await db.contractors.find({"org_id": current_user['org_id']}, {"_id": 0, "search_keys": 0}).to_list(1000)
     
     if not contractors:
         raise HTTPException(status_code=404, detail="No contractors to export")
@@ -1410,7 +3342,7 @@ async def export_contractors(current_user: dict = Depends(get_current_user)):
 @api_router.get("/employees/export")
 async def export_employees(current_user: dict = Depends(get_current_user)):
     """Export all employees to Excel"""
-    employees = await db.employees.find({"org_id": current_user['org_id']}, {"_id": 0}).to_list(1000)
+    employees = await db.employees.find({"org_id": current_user['org_id']}, {"_id": 0, "search_keys": 0}).to_list(1000)
     
     if not employees:
         raise HTTPException(status_code=404, detail="No employees to export")
@@ -1429,66 +3361,44 @@ async def export_employees(current_user: dict = Depends(get_current_user)):
         headers={'Content-Disposition': 'attachment; filename="employees_export.xlsx"'}
     )
 
-@api_router.get("/clients/sample")
-async def get_client_sample(current_user: dict = Depends(get_current_user)):
-    """Download sample Excel template for bulk upload"""
-    # Get a valid Director/Admin user ID for the sample
-    approver = await db.users.find_one(
-        {"org_id": current_user['org_id'], "role": {"$in": ["Admin", "Director"]}},
-        {"id": 1}
-    )
-    approver_id = approver['id'] if approver else current_user['id']
-    
-    sample_data = {
+# Sample workbooks are rendered once per (approver, services) and kept as bytes.
+# Which approver and services an org has is remembered per worker and dropped
+# when users or services change, so a warm download makes no queries at all.
+
+SAMPLE_CACHE_SIZE = int(os.environ.get('SAMPLE_CACHE_SIZE', '64'))
+SAMPLE_TTL_SECONDS = float(os.environ.get('SAMPLE_TTL_SECONDS', '300'))
+DEFAULT_SAMPLE_SERVICES = ('PPC', 'SEO', 'Content')
+
+sample_cache = OrderedDict()  # (entity, approver_id, services) -> xlsx bytes, least recently used first
+sample_inputs = {}  # org_id -> ((approver_id, services), resolved_at)
+
+def invalidate_samples(org_id: str):
+    sample_inputs.pop(org_id, None)
+
+def sample_services(services: tuple, rows: int) -> List[str]:
+    return [services[i % len(services)] for i in range(rows)]
+
+def client_sample_data(approver_id: str, services: tuple) -> dict:
+    return {
         'client_name': ['ABC Corp', 'XYZ Ltd'],
         'address': ['123 Main St, New York', '456 Park Ave, Boston'],
         'start_date': ['2025-01-01', '2025-02-01'],
         'tenure_months': [12, 6],
         'currency_preference': ['INR', 'INR'],
-        'service': ['PPC', 'SEO'],
+        'service': sample_services(services, 2),
         'amount_inr': [50000.0, 75000.0],
         'authorised_signatory': ['John Doe', 'Mike Johnson'],
         'signatory_designation': ['CEO', 'Director'],
-        'gst': ['GST123456', 'GST789012'],
+        'gst': ['27ABCDE1234F1Z5', '07XYZAB5678C1Z3'],
         'poc_name': ['Jane Smith', 'Sarah Lee'],
         'poc_email': ['jane.smith@abccorp.com', 'sarah.lee@xyzltd.com'],
         'poc_designation': ['Manager', 'Lead'],
         'poc_mobile': ['9876543210', '9876543211'],
-        'approver_user_id': [approver_id, approver_id]
+        'approver_user_id': [approver_id] * 2
     }
-    
-    df = pd.DataFrame(sample_data)
-    
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Clients')
-        
-        workbook = writer.book
-        worksheet = writer.sheets['Clients']
-        
-        for cell in worksheet[1]:
-            cell.font = Font(bold=True)
-            cell.fill = PatternFill(start_color="CCE5FF", end_color="CCE5FF", fill_type="solid")
-    
-    output.seek(0)
-    
-    return Response(
-        content=output.getvalue(),
-        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        headers={'Content-Disposition': 'attachment; filename="client_sample.xlsx"'}
-    )
 
-@api_router.get("/contractors/sample")
-async def get_contractor_sample(current_user: dict = Depends(get_current_user)):
-    """Download sample Excel template for bulk upload"""
-    # Get a valid Director/Admin user ID for the sample
-    approver = await db.users.find_one(
-        {"org_id": current_user['org_id'], "role": {"$in": ["Admin", "Director"]}},
-        {"id": 1}
-    )
-    approver_id = approver['id'] if approver else current_user['id']
-    
-    sample_data = {
+def contractor_sample_data(approver_id: str, services: tuple) -> dict:
+    return {
         'name': ['John Contractor', 'Mary Freelancer'],
         'doj': ['2025-01-01', '2025-01-15'],
         'start_date': ['2025-01-01', '2025-01-15'],
@@ -1506,44 +3416,14 @@ async def get_contractor_sample(current_user: dict = Depends(get_current_user)):
         'pincode': ['110001', '110002'],
         'city': ['Delhi', 'Mumbai'],
         'address_2': ['Near Market', 'Behind Mall'],
-        'department': ['PPC', 'SEO'],
+        'department': sample_services(services, 2),
         'monthly_retainer_inr': [35000.0, 40000.0],
         'designation': ['Consultant', 'Specialist'],
-        'approver_user_id': [approver_id, approver_id]
+        'approver_user_id': [approver_id] * 2
     }
-    
-    df = pd.DataFrame(sample_data)
-    
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Contractors')
-        
-        workbook = writer.book
-        worksheet = writer.sheets['Contractors']
-        
-        for cell in worksheet[1]:
-            cell.font = Font(bold=True)
-            cell.fill = PatternFill(start_color="CCE5FF", end_color="CCE5FF", fill_type="solid")
-    
-    output.seek(0)
-    
-    return Response(
-        content=output.getvalue(),
-        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        headers={'Content-Disposition': 'attachment; filename="contractor_sample.xlsx"'}
-    )
 
-@api_router.get("/employees/sample")
-async def get_employee_sample(current_user: dict = Depends(get_current_user)):
-    """Download sample Excel template for bulk upload"""
-    # Get a valid Director/Admin user ID for the sample
-    approver = await db.users.find_one(
-        {"org_id": current_user['org_id'], "role": {"$in": ["Admin", "Director"]}},
-        {"id": 1}
-    )
-    approver_id = approver['id'] if approver else current_user['id']
-    
-    sample_data = {
+def employee_sample_data(approver_id: str, services: tuple) -> dict:
+    return {
         'doj': ['2025-01-15', '2025-02-01'],
         'work_email': ['john.doe@company.com', 'jane.smith@company.com'],
         'emp_id': ['EMP001', 'EMP002'],
@@ -1565,36 +3445,12 @@ async def get_employee_sample(current_user: dict = Depends(get_current_user)):
         'pincode': ['110001', '110002'],
         'city': ['Delhi', 'Mumbai'],
         'monthly_gross_inr': [60000.0, 75000.0],
-        'department': ['PPC', 'SEO'],
-        'approver_user_id': [approver_id, approver_id]
+        'department': sample_services(services, 2),
+        'approver_user_id': [approver_id] * 2
     }
-    
-    df = pd.DataFrame(sample_data)
-    
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Employees')
-        
-        workbook = writer.book
-        worksheet = writer.sheets['Employees']
-        
-        for cell in worksheet[1]:
-            cell.font = Font(bold=True)
-            cell.fill = PatternFill(start_color="CCE5FF", end_color="CCE5FF", fill_type="solid")
-    
-    output.seek(0)
-    
-    return Response(
-        content=output.getvalue(),
-        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        headers={'Content-Disposition': 'attachment; filename="employee_sample.xlsx"'}
-    )
 
-@api_router.get("/assets/sample")
-async def get_asset_sample(current_user: dict = Depends(get_current_user)):
-    """Download sample Excel template for bulk upload"""
-    # Use pandas to create a proper DataFrame-based Excel file
-    sample_data = {
+def asset_sample_data(approver_id: str, services: tuple) -> dict:
+    return {
         'asset_type': ['Laptop', 'Monitor', 'Keyboard'],
         'model': ['Dell XPS 15', 'LG 27inch 4K', 'Logitech MX Keys'],
         'serial_number': ['SN123456', 'SN789012', 'SN345678'],
@@ -1604,46 +3460,102 @@ async def get_asset_sample(current_user: dict = Depends(get_current_user)):
         'warranty_period_months': [12, 24, 12],
         'alloted_to': ['John Doe', 'Jane Smith', 'Bob Wilson'],
         'email': ['john.doe@example.com', 'jane.smith@example.com', 'bob.wilson@example.com'],
-        'department': ['PPC', 'SEO', 'Content']
+        'department': sample_services(services, 3)
     }
-    
+
+# entity -> (sheet name, download name, data builder, whether rows name an approver)
+SAMPLE_TEMPLATES = {
+    "clients": ("Clients", "client_sample.xlsx", client_sample_data, True),
+    "contractors": ("Contractors", "contractor_sample.xlsx", contractor_sample_data, True),
+    "employees": ("Employees", "employee_sample.xlsx", employee_sample_data, True),
+    "assets": ("Assets", "asset_sample.xlsx", asset_sample_data, False),
+}
+
+def render_sample(sheet_name: str, sample_data: dict) -> bytes:
     df = pd.DataFrame(sample_data)
     
     output = BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Assets')
+        df.to_excel(writer, index=False, sheet_name=sheet_name)
         
         # Format the header row
-        workbook = writer.book
-        worksheet = writer.sheets['Assets']
-        
+        worksheet = writer.sheets[sheet_name]
         for cell in worksheet[1]:
             cell.font = Font(bold=True)
             cell.fill = PatternFill(start_color="CCE5FF", end_color="CCE5FF", fill_type="solid")
     
-    output.seek(0)
+    return output.getvalue()
+
+async def sample_response(entity: str, current_user: dict) -> Response:
+    org_id = current_user['org_id']
+    cached = sample_inputs.get(org_id)
+    if cached and time.monotonic() - cached[1] < SAMPLE_TTL_SECONDS:
+        approver_id, services = cached[0]
+    else:
+        # Get a valid Director/Admin user ID for the sample
+        approver = await db.users.find_one(
+            {"org_id": org_id, "role": {"$in": ["Admin", "Director"]}},
+            {"id": 1}
+        )
+        approver_id = approver['id'] if approver else current_user['user_id']
+        services = tuple(sorted(await db.services.distinct("name", {"org_id": org_id}))) or DEFAULT_SAMPLE_SERVICES
+        sample_inputs[org_id] = ((approver_id, services), time.monotonic())
+    
+    sheet_name, filename, build, uses_approver = SAMPLE_TEMPLATES[entity]
+    key = (entity, approver_id if uses_approver else None, services)
+    content = sample_cache.get(key)
+    if content is None:
+        content = render_sample(sheet_name, build(approver_id, services))
+        sample_cache[key] = content
+        if len(sample_cache) > SAMPLE_CACHE_SIZE:
+            sample_cache.popitem(last=False)
+    else:
+        sample_cache.move_to_end(key)
     
     return Response(
-        content=output.getvalue(),
+        content=content,
         media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        headers={'Content-Disposition': 'attachment; filename="asset_sample.xlsx"'}
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
     )
 
+@api_router.get("/clients/sample")
+async def get_client_sample(current_user: dict = Depends(get_current_user)):
+    """Download sample Excel template for bulk upload"""
+    return await sample_response("clients", current_user)
+
+@api_router.get("/contractors/sample")
+async def get_contractor_sample(current_user: dict = Depends(get_current_user)):
+    """Download sample Excel template for bulk upload"""
+    return await sample_response("contractors", current_user)
+
+@api_router.get("/employees/sample")
+async def get_employee_sample(current_user: dict = Depends(get_current_user)):
+    """Download sample Excel template for bulk upload"""
+    return await sample_response("employees", current_user)
+
+@api_router.get("/assets/sample")
+async def get_asset_sample(current_user: dict = Depends(get_current_user)):
+    """Download sample Excel template for bulk upload"""
+    return await sample_response("assets", current_user)
+
 @api_router.post("/clients/import")
-async def import_clients(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
+async def import_clients(file: UploadFile = File(...), mode: Literal['insert', 'upsert'] = 'insert', dry_run: bool = False, current_user: dict = Depends(get_current_user)):
     """Bulk import clients from Excel"""
     if current_user['role'] not in ['Admin', 'Director']:
         raise HTTPException(status_code=403, detail="Only Admin and Director can bulk upload")
     
-    if not file.filename.endswith(('.xlsx', '.xls')):
-        raise HTTPException(status_code=400, detail="Only Excel files (.xlsx, .xls) are supported")
+    if not file.filename.lower().endswith(IMPORT_EXTENSIONS):
+        raise HTTPException(status_code=400, detail="Only Excel (.xlsx, .xls) or CSV files are supported")
     
     try:
         contents = await file.read()
-        df = pd.read_excel(BytesIO(contents))
+        df = await asyncio.to_thread(read_import_file, file.filename, contents)
+        if dry_run:
+            return await dry_run_import('clients', df, current_user['org_id'])
         
         imported_count = 0
         errors = []
+        pending = []  # (row number, doc) for upsert mode
         
         for index, row in df.iterrows():
             try:
@@ -1677,17 +3589,31 @@ async def import_clients(file: UploadFile = File(...), current_user: dict = Depe
                 client.end_date = calculate_end_date(client.start_date, client.tenure_months)
                 client.agreement_status = check_agreement_status(client.end_date)
                 
-                await db.clients.insert_one(client.model_dump())
-                imported_count += 1
+                if mode == 'upsert':
+                    pending.append((index + 2, client.model_dump()))
+                else:
+                    await db.clients.insert_one(with_search_keys('client', client.model_dump()))
+                    imported_count += 1
                 
+            except DuplicateKeyError as e:
+                errors.append(f"Row {index + 2}: {duplicate_key_message(e.details)}, use mode=upsert to update it")
             except Exception as e:
                 error_msg = f"Row {index + 2}: {str(e)}"
                 errors.append(error_msg)
                 print(f"Client import error: {error_msg}")
         
+        counts = {}
+        if mode == 'upsert':
+            counts = await upsert_import('clients', current_user['org_id'], pending, errors, set(df.columns))
+            imported_count = counts['inserted'] + counts['updated']
+        
+        await bump_version(current_user['org_id'], 'clients')
+        await publish_event(current_user['org_id'], 'clients', None, 'import')
+        invalidate_typeahead(current_user['org_id'], 'clients')
         return {
             "message": f"Import completed. {imported_count} clients imported successfully.",
             "imported": imported_count,
+            **counts,
             "errors": errors if errors else None
         }
     
@@ -1695,20 +3621,23 @@ async def import_clients(file: UploadFile = File(...), current_user: dict = Depe
         raise HTTPException(status_code=400, detail=f"Failed to process file: {str(e)}")
 
 @api_router.post("/contractors/import")
-async def import_contractors(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
+async def import_contractors(file: UploadFile = File(...), mode: Literal['insert', 'upsert'] = 'insert', dry_run: bool = False, current_user: dict = Depends(get_current_user)):
     """Bulk import contractors from Excel"""
     if current_user['role'] not in ['Admin', 'Director']:
         raise HTTPException(status_code=403, detail="Only Admin and Director can bulk upload")
     
-    if not file.filename.endswith(('.xlsx', '.xls')):
-        raise HTTPException(status_code=400, detail="Only Excel files (.xlsx, .xls) are supported")
+    if not file.filename.lower().endswith(IMPORT_EXTENSIONS):
+        raise HTTPException(status_code=400, detail="Only Excel (.xlsx, .xls) or CSV files are supported")
     
     try:
         contents = await file.read()
-        df = pd.read_excel(BytesIO(contents))
+        df = await asyncio.to_thread(read_import_file, file.filename, contents)
+        if dry_run:
+            return await dry_run_import('contractors', df, current_user['org_id'])
         
         imported_count = 0
         errors = []
+        pending = []  # (row number, doc) for upsert mode
         
         for index, row in df.iterrows():
             try:
@@ -1746,17 +3675,30 @@ async def import_contractors(file: UploadFile = File(...), current_user: dict =
                 contractor.end_date = calculate_end_date(contractor.start_date, contractor.tenure_months)
                 contractor.agreement_status = check_agreement_status(contractor.end_date)
                 
-                await db.contractors.insert_one(contractor.model_dump())
-                imported_count += 1
+                if mode == 'upsert':
+                    pending.append((index + 2, contractor.model_dump()))
+                else:
+                    await db.contractors.insert_one(with_search_keys('contractor', contractor.model_dump()))
+                    imported_count += 1
                 
+            except DuplicateKeyError as e:
+                errors.append(f"Row {index + 2}: {duplicate_key_message(e.details)}, use mode=upsert to update it")
             except Exception as e:
                 error_msg = f"Row {index + 2}: {str(e)}"
                 errors.append(error_msg)
                 print(f"Contractor import error: {error_msg}")
         
+        counts = {}
+        if mode == 'upsert':
+            counts = await upsert_import('contractors', current_user['org_id'], pending, errors, set(df.columns))
+            imported_count = counts['inserted'] + counts['updated']
+        
+        await bump_version(current_user['org_id'], 'contractors')
+        await publish_event(current_user['org_id'], 'contractors', None, 'import')
         return {
             "message": f"Import completed. {imported_count} contractors imported successfully.",
             "imported": imported_count,
+            **counts,
             "errors": errors if errors else None
         }
     
@@ -1764,20 +3706,23 @@ async def import_contractors(file: UploadFile = File(...), current_user: dict =
         raise HTTPException(status_code=400, detail=f"Failed to process file: {str(e)}")
 
 @api_router.post("/employees/import")
-async def import_employees(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
+async def import_employees(file: UploadFile = File(...), mode: Literal['insert', 'upsert'] = 'insert', dry_run: bool = False, current_user: dict = Depends(get_current_user)):
     """Bulk import employees from Excel"""
     if current_user['role'] not in ['Admin', 'Director']:
         raise HTTPException(status_code=403, detail="Only Admin and Director can bulk upload")
     
-    if not file.filename.endswith(('.xlsx', '.xls')):
-        raise HTTPException(status_code=400, detail="Only Excel files (.xlsx, .xls) are supported")
+    if not file.filename.lower().endswith(IMPORT_EXTENSIONS):
+        raise HTTPException(status_code=400, detail="Only Excel (.xlsx, .xls) or CSV files are supported")
     
     try:
         contents = await file.read()
-        df = pd.read_excel(BytesIO(contents))
+        df = await asyncio.to_thread(read_import_file, file.filename, contents)
+        if dry_run:
+            return await dry_run_import('employees', df, current_user['org_id'])
         
         imported_count = 0
         errors = []
+        pending = []  # (row number, doc) for upsert mode
         
         for index, row in df.iterrows():
             try:
@@ -1814,17 +3759,30 @@ async def import_employees(file: UploadFile = File(...), current_user: dict = De
                 )
                 
                 employee = Employee(**employee_data.model_dump(), org_id=current_user['org_id'])
-                await db.employees.insert_one(employee.model_dump())
-                imported_count += 1
+                if mode == 'upsert':
+                    pending.append((index + 2, employee.model_dump()))
+                else:
+                    await db.employees.insert_one(with_search_keys('employee', employee.model_dump()))
+                    imported_count += 1
                 
+            except DuplicateKeyError as e:
+                errors.append(f"Row {index + 2}: {duplicate_key_message(e.details)}, use mode=upsert to update it")
             except Exception as e:
                 error_msg = f"Row {index + 2}: {str(e)}"
                 errors.append(error_msg)
                 print(f"Employee import error: {error_msg}")
         
+        counts = {}
+        if mode == 'upsert':
+            counts = await upsert_import('employees', current_user['org_id'], pending, errors, set(df.columns))
+            imported_count = counts['inserted'] + counts['updated']
+        
+        await bump_version(current_user['org_id'], 'employees')
+        await publish_event(current_user['org_id'], 'employees', None, 'import')
         return {
             "message": f"Import completed. {imported_count} employees imported successfully.",
             "imported": imported_count,
+            **counts,
             "errors": errors if errors else None
         }
     
@@ -1832,20 +3790,23 @@ async def import_employees(file: UploadFile = File(...), current_user: dict = De
         raise HTTPException(status_code=400, detail=f"Failed to process file: {str(e)}")
 
 @api_router.post("/assets/import")
-async def import_assets(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
+async def import_assets(file: UploadFile = File(...), mode: Literal['insert', 'upsert'] = 'insert', dry_run: bool = False, current_user: dict = Depends(get_current_user)):
     """Bulk import assets from Excel"""
     if current_user['role'] not in ['Admin', 'Director']:
         raise HTTPException(status_code=403, detail="Only Admin and Director can bulk upload")
     
-    if not file.filename.endswith(('.xlsx', '.xls')):
-        raise HTTPException(status_code=400, detail="Only Excel files (.xlsx, .xls) are supported")
+    if not file.filename.lower().endswith(IMPORT_EXTENSIONS):
+        raise HTTPException(status_code=400, detail="Only Excel (.xlsx, .xls) or CSV files are supported")
     
     try:
         contents = await file.read()
-        df = pd.read_excel(BytesIO(contents))
+        df = await asyncio.to_thread(read_import_file, file.filename, contents)
+        if dry_run:
+            return await dry_run_import('assets', df, current_user['org_id'])
         
         imported_count = 0
         errors = []
+        pending = []  # (row number, doc) for upsert mode
         
         for index, row in df.iterrows():
             try:
@@ -1884,17 +3845,31 @@ async def import_assets(file: UploadFile = File(...), current_user: dict = Depen
                 today = datetime.now().date()
                 asset.warranty_status = 'Active' if today <= warranty_end else 'Expired'
                 
-                await db.assets.insert_one(asset.model_dump())
-                imported_count += 1
+                if mode == 'upsert':
+                    pending.append((index + 2, asset.model_dump()))
+                else:
+                    await db.assets.insert_one(with_search_keys('asset', asset.model_dump()))
+                    imported_count += 1
                 
+            except DuplicateKeyError as e:
+                errors.append(f"Row {index + 2}: {duplicate_key_message(e.details)}, use mode=upsert to update it")
             except Exception as e:
                 error_msg = f"Row {index + 2}: {str(e)}"
                 errors.append(error_msg)
                 print(f"Import error: {error_msg}")  # Log to console for debugging
         
+        counts = {}
+        if mode == 'upsert':
+            counts = await upsert_import('assets', current_user['org_id'], pending, errors, set(df.columns))
+            imported_count = counts['inserted'] + counts['updated']
+        
+        await bump_version(current_user['org_id'], 'assets')
+        await publish_event(current_user['org_id'], 'assets', None, 'import')
+        invalidate_typeahead(current_user['org_id'], 'vendors')
         return {
             "message": f"Import completed. {imported_count} assets imported successfully.",
             "imported": imported_count,
+            **counts,
             "errors": errors if errors else None
         }
     
@@ -1906,24 +3881,32 @@ async def import_assets(file: UploadFile = File(...), current_user: dict = Depen
 @api_router.get("/assets", response_model=List[Asset])
 async def get_assets(
     current_user: dict = Depends(get_current_user),
-    department: str = None
+    department: str = None,
+    fields: str = None
 ):
     query = {"org_id": current_user['org_id']}  # Filter by org_id
     if department:
         query['department'] = department
     
-    assets = await db.assets.find(query, {"_id": 0}).to_list(1000)
+    selected = select_fields(Asset, fields)
+    with_warranty = selected is None or 'warranty_status' in selected
+    projection = model_projection(
+        Asset, fields=selected,
+        extra=('purchase_date', 'warranty_period_months') if with_warranty else ()
+    )
+    assets = await db.assets.find(query, projection).to_list(1000)
     
     # Update warranty status
-    for asset in assets:
-        purchase_date = datetime.fromisoformat(asset['purchase_date'])
-        warranty_end = purchase_date + timedelta(days=asset['warranty_period_months'] * 30)
-        if datetime.now() > warranty_end:
-            asset['warranty_status'] = 'Expired'
-        else:
-            asset['warranty_status'] = 'Active'
-    
-    return assets
+    if with_warranty:
+        for asset in assets:
+            purchase_date = datetime.fromisoformat(asset['purchase_date'])
+            warranty_end = purchase_date + timedelta(days=asset['warranty_period_months'] * 30)
+            if datetime.now() > warranty_end:
+                asset['warranty_status'] = 'Expired'
+            else:
+                asset['warranty_status'] = 'Active'
+    
+    return trusted_response(assets, Asset, selected)
 
 @api_router.post("/assets", response_model=Asset)
 async def create_asset(asset_data: AssetCreate, current_user: dict = Depends(get_current_user)):
@@ -1934,8 +3917,10 @@ async def create_asset(asset_data: AssetCreate, current_user: dict = Depends(get
     warranty_end = purchase_date + timedelta(days=asset.warranty_period_months * 30)
     asset.warranty_status = 'Active' if datetime.now() <= warranty_end else 'Expired'
     
-    doc = asset.model_dump()
+    doc = with_search_keys('asset', asset.model_dump())
     await db.assets.insert_one(doc)
+    invalidate_typeahead(current_user['org_id'], 'vendors')
+    await publish_event(current_user['org_id'], 'assets', asset.id, 'create', asset.warranty_status)
     return asset
 
 @api_router.patch("/assets/{asset_id}")
@@ -1945,7 +3930,12 @@ async def update_asset(asset_id: str, update_data: dict, current_user: dict = De
     if not asset:
         raise HTTPException(status_code=404, detail="Asset not found in your organization")
     
+    update_data['search_keys'] = build_search_keys('asset', {**asset, **update_data})
+    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
     await db.assets.update_one({"id": asset_id, "org_id": current_user['org_id']}, {"$set": update_data})
+    if 'vendor' in update_data:
+        invalidate_typeahead(current_user['org_id'], 'vendors')
+    await publish_event(current_user['org_id'], 'assets', asset_id, 'update', update_data.get('warranty_status'))
     return {"message": "Asset updated successfully"}
 
 @api_router.delete("/assets/{asset_id}")
@@ -1957,12 +3947,15 @@ async def delete_asset(asset_id: str, current_user: dict = Depends(get_current_u
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Asset not found in your organization")
     
+    await record_tombstone(current_user['org_id'], 'assets', asset_id)
+    await publish_event(current_user['org_id'], 'assets', asset_id, 'delete')
+    invalidate_typeahead(current_user['org_id'], 'vendors')
     return {"message": "Asset deleted successfully"}
 
 @api_router.get("/assets/export")
 async def export_assets(current_user: dict = Depends(get_current_user)):
     """Export all assets to Excel"""
-    assets = await db.assets.find({"org_id": current_user['org_id']}, {"_id": 0}).to_list(1000)
+    assets = await db.assets.find({"org_id": current_user['org_id']}, {"_id": 0, "search_keys": 0}).to_list(1000)
     
     if not assets:
         raise HTTPException(status_code=404, detail="No assets to export")
@@ -2000,10 +3993,15 @@ async def export_assets(current_user: dict = Depends(get_current_user)):
 
 # ============= SERVICE/DEPARTMENT ROUTES =============
 @api_router.get("/services")
-async def get_services(current_user: dict = Depends(get_current_user)):
+async def get_services(request: Request, current_user: dict = Depends(get_current_user)):
     """Get all services for the organization"""
+    etag = await list_etag(request, current_user['org_id'], 'services')
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
     services = await db.services.find({"org_id": current_user['org_id']}, {"_id": 0}).to_list(100)
-    return services
+    return with_etag(ORJSONResponse(services), etag)
 
 @api_router.post("/services")
 async def create_service(service: ServiceCreate, current_user: dict = Depends(get_current_user)):
@@ -2018,10 +4016,12 @@ async def create_service(service: ServiceCreate, current_user: dict = Depends(ge
     
     new_service = Service(**service.model_dump(), org_id=current_user['org_id'])
     await db.services.insert_one(new_service.model_dump())
+    await bump_version(current_user['org_id'], 'services')
+    invalidate_samples(current_user['org_id'])
     return {"message": "Service created successfully", "service": new_service}
 
 @api_router.patch("/services/{service_id}")
-async def update_service(service_id: str, service: ServiceCreate, current_user: dict = Depends(get_current_user)):
+async def update_service(service_id: str, service: ServiceCreate, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
     """Update a service/department"""
     if current_user['role'] != 'Admin':
         raise HTTPException(status_code=403, detail="Only Admin can update services")
@@ -2041,9 +4041,21 @@ async def update_service(service_id: str, service: ServiceCreate, current_user:
     
     await db.services.update_one(
         {"id": service_id, "org_id": current_user['org_id']},
-        {"$set": {"name": service.name}}
+        {"$set": {"name": service.name, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    await bump_version(current_user['org_id'], 'services')
+    invalidate_samples(current_user['org_id'])
+    
+    if existing_service['name'] == service.name:
+        return {"message": "Service updated successfully"}
+    
+    # Records store the service name, so carry the rename over to them
+    job = await create_job(current_user['org_id'], 'service_rename', current_user['user_id'])
+    background_tasks.add_task(
+        run_job, job['id'], cascade_service_rename,
+        current_user['org_id'], existing_service['name'], service.name
     )
-    return {"message": "Service updated successfully"}
+    return {"message": "Service updated successfully", "job_id": job['id']}
 
 @api_router.delete("/services/{service_id}")
 async def delete_service(service_id: str, current_user: dict = Depends(get_current_user)):
@@ -2055,20 +4067,24 @@ async def delete_service(service_id: str, current_user: dict = Depends(get_curre
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Service not found")
     
+    await record_tombstone(current_user['org_id'], 'services', service_id)
+    await bump_version(current_user['org_id'], 'services')
+    invalidate_samples(current_user['org_id'])
     return {"message": "Service deleted successfully"}
 
 # ============= CLIENT ONBOARDING ROUTES =============
 
 @api_router.get("/client-onboarding", response_model=List[ClientOnboarding])
 async def get_client_onboarding(current_user: dict = Depends(get_current_user)):
-    onboardings = await db.client_onboarding.find({"org_id": current_user['org_id']}, {"_id": 0}).to_list(1000)
-    return onboardings
+    onboardings = await db.client_onboarding.find({"org_id": current_user['org_id']}, model_projection(ClientOnboarding)).to_list(1000)
+    return trusted_response(onboardings, ClientOnboarding)
 
 @api_router.post("/client-onboarding", response_model=ClientOnboarding)
 async def create_client_onboarding(data: ClientOnboardingCreate, current_user: dict = Depends(get_current_user)):
     onboarding = ClientOnboarding(**data.model_dump(), org_id=current_user['org_id'])
     doc = onboarding.model_dump()
     await db.client_onboarding.insert_one(doc)
+    invalidate_typeahead(current_user['org_id'], 'clients')
     return onboarding
 
 @api_router.patch("/client-onboarding/{onboarding_id}")
@@ -2077,7 +4093,10 @@ async def update_client_onboarding(onboarding_id: str, update_data: dict, curren
     if not onboarding:
         raise HTTPException(status_code=404, detail="Onboarding not found in your organization")
     
+    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
     await db.client_onboarding.update_one({"id": onboarding_id, "org_id": current_user['org_id']}, {"$set": update_data})
+    if 'client_name' in update_data:
+        invalidate_typeahead(current_user['org_id'], 'clients')
     return {"message": "Onboarding updated successfully"}
 
 @api_router.delete("/client-onboarding/{onboarding_id}")
@@ -2085,25 +4104,739 @@ async def delete_client_onboarding(onboarding_id: str, current_user: dict = Depe
     result = await db.client_onboarding.delete_one({"id": onboarding_id, "org_id": current_user['org_id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Onboarding not found")
+    await record_tombstone(current_user['org_id'], 'client_onboarding', onboarding_id)
+    invalidate_typeahead(current_user['org_id'], 'clients')
     return {"message": "Onboarding deleted successfully"}
 
+# ============= STOCK SNAPSHOT HELPERS =============
+
+STOCK_SNAPSHOT_INTERVAL_HOURS = float(os.environ.get('STOCK_SNAPSHOT_INTERVAL_HOURS', '24'))
+
+def parse_as_of_date(date: str) -> str:
+    try:
+        return datetime.fromisoformat(date).date().isoformat()
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid date. Use YYYY-MM-DD")
+
+async def invalidate_stock_snapshots(org_id: str, product_name: str, date: str, session=None):
+    """Drop checkpoints a (possibly backdated) ledger entry has made stale"""
+    await db.stock_snapshots.delete_many(
+        {"org_id": org_id, "product_name": product_name, "date": {"$gte": date[:10]}},
+        session=session
+    )
+
+async def compute_stock_as_of(org_id: str, as_of: str, product_name: str = None) -> dict:
+    """Stock per product after all ledger entries dated <= as_of.
+
+    Starts from the nearest checkpoint at or before as_of and replays only the
+    ledger entries dated after it. Returns {product_name: (stock, checkpoint_date)}.
+    """
+    match = {"org_id": org_id, "date": {"$lte": as_of}}
+    if product_name:
+        match['product_name'] = product_name
+    
+    checkpoints = await db.stock_snapshots.aggregate([
+        {"$match": match},
+        {"$sort": {"product_name": 1, "date": -1}},
+        {"$group": {
+            "_id": "$product_name",
+            "date": {"$first": "$date"},
+            "stock_available": {"$first": "$stock_available"}
+        }}
+    ]).to_list(None)
+    
+    levels = {c['_id']: (c['stock_available'], c['date']) for c in checkpoints}
+    
+    # Each checkpointed product only replays entries after its own checkpoint
+    replay = [
+        {"product_name": name, "date": {"$gt": checkpoint_date, "$lte": as_of}}
+        for name, (_, checkpoint_date) in levels.items()
+    ]
+    uncheckpointed = {"date": {"$lte": as_of}}
+    if product_name:
+        if product_name not in levels:
+            uncheckpointed['product_name'] = product_name
+            replay.append(uncheckpointed)
+    else:
+        uncheckpointed['product_name'] = {"$nin": list(levels)}
+        replay.append(uncheckpointed)
+    
+    if replay:
+        deltas = await db.stock_transactions.aggregate([
+            {"$match": {"org_id": org_id, "$or": replay}},
+            {"$group": {
+                "_id": "$product_name",
+                "delta": {"$sum": {"$cond": [
+                    {"$eq": ["$type", "Stock In"]},
+                    "$quantity",
+                    {"$multiply": ["$quantity", -1]}
+                ]}}
+            }}
+        ]).to_list(None)
+        for d in deltas:
+            stock, checkpoint_date = levels.get(d['_id'], (0, None))
+            levels[d['_id']] = (stock + d['delta'], checkpoint_date)
+    
+    return levels
+
+async def take_stock_snapshots(org_id: str, as_of: str) -> int:
+    """Write a checkpoint for every product of the org as of the given date"""
+    levels = await compute_stock_as_of(org_id, as_of)
+    if not levels:
+        return 0
+    
+    now = datetime.now(timezone.utc).isoformat()
+    await db.stock_snapshots.bulk_write([
+        UpdateOne(
+            {"org_id": org_id, "product_name": name, "date": as_of},
+            {"$set": StockSnapshot(
+                org_id=org_id, product_name=name, date=as_of, stock_available=stock, created_at=now
+            ).model_dump()},
+            upsert=True
+        )
+        for name, (stock, _) in levels.items()
+    ], ordered=False)
+    return len(levels)
+
+async def snapshot_all_stock():
+    """Checkpoint every org's stock as of the last closed day"""
+    as_of = (datetime.now(timezone.utc) - timedelta(days=1)).date().isoformat()
+    for org_id in await db.stock_transactions.distinct("org_id"):
+        await take_stock_snapshots(org_id, as_of)
+
+# ============= STOCK FORECAST HELPERS =============
+
+STOCK_FORECAST_WINDOW_DAYS = int(os.environ.get('STOCK_FORECAST_WINDOW_DAYS', '30'))
+STOCK_FORECAST_RECENT_DAYS = int(os.environ.get('STOCK_FORECAST_RECENT_DAYS', '7'))
+STOCK_REORDER_LEAD_DAYS = float(os.environ.get('STOCK_REORDER_LEAD_DAYS', '14'))
+STOCK_FORECAST_INTERVAL_HOURS = float(os.environ.get('STOCK_FORECAST_INTERVAL_HOURS', '6'))
+
+def forecast_stock(products: List[str], stock: np.ndarray, outs: pd.DataFrame, today) -> pd.DataFrame:
+    """Daily consumption and days of stock left per product.
+
+    Stock Out quantities are binned into a products x days matrix; the rate is
+    the higher of the full-window and recent-window daily averages, so a
+    recent spike shortens the projection instead of being averaged away.
+    """
+    window = STOCK_FORECAST_WINDOW_DAYS
+    daily = np.zeros((len(products), window))
+    if len(outs):
+        index = {name: i for i, name in enumerate(products)}
+        rows = outs['product_name'].map(index)
+        days_ago = (pd.Timestamp(today) - pd.to_datetime(outs['date'].str[:10], errors='coerce')).dt.days
+        valid = rows.notna() & days_ago.between(0, window - 1)
+        np.add.at(
+            daily,
+            (rows[valid].to_numpy(dtype=int), window - 1 - days_ago[valid].to_numpy(dtype=int)),
+            outs.loc[valid, 'quantity'].to_numpy(dtype=float)
+        )
+    
+    recent = min(STOCK_FORECAST_RECENT_DAYS, window)
+    rate = np.maximum(daily.mean(axis=1), daily[:, window - recent:].mean(axis=1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_left = np.where(rate > 0, stock / rate, np.inf)
+    
+    return pd.DataFrame({
+        "product_name": products,
+        "stock_available": stock,
+        "daily_consumption": rate,
+        "days_of_stock_left": days_left
+    })
+
+async def refresh_stock_alerts(org_id: str) -> int:
+    """Recompute reorder alerts for one org from the recent Stock Out ledger"""
+    today = datetime.now(timezone.utc).date()
+    since = (today - timedelta(days=STOCK_FORECAST_WINDOW_DAYS - 1)).isoformat()
+    
+    stocks = await db.stock_availability.find(
+        {"org_id": org_id}, {"_id": 0, "product_name": 1, "stock_available": 1}
+    ).to_list(None)
+    outs = await db.stock_transactions.find(
+        {"org_id": org_id, "type": "Stock Out", "date": {"$gte": since}},
+        {"_id": 0, "product_name": 1, "date": 1, "quantity": 1}
+    ).to_list(None)
+    
+    forecast = forecast_stock(
+        [s['product_name'] for s in stocks],
+        np.array([s['stock_available'] for s in stocks], dtype=float),
+        pd.DataFrame(outs, columns=['product_name', 'date', 'quantity']),
+        today
+    )
+    flagged = forecast[(forecast['stock_available'] <= 0) | (forecast['days_of_stock_left'] <= STOCK_REORDER_LEAD_DAYS)]
+    
+    alerts = []
+    for row in flagged.itertuples(index=False):
+        days_left = None if np.isinf(row.days_of_stock_left) else round(float(row.days_of_stock_left), 1)
+        alerts.append(StockAlert(
+            org_id=org_id,
+            product_name=row.product_name,
+            stock_available=int(row.stock_available),
+            daily_consumption=round(float(row.daily_consumption), 2),
+            days_of_stock_left=days_left,
+            # Reorder far enough ahead to cover the lead time
+            reorder_by=(today + timedelta(days=max(days_left - STOCK_REORDER_LEAD_DAYS, 0))).isoformat() if days_left is not None else today.isoformat(),
+            severity='Out of stock' if row.stock_available <= 0 else 'Low stock'
+        ).model_dump())
+    
+    async def replace(session):
+        await db.stock_alerts.delete_many({"org_id": org_id}, session=session)
+        if alerts:
+            await db.stock_alerts.insert_many(alerts, session=session)
+    
+    await run_in_transaction(replace)
+    return len(alerts)
+
+async def refresh_all_stock_alerts():
+    for org_id in await db.stock_availability.distinct("org_id"):
+        await refresh_stock_alerts(org_id)
+
+# ============= STOCK VALUATION HELPERS =============
+# Cost state per product lives in stock_cost_layers and is advanced on every
+# stock_in/stock_out, so valuation reads never replay the ledger. Stock In
+# `price` is the unit price. Each doc records how many ledger entries it covers
+# (txn_count); docs are rebuilt from the ledger when missing (new product,
+# backdated entry, lost concurrent update) or behind the ledger (an entry
+# committed while a rebuild was reading it).
+
+def empty_cost_month() -> dict:
+    return {"received_qty": 0, "received_value": 0.0, "issued_qty": 0, "fifo_cogs": 0.0, "average_cogs": 0.0}
+
+def advance_cost_layers(state: dict, txn: dict) -> dict:
+    """Apply one ledger entry (in date order) to a product's cost state"""
+    layers = [list(layer) for layer in state['fifo_layers']]
+    monthly = {month: dict(values) for month, values in state['monthly'].items()}
+    month = monthly.setdefault(txn['date'][:7], empty_cost_month())
+    quantity = state['quantity']
+    avg_cost = state['average_unit_cost']
+    qty = txn['quantity']
+    
+    if txn['type'] == 'Stock In':
+        unit_cost = float(txn.get('price') or 0)
+        layers.append([qty, unit_cost])
+        total = quantity + qty
+        avg_cost = (quantity * avg_cost + qty * unit_cost) / total if total > 0 else 0.0
+        quantity = total
+        month['received_qty'] += qty
+        month['received_value'] += qty * unit_cost
+    else:
+        remaining = qty
+        fifo_cogs = 0.0
+        while remaining > 0 and layers:
+            take = min(layers[0][0], remaining)
+            fifo_cogs += take * layers[0][1]
+            layers[0][0] -= take
+            remaining -= take
+            if layers[0][0] == 0:
+                layers.pop(0)
+        quantity -= qty
+        month['issued_qty'] += qty
+        month['fifo_cogs'] += fifo_cogs
+        month['average_cogs'] += qty * avg_cost
+    
+    return {
+        "fifo_layers": layers,
+        "quantity": quantity,
+        "average_unit_cost": avg_cost,
+        "monthly": monthly,
+        "last_date": max(state['last_date'], txn['date'][:10])
+    }
+
+def value_product_ledger(ledger: pd.DataFrame) -> dict:
+    """Cost state for one product from its full ledger, sorted by date.
+
+    FIFO is computed without walking layers: the cost of the first x units ever
+    received is a piecewise-linear curve over cumulative receipts, so each
+    issue costs curve(cum_out) - curve(cum_out - qty).
+    """
+    is_in = (ledger['type'] == 'Stock In').to_numpy()
+    qty = ledger['quantity'].to_numpy(dtype=np.int64)
+    price = pd.to_numeric(ledger['price'], errors='coerce').fillna(0.0).to_numpy(dtype=float)
+    months = ledger['date'].str[:7].to_numpy()
+    
+    q_in = np.where(is_in, qty, 0)
+    v_in = np.where(is_in, qty * price, 0.0)
+    q_out = np.where(is_in, 0, qty)
+    
+    # FIFO cost curve over cumulative received units
+    curve_q = np.concatenate(([0], np.cumsum(q_in[is_in])))
+    curve_v = np.concatenate(([0.0], np.cumsum(v_in[is_in])))
+    cum_out = np.cumsum(q_out)
+    fifo_cogs = np.interp(cum_out, curve_q, curve_v) - np.interp(cum_out - q_out, curve_q, curve_v)
+    
+    # Moving average only changes on receipts; issues use the latest one
+    stock_after = np.cumsum(q_in - q_out)
+    stock_before = stock_after - q_in + q_out
+    avg_at_in = np.zeros(len(qty))
+    avg_cost = 0.0
+    for i in np.flatnonzero(is_in):
+        total = stock_before[i] + qty[i]
+        avg_cost = (stock_before[i] * avg_cost + qty[i] * price[i]) / total if total > 0 else 0.0
+        avg_at_in[i] = avg_cost
+    last_in = np.maximum.accumulate(np.where(is_in, np.arange(len(qty)), -1))
+    avg_at_row = np.where(last_in >= 0, avg_at_in[np.maximum(last_in, 0)], 0.0)
+    average_cogs = q_out * avg_at_row
+    
+    # Layers still on hand are the receipts beyond the total issued
+    total_out = cum_out[-1] if len(cum_out) else 0
+    layer_end = curve_q[1:]
+    layer_qty = np.minimum(q_in[is_in], np.maximum(layer_end - total_out, 0))
+    layers = [[int(q), float(c)] for q, c in zip(layer_qty, price[is_in]) if q > 0]
+    
+    per_month = pd.DataFrame({
+        "month": months,
+        "received_qty": q_in,
+        "received_value": v_in,
+        "issued_qty": q_out,
+        "fifo_cogs": fifo_cogs,
+        "average_cogs": average_cogs
+    }).groupby("month").sum()
+    
+    return {
+        "fifo_layers": layers,
+        "quantity": int(stock_after[-1]) if len(stock_after) else 0,
+        "average_unit_cost": float(avg_at_row[-1]) if len(avg_at_row) else 0.0,
+        "monthly": {
+            month: {
+                "received_qty": int(row['received_qty']),
+                "received_value": float(row['received_value']),
+                "issued_qty": int(row['issued_qty']),
+                "fifo_cogs": float(row['fifo_cogs']),
+                "average_cogs": float(row['average_cogs'])
+            }
+            for month, row in per_month.iterrows()
+        },
+        "last_date": ledger['date'].iloc[-1][:10] if len(ledger) else ""
+    }
+
+async def rebuild_cost_layers(org_id: str, product_names: List[str] = None) -> dict:
+    """Replay the ledger into stock_cost_layers for the given products (or all)"""
+    query = {"org_id": org_id}
+    if product_names is not None:
+        query['product_name'] = {"$in": list(product_names)}
+    
+    rows = await db.stock_transactions.find(
+        query,
+        {"_id": 0, "product_name": 1, "type": 1, "date": 1, "created_at": 1, "quantity": 1, "price": 1}
+    ).to_list(None)
+    if not rows:
+        return {}
+    
+    ledger = pd.DataFrame(rows)
+    if 'price' not in ledger.columns:
+        ledger['price'] = None
+    ledger['date'] = ledger['date'].astype(str)
+    ledger = ledger.sort_values(['product_name', 'date', 'created_at'], kind='stable')
+    
+    states = {}
+    for name, product_ledger in ledger.groupby('product_name', sort=False):
+        states[name] = {
+            "org_id": org_id,
+            "product_name": name,
+            **value_product_ledger(product_ledger),
+            "txn_count": len(product_ledger),
+            "version": uuid.uuid4().hex
+        }
+    
+    await db.stock_cost_layers.bulk_write([
+        ReplaceOne({"org_id": org_id, "product_name": name}, state, upsert=True)
+        for name, state in states.items()
+    ], ordered=False)
+    return states
+
+async def update_cost_layers(org_id: str, product_name: str, txn: dict, session=None):
+    """Advance the cached cost state for one new ledger entry"""
+    key = {"org_id": org_id, "product_name": product_name}
+    state = await db.stock_cost_layers.find_one(key, {"_id": 0}, session=session)
+    if not state:
+        return  # Built from the ledger on the next valuation read
+    
+    if txn['date'][:10] < state['last_date']:
+        # Backdated entry changes the cost of everything after it
+        await db.stock_cost_layers.delete_one(key, session=session)
+        return
+    
+    result = await db.stock_cost_layers.update_one(
+        {**key, "version": state['version']},
+        {"$set": {
+            **advance_cost_layers(state, txn),
+            "txn_count": state.get('txn_count', 0) + 1,
+            "version": uuid.uuid4().hex
+        }},
+        session=session
+    )
+    if result.matched_count == 0:
+        # Another writer got there first; drop the doc rather than guess
+        await db.stock_cost_layers.delete_one(key, session=session)
+
+async def load_cost_layers(org_id: str) -> dict:
+    """Cached cost state for every product of the org, rebuilding only missing or stale ones"""
+    states = {
+        s['product_name']: s
+        for s in await db.stock_cost_layers.find({"org_id": org_id}, {"_id": 0}).to_list(None)
+    }
+    # Read after the states: a doc can only be behind this count, never ahead of it
+    counts = {
+        c['_id']: c['count']
+        async for c in db.stock_transactions.aggregate([
+            {"$match": {"org_id": org_id}},
+            {"$group": {"_id": "$product_name", "count": {"$sum": 1}}}
+        ])
+    }
+    products = await db.stock_availability.distinct("product_name", {"org_id": org_id})
+    stale = [
+        p for p in products
+        if p not in states or states[p].get('txn_count') != counts.get(p, 0)
+    ]
+    if stale:
+        states.update(await rebuild_cost_layers(org_id, stale))
+    return states
+
+# ============= SEARCH ROUTES =============
+
+@api_router.get("/search")
+async def search(q: str, types: str = None, limit: int = 20, current_user: dict = Depends(get_current_user)):
+    """Search clients, contractors, employees and assets by name, email, GST, emp_id, serial number or vendor"""
+    term = normalise_search(q)
+    if not term:
+        raise HTTPException(status_code=400, detail="Search query is required")
+    
+    item_types = [t.strip() for t in types.split(',')] if types else list(SEARCH_SOURCES)
+    unknown = [t for t in item_types if t not in SEARCH_SOURCES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown search types: {', '.join(unknown)}")
+    limit = max(1, min(limit, 100))
+    
+    results = await asyncio.gather(*(
+        search_source(t, current_user['org_id'], q, term, limit) for t in item_types
+    ))
+    hits = sorted((hit for hits in results for hit in hits), key=lambda h: (-h['score'], h['title']))
+    return {"query": q, "hits": hits[:limit]}
+
+@api_router.get("/typeahead/{kind}")
+async def typeahead(kind: str, q: str = "", limit: int = 10, current_user: dict = Depends(get_current_user)):
+    """Top completions for product, vendor or client names, served from memory"""
+    if kind not in TYPEAHEAD_SOURCES:
+        raise HTTPException(status_code=404, detail=f"Unknown typeahead: {kind}")
+    trie = await get_typeahead(current_user['org_id'], kind)
+    return trie.complete(q, max(1, min(limit, TYPEAHEAD_TOP_K)))
+
+# ============= SYNC ROUTES =============
+# Clients pass back the `next` token from their last sync and get only what
+# changed since. Tokens are the sync's start time; each sync re-reads an
+# overlap window before the token so writes landing mid-sync, or on a worker
+# with a slightly behind clock, are not missed. Clients apply records by id,
+# so seeing one twice is harmless.
+
+SYNC_OVERLAP_SECONDS = float(os.environ.get('SYNC_OVERLAP_SECONDS', '5'))
+SYNC_TOMBSTONE_DAYS = int(os.environ.get('SYNC_TOMBSTONE_DAYS', '30'))
+
+async def prune_tombstones():
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=SYNC_TOMBSTONE_DAYS)).isoformat()
+    await db.tombstones.delete_many({"deleted_at": {"$lt": cutoff}})
+
+async def backfill_updated_at():
+    """Give records written before sync existed an updated_at, taken from created_at"""
+    try:
+        for collection in SYNC_MODELS:
+            await db[collection].update_many(
+                {"updated_at": {"$exists": False}},
+                [{"$set": {"updated_at": {"$ifNull": ["$created_at", "1970-01-01T00:00:00+00:00"]}}}]
+            )
+    except Exception as e:
+        logger.error(f"updated_at backfill error: {str(e)}")
+
+@api_router.get("/sync")
+async def sync(since: str = None, collections: str = None, current_user: dict = Depends(get_current_user)):
+    """Records changed and deleted since a previous sync, per collection.
+
+    Without since, or when since is older than tombstones are kept, returns
+    every record with full=true and the client should replace its cache.
+    """
+    names = [c.strip() for c in collections.split(',') if c.strip()] if collections else list(SYNC_MODELS)
+    unknown = [c for c in names if c not in SYNC_MODELS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown collections: {', '.join(unknown)}")
+    
+    started = datetime.now(timezone.utc)
+    full = True
+    if since:
+        try:
+            since_at = datetime.fromisoformat(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid since token")
+        if since_at.tzinfo is None:
+            raise HTTPException(status_code=400, detail="Invalid since token")
+        full = since_at < started - timedelta(days=SYNC_TOMBSTONE_DAYS)
+        cutoff = (since_at - timedelta(seconds=SYNC_OVERLAP_SECONDS)).astimezone(timezone.utc).isoformat()
+    
+    org_id = current_user['org_id']
+    changes = {}
+    for name in names:
+        model = SYNC_MODELS[name]
+        query = {"org_id": org_id}
+        if not full:
+            query["updated_at"] = {"$gt": cutoff}
+        changed = await db[name].find(query, model_projection(model)).to_list(None)
+        deleted = [] if full else await db.tombstones.distinct(
+            "id", {"org_id": org_id, "collection": name, "deleted_at": {"$gt": cutoff}}
+        )
+        changes[name] = {"changed": fill_model_defaults(changed, model), "deleted": deleted}
+    
+    # Z rather than +00:00, so the token survives an unencoded query string
+    token = started.isoformat().replace('+00:00', 'Z')
+    return ORJSONResponse({"next": token, "full": full, "changes": changes})
+
+# ============= BULK ROUTES =============
+# PATCH/DELETE /bulk/{entity} apply one change set to many records with a
+# single bulk_write. Derived fields are recomputed per record exactly as the
+# single-record handlers do.
+
+BULK_ENTITIES = {
+    "clients": {"model": Client, "search": "client", "status": "client_status", "typeahead": ("clients", "client_name")},
+    "contractors": {"model": Contractor, "search": "contractor", "status": "status", "typeahead": None},
+    "employees": {"model": Employee, "search": "employee", "status": "status", "typeahead": None},
+    "assets": {"model": Asset, "search": "asset", "status": "warranty_status", "typeahead": ("vendors", "vendor")},
+}
+# Set by the server, never by a change set
+BULK_PROTECTED_FIELDS = {"id", "org_id", "created_at", "updated_at", "end_date", "agreement_status", "churned_at"}
+
+def bulk_query(entity: str, org_id: str, selection: BulkSelection) -> dict:
+    if sum([selection.ids is not None, selection.filter is not None, selection.all]) != 1:
+        raise HTTPException(status_code=400, detail="Provide exactly one of ids, filter or all")
+    # An empty filter would match the whole collection; that must be asked for explicitly
+    if selection.all:
+        return {"org_id": org_id}
+    if selection.ids is not None:
+        if not selection.ids:
+            raise HTTPException(status_code=400, detail="ids must not be empty")
+        return {"org_id": org_id, "id": {"$in": selection.ids}}
+    if not selection.filter:
+        raise HTTPException(status_code=400, detail="filter must not be empty; use all: true to select every record")
+    
+    model = BULK_ENTITIES[entity]['model']
+    for field, value in selection.filter.items():
+        if field not in model.model_fields or field == 'org_id':
+            raise HTTPException(status_code=400, detail=f"Cannot filter on: {field}")
+        if isinstance(value, (dict, list)):
+            raise HTTPException(status_code=400, detail=f"Filter values must be plain values: {field}")
+    return {**selection.filter, "org_id": org_id}
+
+def bulk_derived_fields(entity: str, doc: dict, changes: dict, end_dates: dict) -> dict:
+    """Fields the single-record update handler would recompute for this doc"""
+    derived = {}
+    if entity in ("clients", "contractors") and ('start_date' in changes or 'tenure_months' in changes):
+        start_date = changes.get('start_date', doc.get('start_date'))
+        tenure_months = changes.get('tenure_months', doc.get('tenure_months'))
+        if start_date and tenure_months:
+            # Mass edits mostly share a few (start, tenure) pairs; compute each once
+            key = (start_date, tenure_months)
+            if key not in end_dates:
+                end_date = calculate_end_date(start_date, tenure_months)
+                end_dates[key] = (end_date, check_agreement_status(end_date))
+            derived['end_date'], derived['agreement_status'] = end_dates[key]
+    if entity == "clients" and 'client_status' in changes and changes['client_status'] != doc.get('client_status'):
+        derived['churned_at'] = datetime.now(timezone.utc).isoformat() if changes['client_status'] == 'Churned' else None
+    derived['search_keys'] = build_search_keys(BULK_ENTITIES[entity]['search'], {**doc, **changes, **derived})
+    return derived
+
+@api_router.patch("/bulk/{entity}")
+async def bulk_update(entity: str, request: BulkUpdateRequest, current_user: dict = Depends(get_current_user)):
+    """Apply the same changes to every selected record"""
+    if entity not in BULK_ENTITIES:
+        raise HTTPException(status_code=404, detail=f"Unknown entity: {entity}")
+    config = BULK_ENTITIES[entity]
+    
+    changes = request.changes
+    invalid = [f for f in changes if f in BULK_PROTECTED_FIELDS or f not in config['model'].model_fields]
+    if not changes or invalid:
+        raise HTTPException(status_code=400, detail=f"Cannot update fields: {', '.join(invalid) or 'none given'}")
+    
+    org_id = current_user['org_id']
+    docs = await db[entity].find(bulk_query(entity, org_id, request)).to_list(None)
+    if not docs:
+        return {"matched": 0, "updated": 0}
+    
+    now = datetime.now(timezone.utc).isoformat()
+    end_dates = {}
+    result = await db[entity].bulk_write([
+        UpdateOne({"_id": doc['_id']}, {"$set": {
+            **changes, **bulk_derived_fields(entity, doc, changes, end_dates), "updated_at": now
+        }})
+        for doc in docs
+    ], ordered=False)
+    
+    await bump_version(org_id, entity)
+    if config['typeahead'] and config['typeahead'][1] in changes:
+        invalidate_typeahead(org_id, config['typeahead'][0])
+    await publish_event(org_id, entity, None, 'bulk_update', changes.get(config['status']))
+    return {"matched": len(docs), "updated": result.modified_count}
+
+@api_router.delete("/bulk/{entity}")
+async def bulk_delete(entity: str, request: BulkSelection, current_user: dict = Depends(get_current_user)):
+    """Delete every selected record - Admin and Director only"""
+    if entity not in BULK_ENTITIES:
+        raise HTTPException(status_code=404, detail=f"Unknown entity: {entity}")
+    if current_user['role'] not in ['Admin', 'Director']:
+        raise HTTPException(status_code=403, detail=f"Only Admin and Director can delete {entity}")
+    
+    org_id = current_user['org_id']
+    ids = await db[entity].distinct("id", bulk_query(entity, org_id, request))
+    if not ids:
+        return {"deleted": 0}
+    
+    result = await db[entity].delete_many({"org_id": org_id, "id": {"$in": ids}})
+    now = datetime.now(timezone.utc).isoformat()
+    await db.tombstones.insert_many([
+        {"org_id": org_id, "collection": entity, "id": record_id, "deleted_at": now}
+        for record_id in ids
+    ])
+    
+    await bump_version(org_id, entity)
+    if BULK_ENTITIES[entity]['typeahead']:
+        invalidate_typeahead(org_id, BULK_ENTITIES[entity]['typeahead'][0])
+    await publish_event(org_id, entity, None, 'bulk_delete')
+    return {"deleted": result.deleted_count}
+
+# ============= LIVE EVENTS =============
+# Write handlers append compact change events to `events`, a capped collection.
+# Each worker tails it once and fans events out to its own SSE connections, so
+# a write on any worker reaches every open stream of that org. Events are
+# hints to refetch, not a log: a connection that falls behind gets `resync`.
+
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', '200'))  # per worker
+SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', '100'))  # per connection
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))
+EVENTS_CAP_BYTES = int(os.environ.get('EVENTS_CAP_BYTES', str(16 * 1024 * 1024)))
+
+event_streams = {}  # org_id -> set of EventStream open on this worker
+
+class EventStream:
+    """One SSE connection: a bounded queue plus a flag set when events were dropped"""
+    __slots__ = ('queue', 'lagging')
+    
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.lagging = False
+    
+    def offer(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow reader; never block the tailer for one connection
+            self.lagging = True
+
+async def publish_event(org_id: str, entity: str, record_id: Optional[str], op: str, status: Optional[str] = None):
+    event = {"org_id": org_id, "entity": entity, "id": record_id, "op": op}
+    if status is not None:
+        event["status"] = status
+    try:
+        await db.events.insert_one(event)
+    except Exception as e:
+        # The write itself succeeded; a missed live update must not fail it
+        logger.error(f"Event publish error: {str(e)}")
+
+async def ensure_events_collection():
+    if "events" not in await db.list_collection_names():
+        try:
+            await db.create_collection("events", capped=True, size=EVENTS_CAP_BYTES)
+        except CollectionInvalid:
+            pass  # Another worker created it first
+
+def dispatch_event(doc: dict):
+    streams = event_streams.get(doc['org_id'])
+    if not streams:
+        return
+    event = {key: doc[key] for key in ("entity", "id", "op", "status") if key in doc}
+    for stream in streams:
+        stream.offer(event)
+
+async def tail_events():
+    """Follow the events collection for the life of the worker"""
+    ready = False
+    last_id = None
+    while True:
+        try:
+            if not ready:
+                await ensure_events_collection()
+                latest = await db.events.find_one({}, sort=[("$natural", -1)])
+                last_id = latest['_id'] if latest else None  # Only events from now on
+                ready = True
+            query = {"_id": {"$gt": last_id}} if last_id else {}
+            cursor = db.events.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+            while cursor.alive:
+                async for doc in cursor:
+                    last_id = doc['_id']
+                    dispatch_event(doc)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Event tail error: {str(e)}")
+            await asyncio.sleep(5)
+        # A tailable cursor on an empty collection dies at once; wait before reopening
+        await asyncio.sleep(1)
+
+async def event_stream_body(request: Request, org_id: str):
+    # Registered here rather than in the handler, so the finally always pairs with it
+    stream = EventStream()
+    event_streams.setdefault(org_id, set()).add(stream)
+    try:
+        yield "retry: 5000\n\n"
+        while not await request.is_disconnected():
+            if stream.lagging:
+                while not stream.queue.empty():
+                    stream.queue.get_nowait()
+                stream.lagging = False
+                yield "event: resync\ndata: {}\n\n"
+                continue
+            try:
+                event = await asyncio.wait_for(stream.queue.get(), SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: change\ndata: {orjson.dumps(event).decode()}\n\n"
+    finally:
+        streams = event_streams.get(org_id)
+        if streams is not None:
+            streams.discard(stream)
+            if not streams:
+                del event_streams[org_id]
+
+@api_router.get("/events")
+async def events(request: Request, current_user: dict = Depends(get_current_user)):
+    """Server-sent change events for the caller's org.
+
+    Each `change` event carries entity, id, op and, where it changed, status.
+    On `resync` the client should refetch what it shows. Authenticates with
+    the usual bearer header, so browsers need a fetch-based SSE client.
+    """
+    if sum(len(streams) for streams in event_streams.values()) >= SSE_MAX_STREAMS:
+        raise HTTPException(status_code=503, detail="Too many live connections, try again shortly")
+    
+    return StreamingResponse(
+        event_stream_body(request, current_user['org_id']),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ============= CONSUMABLES ROUTES =============
 
 @api_router.get("/stock-availability", response_model=List[StockAvailability])
 async def get_stock_availability(current_user: dict = Depends(get_current_user)):
-    stocks = await db.stock_availability.find({"org_id": current_user['org_id']}, {"_id": 0}).to_list(1000)
-    return stocks
+    stocks = await db.stock_availability.find({"org_id": current_user['org_id']}, model_projection(StockAvailability)).to_list(1000)
+    return trusted_response(stocks, StockAvailability)
 
 @api_router.get("/stock-transactions", response_model=List[StockTransaction])
 async def get_stock_transactions(current_user: dict = Depends(get_current_user)):
-    transactions = await db.stock_transactions.find({"org_id": current_user['org_id']}, {"_id": 0}).to_list(1000)
+    transactions = await db.stock_transactions.find({"org_id": current_user['org_id']}, model_projection(StockTransaction)).to_list(1000)
     # Sort by date descending
     transactions.sort(key=lambda x: x.get('date', ''), reverse=True)
-    return transactions
+    return trusted_response(transactions, StockTransaction)
 
 @api_router.post("/stock-in")
 async def stock_in(data: StockInCreate, current_user: dict = Depends(get_current_user)):
-    # Create transaction
+    if data.quantity <= 0:
+        raise HTTPException(status_code=400, detail="Quantity must be greater than zero")
+    
     transaction = StockTransaction(
         org_id=current_user['org_id'],
         type='Stock In',
@@ -2115,48 +4848,40 @@ async def stock_in(data: StockInCreate, current_user: dict = Depends(get_current
         quantity=data.quantity,
         price=data.price
     )
-    await db.stock_transactions.insert_one(transaction.model_dump())
-    
-    # Update stock availability
-    existing_stock = await db.stock_availability.find_one({
-        "product_name": data.product_name,
-        "org_id": current_user['org_id']
-    })
+    # Fields only written when this stock-in creates the product row
+    new_stock = StockAvailability(
+        org_id=current_user['org_id'],
+        product_name=data.product_name,
+        vendor_name=data.vendor_name,
+        stock_available=0
+    ).model_dump(exclude={'org_id', 'product_name', 'vendor_name', 'stock_available'})
     
-    if existing_stock:
-        # Update quantity
-        new_quantity = existing_stock['stock_available'] + data.quantity
+    async def apply(session):
+        # Increment (or create) the stock row and write the ledger entry together
         await db.stock_availability.update_one(
-            {"id": existing_stock['id']},
-            {"$set": {"stock_available": new_quantity, "vendor_name": data.vendor_name}}
-        )
-    else:
-        # Create new stock
-        stock = StockAvailability(
-            org_id=current_user['org_id'],
-            product_name=data.product_name,
-            vendor_name=data.vendor_name,
-            stock_available=data.quantity
+            {"org_id": current_user['org_id'], "product_name": data.product_name},
+            {
+                "$inc": {"stock_available": data.quantity},
+                "$set": {"vendor_name": data.vendor_name},
+                "$setOnInsert": new_stock
+            },
+            upsert=True,
+            session=session
         )
-        await db.stock_availability.insert_one(stock.model_dump())
+        await db.stock_transactions.insert_one(transaction.model_dump(), session=session)
+        await invalidate_stock_snapshots(current_user['org_id'], data.product_name, data.date, session)
+        await update_cost_layers(current_user['org_id'], data.product_name, transaction.model_dump(), session)
     
+    await run_in_transaction(apply)
+    invalidate_typeahead(current_user['org_id'], 'products', 'vendors')
+    await publish_event(current_user['org_id'], 'stock', data.product_name, 'stock_in')
     return {"message": "Stock In recorded successfully"}
 
 @api_router.post("/stock-out")
 async def stock_out(data: StockOutCreate, current_user: dict = Depends(get_current_user)):
-    # Check if stock exists and has enough quantity
-    existing_stock = await db.stock_availability.find_one({
-        "product_name": data.product_name,
-        "org_id": current_user['org_id']
-    })
-    
-    if not existing_stock:
-        raise HTTPException(status_code=404, detail="Product not found in stock")
-    
-    if existing_stock['stock_available'] < data.quantity:
-        raise HTTPException(status_code=400, detail=f"Insufficient stock. Available: {existing_stock['stock_available']}")
+    if data.quantity <= 0:
+        raise HTTPException(status_code=400, detail="Quantity must be greater than zero")
     
-    # Create transaction
     transaction = StockTransaction(
         org_id=current_user['org_id'],
         type='Stock Out',
@@ -2166,16 +4891,126 @@ async def stock_out(data: StockOutCreate, current_user: dict = Depends(get_curre
         date=data.date,
         quantity=data.quantity
     )
-    await db.stock_transactions.insert_one(transaction.model_dump())
     
-    # Update stock availability
-    new_quantity = existing_stock['stock_available'] - data.quantity
-    await db.stock_availability.update_one(
-        {"id": existing_stock['id']},
-        {"$set": {"stock_available": new_quantity}}
-    )
+    async def apply(session):
+        # Conditional decrement: only matches while enough stock is left, so
+        # concurrent issues can never drive stock_available negative
+        stock = await db.stock_availability.find_one_and_update(
+            {
+                "org_id": current_user['org_id'],
+                "product_name": data.product_name,
+                "stock_available": {"$gte": data.quantity}
+            },
+            {"$inc": {"stock_available": -data.quantity}},
+            projection={"_id": 0, "stock_available": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if not stock:
+            # Slow path only: work out which error to report
+            existing_stock = await db.stock_availability.find_one(
+                {"org_id": current_user['org_id'], "product_name": data.product_name},
+                {"_id": 0, "stock_available": 1},
+                session=session
+            )
+            if not existing_stock:
+                raise HTTPException(status_code=404, detail="Product not found in stock")
+            raise HTTPException(status_code=400, detail=f"Insufficient stock. Available: {existing_stock['stock_available']}")
+        
+        await db.stock_transactions.insert_one(transaction.model_dump(), session=session)
+        await invalidate_stock_snapshots(current_user['org_id'], data.product_name, data.date, session)
+        await update_cost_layers(current_user['org_id'], data.product_name, transaction.model_dump(), session)
+        return stock
+    
+    stock = await run_in_transaction(apply)
+    await publish_event(current_user['org_id'], 'stock', data.product_name, 'stock_out')
+    return {"message": "Stock Out recorded successfully", "stock_available": stock['stock_available']}
+
+@api_router.get("/stock-availability/as-of")
+async def get_stock_as_of(date: str, product_name: str = None, current_user: dict = Depends(get_current_user)):
+    """Stock levels as they stood at the end of the given date"""
+    as_of = parse_as_of_date(date)
+    levels = await compute_stock_as_of(current_user['org_id'], as_of, product_name)
+    
+    if product_name and product_name not in levels:
+        raise HTTPException(status_code=404, detail="No stock history for this product on or before this date")
+    
+    return [
+        {
+            "product_name": name,
+            "stock_available": stock,
+            "as_of": as_of,
+            "checkpoint_date": checkpoint_date
+        }
+        for name, (stock, checkpoint_date) in sorted(levels.items())
+    ]
+
+@api_router.post("/stock-snapshots")
+async def create_stock_snapshot(date: str = None, current_user: dict = Depends(get_current_user)):
+    """Write stock checkpoints for the organization on demand (Admin only)"""
+    if current_user['role'] != 'Admin':
+        raise HTTPException(status_code=403, detail="Only Admin can create stock snapshots")
+    
+    as_of = parse_as_of_date(date) if date else datetime.now(timezone.utc).date().isoformat()
+    count = await take_stock_snapshots(current_user['org_id'], as_of)
+    return {"message": f"Snapshot written for {count} products", "date": as_of, "products": count}
+
+@api_router.get("/stock-valuation")
+async def get_stock_valuation(current_user: dict = Depends(get_current_user)):
+    """Value of stock on hand per product under FIFO and weighted-average cost"""
+    states = await load_cost_layers(current_user['org_id'])
+    
+    products = []
+    for name, state in sorted(states.items()):
+        products.append({
+            "product_name": name,
+            "stock_available": state['quantity'],
+            "fifo_value": round(sum(q * c for q, c in state['fifo_layers']), 2),
+            "average_unit_cost": round(state['average_unit_cost'], 2),
+            "average_value": round(state['quantity'] * state['average_unit_cost'], 2)
+        })
     
-    return {"message": "Stock Out recorded successfully"}
+    return {
+        "products": products,
+        "total_fifo_value": round(sum(p['fifo_value'] for p in products), 2),
+        "total_average_value": round(sum(p['average_value'] for p in products), 2)
+    }
+
+@api_router.get("/stock-valuation/cogs")
+async def get_stock_cogs(month: str = None, product_name: str = None, current_user: dict = Depends(get_current_user)):
+    """Cost of goods issued per product per month (month as YYYY-MM)"""
+    states = await load_cost_layers(current_user['org_id'])
+    
+    rows = []
+    for name, state in sorted(states.items()):
+        if product_name and name != product_name:
+            continue
+        for m, values in sorted(state['monthly'].items()):
+            if month and m != month:
+                continue
+            rows.append({
+                "product_name": name,
+                "month": m,
+                "received_qty": values['received_qty'],
+                "received_value": round(values['received_value'], 2),
+                "issued_qty": values['issued_qty'],
+                "fifo_cogs": round(values['fifo_cogs'], 2),
+                "average_cogs": round(values['average_cogs'], 2)
+            })
+    return rows
+
+@api_router.get("/stock-alerts")
+async def get_stock_alerts(current_user: dict = Depends(get_current_user)):
+    """Reorder alerts from the last forecast run"""
+    return await db.stock_alerts.find(
+        {"org_id": current_user['org_id']}, {"_id": 0}
+    ).sort("days_of_stock_left", 1).to_list(1000)
+
+@api_router.post("/stock-alerts/refresh")
+async def refresh_stock_alerts_now(current_user: dict = Depends(get_current_user)):
+    """Re-run the consumption forecast for the organization"""
+    count = await refresh_stock_alerts(current_user['org_id'])
+    return {"message": f"Forecast refreshed. {count} products need reordering", "alerts": count}
 
 @api_router.patch("/stock-availability/{stock_id}")
 async def update_stock_notes(stock_id: str, update_data: dict, current_user: dict = Depends(get_current_user)):
@@ -2195,48 +5030,172 @@ async def get_stock_products(current_user: dict = Depends(get_current_user)):
     ).to_list(1000)
     return stocks
 
-app.include_router(api_router)
+# ============= BACKGROUND JOB HELPERS =============
+# Long-running work is started from a request with BackgroundTasks and tracked
+# in the jobs collection; clients poll GET /api/jobs/{job_id} for progress.
 
-# Mount static files for uploads
-uploads_dir = ROOT_DIR / "uploads"
-uploads_dir.mkdir(parents=True, exist_ok=True)
-app.mount("/uploads", StaticFiles(directory=uploads_dir), name="uploads")
+JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', '1000'))
+JOB_CONCURRENCY = int(os.environ.get('JOB_CONCURRENCY', '3'))
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Collections keyed by org_id, purged concurrently
+ORG_DATA_COLLECTIONS = [
+    "clients", "contractors", "employees", "assets", "client_onboarding", "services", "tombstones",
+    "stock_availability", "stock_transactions", "stock_snapshots", "stock_cost_layers", "stock_alerts",
+    "fx_rates", "payroll_runs", "payslips", "payout_batches", "contractor_payouts",
+    "invoice_runs", "invoices", "invoice_counters", "department_snapshots"
+]
+# Purged last so a failed purge can still be retried by logging in again
+ORG_ACCOUNT_COLLECTIONS = ["users", "otps", "organizations"]
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+async def create_job(org_id: str, job_type: str, user_id: str) -> dict:
+    job = Job(org_id=org_id, type=job_type, requested_by=user_id).model_dump()
+    await db.jobs.insert_one(job)
+    job.pop('_id', None)
+    return job
+
+async def update_job_progress(job_id: str, key: str, done: int, total: int = None):
+    update = {"$inc": {f"progress.{key}.done": done}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+    if total is not None:
+        update["$set"][f"progress.{key}.total"] = total
+    await db.jobs.update_one({"id": job_id}, update)
+
+async def run_job(job_id: str, work, *args):
+    """Run work(job_id, *args), recording status and result on the job"""
+    await db.jobs.update_one({"id": job_id}, {"$set": {
+        "status": "Running", "updated_at": datetime.now(timezone.utc).isoformat()
+    }})
+    try:
+        result = await work(job_id, *args)
+        status = {"status": "Completed", "result": result}
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {str(e)}")
+        status = {"status": "Failed", "error": str(e)}
+    await db.jobs.update_one({"id": job_id}, {"$set": {
+        **status, "updated_at": datetime.now(timezone.utc).isoformat()
+    }})
+
+async def delete_in_batches(job_id: str, collection: str, query: dict) -> int:
+    """Delete matching docs JOB_BATCH_SIZE at a time, reporting progress"""
+    total = await db[collection].count_documents(query)
+    await update_job_progress(job_id, collection, 0, total)
+    deleted = 0
+    while True:
+        batch = await db[collection].find(query, {"_id": 1}).limit(JOB_BATCH_SIZE).to_list(JOB_BATCH_SIZE)
+        if not batch:
+            return deleted
+        result = await db[collection].delete_many({"_id": {"$in": [d['_id'] for d in batch]}})
+        deleted += result.deleted_count
+        await update_job_progress(job_id, collection, result.deleted_count)
+
+async def update_in_batches(job_id: str, collection: str, query: dict, update: dict, touch: bool = False) -> int:
+    """Apply update to matching docs JOB_BATCH_SIZE at a time, reporting progress.
+
+    The update must make docs stop matching query, otherwise this never ends.
+    With touch, each batch also sets updated_at to the time it is written, so
+    /api/sync cursors never skip rows written late in a long job.
+    """
+    total = await db[collection].count_documents(query)
+    await update_job_progress(job_id, collection, 0, total)
+    updated = 0
+    while True:
+        batch = await db[collection].find(query, {"_id": 1}).limit(JOB_BATCH_SIZE).to_list(JOB_BATCH_SIZE)
+        if not batch:
+            return updated
+        batch_update = update
+        if touch:
+            batch_update = {**update, "$set": {**update.get("$set", {}), "updated_at": datetime.now(timezone.utc).isoformat()}}
+        # Keep query in the filter so positional ($) updates resolve
+        result = await db[collection].update_many({**query, "_id": {"$in": [d['_id'] for d in batch]}}, batch_update)
+        updated += result.modified_count
+        await update_job_progress(job_id, collection, result.modified_count)
+
+# Where service names are copied onto other records: (collection, field)
+SERVICE_REFERENCES = [
+    ("clients", "service"),
+    ("employees", "department"),
+    ("contractors", "department"),
+    ("assets", "department"),
+]
+
+async def cascade_service_rename(job_id: str, org_id: str, old_name: str, new_name: str) -> dict:
+    throttle = asyncio.Semaphore(JOB_CONCURRENCY)
+    
+    async def rename(collection: str, field: str):
+        async with throttle:
+            return collection, await update_in_batches(
+                job_id, collection,
+                {"org_id": org_id, field: old_name},
+                {"$set": {field: new_name}},
+                touch=True
+            )
+    
+    async def rename_onboarding():
+        # Onboarding keeps a list of service names; $ renames the matched entry
+        async with throttle:
+            return "client_onboarding", await update_in_batches(
+                job_id, "client_onboarding",
+                {"org_id": org_id, "services": old_name},
+                {"$set": {"services.$": new_name}},
+                touch=True
+            )
+    
+    counts = dict(await asyncio.gather(
+        *(rename(collection, field) for collection, field in SERVICE_REFERENCES),
+        rename_onboarding()
+    ))
+    await bump_version(org_id, *(c for c, _ in SERVICE_REFERENCES if c in VERSIONED_COLLECTIONS))
+    return {"old_name": old_name, "new_name": new_name, "updated": counts}
+
+async def purge_org_data(job_id: str, org_id: str) -> dict:
+    # Approvals carry no org_id; resolve the org's users before they are deleted
+    org_user_ids = await db.users.distinct("id", {"org_id": org_id})
+    
+    throttle = asyncio.Semaphore(JOB_CONCURRENCY)
+    
+    async def purge(collection: str, query: dict):
+        async with throttle:
+            return collection, await delete_in_batches(job_id, collection, query)
+    
+    counts = dict(await asyncio.gather(
+        *(purge(c, {"org_id": org_id}) for c in ORG_DATA_COLLECTIONS),
+        purge("approvals", {"requested_by": {"$in": org_user_ids}})
+    ))
+    for collection in ORG_ACCOUNT_COLLECTIONS:
+        counts[collection] = await delete_in_batches(job_id, collection, {"org_id": org_id})
+    
+    # Uploaded logos are saved as uploads/logos/<org_id>.<ext>
+    logos = list((ROOT_DIR / "uploads" / "logos").glob(f"{org_id}.*"))
+    for logo in logos:
+        logo.unlink(missing_ok=True)
+    counts['logos'] = len(logos)
+    
+    # Bump rather than delete the counters, so no pre-purge ETag can match again
+    await bump_version(org_id, *VERSIONED_COLLECTIONS, 'fx_rates')
+    invalidate_typeahead(org_id)
+    invalidate_samples(org_id)
+    invalidate_fx(org_id)
+    return {"deleted": counts}
 
 # ============= ADMIN UTILITIES =============
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Status and progress of a background job"""
+    job = await db.jobs.find_one({"id": job_id, "org_id": current_user['org_id']}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 @api_router.post("/admin/clear-org-data")
-async def clear_org_data(current_user: dict = Depends(get_current_user)):
-    """Clear all data for the organization (Admin only)"""
+async def clear_org_data(background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
+    """Clear all data for the organization (Admin only). Runs as a background job"""
     if current_user['role'] != 'Admin':
         raise HTTPException(status_code=403, detail="Only Admin can clear organization data")
     
     org_id = current_user['org_id']
+    job = await create_job(org_id, 'org_purge', current_user['user_id'])
+    background_tasks.add_task(run_job, job['id'], purge_org_data, org_id)
     
-    # Delete all data for this organization
-    await db.users.delete_many({"org_id": org_id})
-    await db.clients.delete_many({"org_id": org_id})
-    await db.contractors.delete_many({"org_id": org_id})
-    await db.employees.delete_many({"org_id": org_id})
-    await db.assets.delete_many({"org_id": org_id})
-    await db.client_onboarding.delete_many({"org_id": org_id})
-    await db.stock_availability.delete_many({"org_id": org_id})
-    await db.stock_transactions.delete_many({"org_id": org_id})
-    await db.services.delete_many({"org_id": org_id})
-    
-    return {"message": "All organization data cleared successfully"}
+    return {"message": "Organization data purge started", "job_id": job['id']}
 
 @api_router.post("/admin/initialize-services")
 async def initialize_services(current_user: dict = Depends(get_current_user)):
@@ -2260,13 +5219,325 @@ async def initialize_services(current_user: dict = Depends(get_current_user)):
         service = Service(name=service_name, org_id=org_id)
         await db.services.insert_one(service.model_dump())
     
+    await bump_version(org_id, 'services')
+    invalidate_samples(org_id)
     return {"message": f"Initialized {len(default_services)} default services"}
 
+@api_router.get("/admin/fx-rates")
+async def get_fx_rates(current_user: dict = Depends(get_current_user)):
+    """FX rates uploaded for the organization; FX_RATES_FILE rates apply underneath"""
+    return await db.fx_rates.find(
+        {"org_id": current_user['org_id']}, {"_id": 0, "org_id": 0}
+    ).sort([("currency", 1), ("date", 1)]).to_list(None)
+
+@api_router.post("/admin/fx-rates")
+async def upload_fx_rates(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
+    """Upload date, currency, rate_inr rows (Admin only); a row replaces any rate for the same currency and date"""
+    if current_user['role'] != 'Admin':
+        raise HTTPException(status_code=403, detail="Only Admin can upload FX rates")
+    if not file.filename.lower().endswith(IMPORT_EXTENSIONS):
+        raise HTTPException(status_code=400, detail="Only Excel (.xlsx, .xls) or CSV files are supported")
+    
+    df = await asyncio.to_thread(read_import_file, file.filename, await file.read())
+    missing = {"date", "currency", "rate_inr"} - set(df.columns)
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Missing columns: {', '.join(sorted(missing))}")
+    if df.empty:
+        raise HTTPException(status_code=400, detail="No rates in file")
+    
+    dates = pd.to_datetime(df['date'].astype(str).str[:10], format='%Y-%m-%d', errors='coerce')
+    rates = pd.to_numeric(df['rate_inr'], errors='coerce')
+    currencies = df['currency'].astype(str).str.strip().str.upper()
+    invalid = dates.isna() | ~(rates > 0) | ~currencies.str.fullmatch(r"[A-Z]{3}")
+    if invalid.any():
+        rows = ", ".join(str(i + 2) for i in np.flatnonzero(invalid.to_numpy())[:20])
+        raise HTTPException(status_code=400, detail=f"Invalid date, currency or rate in rows: {rows}")
+    
+    org_id = current_user['org_id']
+    await db.fx_rates.bulk_write([
+        UpdateOne(
+            {"org_id": org_id, "currency": currency, "date": date},
+            {"$set": {"rate_inr": float(rate)}},
+            upsert=True
+        )
+        for date, currency, rate in zip(dates.dt.strftime('%Y-%m-%d'), currencies, rates)
+    ], ordered=False)
+    await bump_version(org_id, 'fx_rates')
+    invalidate_fx(org_id)
+    return {"message": f"Uploaded {len(df)} FX rates"}
+
+# ============= RESPONSE COMPRESSION =============
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '4'))
+
+# Already compressed (xlsx/docx are zip containers) or must reach the client unbuffered
+UNCOMPRESSIBLE_TYPES = (
+    'application/vnd.openxmlformats-officedocument.',
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'image/png',
+    'image/jpeg',
+    'image/gif',
+    'image/webp',
+    'video/',
+    'audio/',
+    'text/event-stream',
+)
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        params = params.strip()
+        try:
+            q = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            q = 0.0
+        accepted[name.strip().lower()] = q
+    if brotli and accepted.get('br', 0) > 0:
+        return 'br'
+    if accepted.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+class StreamCompressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    
+    def compress(self, data: bytes) -> bytes:
+        """Compress a chunk and flush it, so streamed output is not held back"""
+        if self.encoding == 'br':
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def compress_all(self, data: bytes) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.process(data) + self._compressor.finish()
+        return self._compressor.compress(data) + self._compressor.flush()
+    
+    def finish(self) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+class CompressionMiddleware:
+    """gzip/brotli response compression.
+
+    Single-body responses under minimum_size and already-compressed content
+    types pass through untouched; StreamingResponse bodies are compressed
+    chunk by chunk.
+    """
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        
+        encoding = choose_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+        
+        start_message = None
+        compressor = None
+        passthrough = False
+        
+        async def send_compressed(message):
+            nonlocal start_message, compressor, passthrough
+            if message['type'] == 'http.response.start':
+                # Hold headers until the first body chunk shows the response size
+                start_message = message
+                return
+            if message['type'] != 'http.response.body' or passthrough:
+                await send(message)
+                return
+            
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            
+            if compressor is None:
+                start_message['headers'] = list(start_message.get('headers', []))
+                headers = MutableHeaders(raw=start_message['headers'])
+                declared_length = headers.get('content-length')
+                
+                if (
+                    'content-encoding' in headers
+                    or headers.get('content-type', '').startswith(UNCOMPRESSIBLE_TYPES)
+                    or (not more_body and len(body) < self.minimum_size)
+                    or (declared_length and int(declared_length) < self.minimum_size)
+                ):
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                
+                compressor = StreamCompressor(encoding)
+                headers['Content-Encoding'] = encoding
+                headers.add_vary_header('Accept-Encoding')
+                if more_body:
+                    if 'content-length' in headers:
+                        del headers['Content-Length']
+                    body = compressor.compress(body)
+                else:
+                    body = compressor.compress_all(body)
+                    headers['Content-Length'] = str(len(body))
+                await send(start_message)
+                await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+                return
+            
+            body = compressor.compress(body) if more_body else compressor.compress(body) + compressor.finish()
+            await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+        
+        await self.app(scope, receive, send_compressed)
+
+app.include_router(api_router)
+
+# Mount static files for uploads
+uploads_dir = ROOT_DIR / "uploads"
+uploads_dir.mkdir(parents=True, exist_ok=True)
+app.mount("/uploads", StaticFiles(directory=uploads_dir), name="uploads")
+
+app.add_middleware(CompressionMiddleware)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_credentials=True,
+    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# (collection, keys, options) for every index the request handlers rely on
+INDEXES = [
+    # One stock row per product; stock_in upserts on this key
+    ("stock_availability", [("org_id", 1), ("product_name", 1)], {"unique": True}),
+    ("stock_transactions", [("org_id", 1), ("product_name", 1), ("date", 1)], {}),
+    ("stock_snapshots", [("org_id", 1), ("product_name", 1), ("date", 1)], {"unique": True}),
+    ("stock_cost_layers", [("org_id", 1), ("product_name", 1)], {"unique": True}),
+    ("stock_transactions", [("org_id", 1), ("type", 1), ("date", 1)], {}),
+    ("stock_alerts", [("org_id", 1), ("days_of_stock_left", 1)], {}),
+    ("jobs", [("id", 1)], {"unique": True}),
+    ("collection_versions", [("org_id", 1), ("collection", 1)], {"unique": True}),
+    # Natural keys for upsert imports; blank keys (e.g. clients without GST) are left out
+    *(
+        (entity, [("org_id", 1), (config['key'], 1)], {
+            "unique": True,
+            "partialFilterExpression": {config['key']: {"$type": "string", "$gt": ""}}
+        })
+        for entity, config in IMPORT_UPSERT.items()
+    ),
+    ("tombstones", [("org_id", 1), ("collection", 1), ("deleted_at", 1)], {}),
+    ("tombstones", [("deleted_at", 1)], {}),
+    ("fx_rates", [("org_id", 1), ("currency", 1), ("date", 1)], {"unique": True}),
+    # One payroll run per org and month
+    ("payroll_runs", [("org_id", 1), ("month", 1)], {"unique": True}),
+    ("payslips", [("org_id", 1), ("run_id", 1), ("emp_id", 1)], {}),
+    ("payout_batches", [("org_id", 1), ("month", 1)], {"unique": True}),
+    ("contractor_payouts", [("org_id", 1), ("batch_id", 1), ("pan", 1)], {}),
+    ("invoice_runs", [("org_id", 1), ("month", 1)], {"unique": True}),
+    ("invoices", [("org_id", 1), ("run_id", 1), ("invoice_number", 1)], {}),
+    ("invoices", [("org_id", 1), ("invoice_number", 1)], {"unique": True}),
+    ("invoice_counters", [("org_id", 1), ("financial_year", 1)], {"unique": True}),
+    ("department_snapshots", [("org_id", 1), ("month", 1)], {"unique": True}),
+    ("clients", [("org_id", 1), ("search_keys", 1)], {}),
+    ("contractors", [("org_id", 1), ("search_keys", 1)], {}),
+    ("employees", [("org_id", 1), ("search_keys", 1)], {}),
+    ("assets", [("org_id", 1), ("search_keys", 1)], {}),
+]
+# Delta reads for /api/sync
+INDEXES += [(collection, [("org_id", 1), ("updated_at", 1)], {}) for collection in SYNC_MODELS]
+# Text indexes are prefixed by org_id, so every $text query stays within one org
+INDEXES += [
+    (
+        source['collection'],
+        [("org_id", 1), *((field, "text") for field in source['text'])],
+        {"weights": source['text'], "name": "search_text"}
+    )
+    for source in SEARCH_SOURCES.values()
+]
+
+async def log_duplicate_keys(collection: str, keys: list, options: dict):
+    """Name the key values that keep a unique index from building"""
+    fields = [name for name, _ in keys]
+    duplicates = await db[collection].aggregate([
+        {"$match": options.get('partialFilterExpression', {})},
+        {"$group": {"_id": {name: f"${name}" for name in fields}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": 20}
+    ]).to_list(None)
+    for duplicate in duplicates:
+        logger.warning(f"Duplicate {collection} rows for {duplicate['_id']} ({duplicate['count']} copies)")
+
+def fallback_index_name(keys: list) -> str:
+    return "_".join(f"{name}_{direction}" for name, direction in keys) + "_nonunique"
+
+async def create_index(collection: str, keys: list, options: dict):
+    try:
+        await db[collection].create_index(keys, **options)
+    except OperationFailure as e:
+        # 85/86: a non-unique fallback from an earlier start holds these keys; the
+        # duplicates have been merged since, so replace it with the unique index
+        if e.code not in (85, 86) or not options.get('unique'):
+            raise
+        await db[collection].drop_index(fallback_index_name(keys))
+        await db[collection].create_index(keys, **options)
+
+async def ensure_indexes():
+    for collection, keys, options in INDEXES:
+        try:
+            await create_index(collection, keys, options)
+        except (DuplicateKeyError, OperationFailure) as e:
+            if not options.get('unique') or getattr(e, 'code', None) != 11000:
+                logger.error(f"Index creation error on {collection}: {str(e)}")
+                continue
+            # Legacy duplicates: keep the lookups indexed without the constraint,
+            # and say which rows to merge so the unique index builds on a later start
+            logger.error(f"Unique index on {collection} {[name for name, _ in keys]} skipped: existing rows share a key")
+            await log_duplicate_keys(collection, keys, options)
+            fallback = {name: value for name, value in options.items() if name != 'unique'}
+            fallback['name'] = fallback_index_name(keys)
+            try:
+                await db[collection].create_index(keys, **fallback)
+            except Exception as fallback_error:
+                logger.error(f"Index creation error on {collection}: {str(fallback_error)}")
+        except Exception as e:
+            logger.error(f"Index creation error on {collection}: {str(e)}")
+
+background_loops = []
+
 @app.on_event("startup")
 async def startup():
+    await ensure_indexes()
+    background_loops.append(asyncio.create_task(run_periodically(snapshot_all_stock, STOCK_SNAPSHOT_INTERVAL_HOURS)))
+    background_loops.append(asyncio.create_task(run_periodically(refresh_all_stock_alerts, STOCK_FORECAST_INTERVAL_HOURS)))
+    background_loops.append(asyncio.create_task(backfill_search_keys()))
+    background_loops.append(asyncio.create_task(backfill_updated_at()))
+    background_loops.append(asyncio.create_task(tail_events()))
+    background_loops.append(asyncio.create_task(run_periodically(prune_tombstones, 24)))
+    background_loops.append(asyncio.create_task(run_periodically(snapshot_all_departments, DEPARTMENT_SNAPSHOT_INTERVAL_HOURS)))
     logger.info("Application started successfully")
     # No seed data - fresh start
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_loops:
+        task.cancel()
+    if invoice_pool:
+        invoice_pool.shutdown(wait=False, cancel_futures=True)
     client.close()
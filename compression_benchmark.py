@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Response Compression Benchmark
+Measures CPU time vs bytes saved for gzip and brotli at several levels on our
+typical payloads: employee list JSON and an xlsx export (already a zip container).
+Runs in-process; no server or database needed.
+"""
+
+import time
+from datetime import datetime
+from io import BytesIO
+
+import pandas as pd
+
+from serialization_benchmark import make_employees
+from server import Employee, StreamCompressor, trusted_response
+import server
+
+ROUNDS = 5
+LEVELS = [('gzip', 1), ('gzip', 6), ('gzip', 9), ('br', 1), ('br', 4), ('br', 11)]
+
+def log(message, level="INFO"):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{timestamp}] {level}: {message}")
+
+def compress(encoding, level, payload):
+    server.GZIP_LEVEL = level
+    server.BROTLI_QUALITY = level
+    return StreamCompressor(encoding).compress_all(payload)
+
+def bench(name, payload):
+    log(f"--- {name}: {len(payload)} bytes ---")
+    for encoding, level in LEVELS:
+        timings = []
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            compressed = compress(encoding, level, payload)
+            timings.append(time.perf_counter() - start)
+        saved = 100 * (1 - len(compressed) / len(payload))
+        log(f"{encoding:>4} level {level:>2}: {min(timings) * 1000:8.2f} ms  {len(compressed):>9} bytes  ({saved:5.1f}% saved)")
+
+def main():
+    if server.brotli is None:
+        global LEVELS
+        LEVELS = [(e, l) for e, l in LEVELS if e == 'gzip']
+        log("brotli not installed, gzip only", "WARN")
+
+    for count in (100, 1000):
+        docs = make_employees(count)
+        bench(f"GET /employees, {count} rows", trusted_response(docs, Employee).body)
+
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        pd.DataFrame(make_employees(1000)).to_excel(writer, index=False, sheet_name='Employees')
+    bench("employees_export.xlsx, 1000 rows", output.getvalue())
+
+if __name__ == "__main__":
+    main()
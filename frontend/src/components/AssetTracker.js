@@ -261,7 +261,7 @@ export default function AssetTracker() {
               type="file"
               ref={fileInputRef}
               onChange={handleImport}
-              accept=".xlsx,.xls"
+              accept=".xlsx,.xls,.csv"
               style={{ display: 'none' }}
               data-testid="file-input"
             />
@@ -291,7 +291,7 @@ export default function ClientDatabase({ user }) {
             <input
               ref={fileInputRef}
               type="file"
-              accept=".xlsx,.xls"
+              accept=".xlsx,.xls,.csv"
               onChange={handleImport}
               style={{ display: 'none' }}
               data-testid="file-input"
@@ -329,7 +329,7 @@ export default function ContractorDatabase({ user }) {
             <input
               ref={fileInputRef}
               type="file"
-              accept=".xlsx,.xls"
+              accept=".xlsx,.xls,.csv"
               onChange={handleImport}
               style={{ display: 'none' }}
             />
@@ -334,7 +334,7 @@ export default function EmployeeDatabase({ user }) {
             <input
               ref={fileInputRef}
               type="file"
-              accept=".xlsx,.xls"
+              accept=".xlsx,.xls,.csv"
               onChange={handleImport}
               style={{ display: 'none' }}
             />
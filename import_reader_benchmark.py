@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Import Reader Benchmark
+Times parsing employee import sheets of 1k/10k/100k rows with each reader the
+import endpoints can use: calamine, openpyxl (read-only) and CSV.
+Runs in-process; no server or database needed.
+"""
+
+import time
+from datetime import datetime
+from io import BytesIO
+
+import pandas as pd
+
+from serialization_benchmark import make_employees
+import server
+
+ROW_COUNTS = [1000, 10000, 100000]
+IMPORT_COLUMNS = [name for name, field in server.EmployeeCreate.model_fields.items() if field.is_required()]
+NUMERIC_COLUMNS = {name for name, field in server.EmployeeCreate.model_fields.items() if field.annotation in (int, float)}
+
+def log(message, level="INFO"):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{timestamp}] {level}: {message}")
+
+def make_sheet(count):
+    df = pd.DataFrame(make_employees(count))[IMPORT_COLUMNS]
+    xlsx = BytesIO()
+    df.to_excel(xlsx, index=False)
+    return xlsx.getvalue(), df.to_csv(index=False).encode('utf-8')
+
+def as_imported(df):
+    """Cells as the import handlers see them: numbers via float(), the rest via str()"""
+    return pd.DataFrame({
+        name: pd.to_numeric(df[name]).astype(float) if name in NUMERIC_COLUMNS else df[name].astype(str)
+        for name in df.columns
+    })
+
+def best_of(rounds, fn):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        df = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), df
+
+def main():
+    engines = ['calamine', 'openpyxl']
+    if server.EXCEL_ENGINE != 'calamine':
+        engines = ['openpyxl']
+        log("python-calamine not installed, openpyxl only", "WARN")
+
+    for count in ROW_COUNTS:
+        xlsx, csv = make_sheet(count)
+        rounds = 3 if count < 100000 else 1
+        log(f"--- {count} rows: xlsx {len(xlsx)} bytes, csv {len(csv)} bytes, best of {rounds} ---")
+
+        frames = {}
+        for engine in engines:
+            server.EXCEL_ENGINE = engine
+            seconds, frames[engine] = best_of(rounds, lambda: server.read_import_file('employees.xlsx', xlsx))
+            log(f"xlsx via {engine:<9} {seconds * 1000:9.1f} ms  {count / seconds:10,.0f} rows/sec")
+        seconds, frames['csv'] = best_of(rounds, lambda: server.read_import_file('employees.csv', csv))
+        log(f"csv              {seconds * 1000:9.1f} ms  {count / seconds:10,.0f} rows/sec")
+
+        baseline = as_imported(frames['openpyxl'])
+        for name, df in frames.items():
+            if not as_imported(df).equals(baseline):
+                log(f"{name} parsed differently from openpyxl", "ERROR")
+
+if __name__ == "__main__":
+    main()
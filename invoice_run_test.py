@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Invoice Run Test
+Raises invoices for an unused month with an intra-state, an inter-state and a
+USD client, and checks the CGST/SGST vs IGST split and the consecutive number
+series: deleting the latest run and running again reuses the same numbers,
+deleting an earlier run is refused with 409, and of two runs started at once
+for the same month exactly one goes through.
+"""
+
+import random
+import requests
+import string
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Configuration
+BASE_URL = "https://onefinance.preview.emergentagent.com/api"
+TEST_EMAIL = "vishnu@onedotfinance.com"
+TEST_PASSWORD = "12345678"
+ORG_ID = "org_cd4324ad"
+
+SUPPLIER_GSTIN = "29AAAAA1111A1Z5"  # Karnataka
+AMOUNT = 1000.0
+JOB_TIMEOUT_SECONDS = 120
+
+def random_gstin(state):
+    letters = "".join(random.choices(string.ascii_uppercase, k=5))
+    digits = "".join(random.choices(string.digits, k=4))
+    return f"{state}{letters}{digits}A1Z5"
+
+class InvoiceRunTester:
+    def __init__(self):
+        self.token = None
+        self.user_id = None
+        self.session = requests.Session()
+        # A far-off year nobody has invoiced: every month used here is in one financial year
+        self.year = random.randint(2200, 2900)
+        self.clients = []
+        self.runs = []
+
+    def log(self, message, level="INFO"):
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{timestamp}] {level}: {message}")
+
+    def authenticate(self):
+        """Authenticate with the API"""
+        self.log("=== AUTHENTICATION ===")
+
+        try:
+            login_data = {
+                "org_id": ORG_ID,
+                "email": TEST_EMAIL,
+                "password": TEST_PASSWORD
+            }
+            response = self.session.post(f"{BASE_URL}/auth/login", json=login_data)
+            if response.status_code != 200:
+                self.log(f"Login failed: {response.text}", "ERROR")
+                return False
+
+            otp_data = {
+                "email": TEST_EMAIL,
+                "otp": response.json().get('otp')
+            }
+            response = self.session.post(f"{BASE_URL}/auth/verify-otp", json=otp_data)
+            if response.status_code != 200:
+                self.log(f"OTP verification failed: {response.text}", "ERROR")
+                return False
+
+            self.token = response.json().get('token')
+            self.user_id = response.json()['user']['id']
+            self.session.headers.update({'Authorization': f'Bearer {self.token}'})
+            self.log("Authentication successful")
+            return True
+
+        except Exception as e:
+            self.log(f"Authentication error: {str(e)}", "ERROR")
+            return False
+
+    def create_client(self, name, gst, currency):
+        response = self.session.post(f"{BASE_URL}/clients", json={
+            "client_name": name,
+            "address": "1 Test Street",
+            "start_date": f"{self.year}-01-01",
+            "tenure_months": 12,
+            "currency_preference": currency,
+            "service": "PPC",
+            "amount_inr": AMOUNT,
+            "authorised_signatory": "Signatory",
+            "signatory_designation": "Director",
+            "gst": gst,
+            "poc_name": "POC",
+            "poc_email": "poc@test.com",
+            "poc_designation": "Manager",
+            "poc_mobile": "9876543210",
+            "approver_user_id": self.user_id
+        })
+        if response.status_code != 200:
+            self.log(f"Client creation failed: {response.text}", "ERROR")
+            return None
+        self.clients.append(response.json())
+        return response.json()
+
+    def start_run(self, month):
+        # Separate request per thread; requests.Session is not thread safe
+        return requests.post(
+            f"{BASE_URL}/invoices/runs",
+            json={"month": month, "supplier_gstin": SUPPLIER_GSTIN},
+            headers={'Authorization': f'Bearer {self.token}'}
+        )
+
+    def wait_for_run(self, started):
+        """Poll the run's job and return the run with its invoices, or None if it failed"""
+        self.runs.append(started['run_id'])
+        deadline = time.time() + JOB_TIMEOUT_SECONDS
+        while time.time() < deadline:
+            job = self.session.get(f"{BASE_URL}/jobs/{started['job_id']}").json()
+            if job['status'] == 'Failed':
+                self.log(f"Invoice run failed: {job.get('error')}", "ERROR")
+                return None
+            if job['status'] == 'Completed':
+                return self.session.get(f"{BASE_URL}/invoices/runs/{started['run_id']}").json()
+            time.sleep(1)
+        self.log("Invoice run did not finish in time", "ERROR")
+        return None
+
+    def run_month(self, month):
+        response = self.start_run(month)
+        if response.status_code != 200:
+            self.log(f"Invoice run for {month} not started: {response.text}", "ERROR")
+            return None
+        return self.wait_for_run(response.json())
+
+    def delete_run(self, run_id):
+        response = self.session.delete(f"{BASE_URL}/invoices/runs/{run_id}")
+        if response.status_code == 200:
+            self.runs.remove(run_id)
+        return response
+
+    def check_tax_split(self, run, expected):
+        ok = True
+        invoices = {invoice['client_id']: invoice for invoice in run['invoices']}
+        for client_id, (label, cgst, sgst, igst) in expected.items():
+            invoice = invoices.get(client_id)
+            if not invoice:
+                self.log(f"No invoice for client {client_id}", "ERROR")
+                ok = False
+                continue
+            got = (invoice['tax_label'], invoice['cgst'], invoice['sgst'], invoice['igst'])
+            if got != (label, cgst, sgst, igst):
+                self.log(f"Client {client_id}: expected {(label, cgst, sgst, igst)}, got {got}", "ERROR")
+                ok = False
+            if invoice['total'] != round(AMOUNT + cgst + sgst + igst, 2):
+                self.log(f"Client {client_id}: wrong total {invoice['total']}", "ERROR")
+                ok = False
+        return ok
+
+    def test_invoice_runs(self):
+        """Test GST split and consecutive invoice numbering"""
+        self.log("=== INVOICE RUNS ===")
+
+        try:
+            # Step 1: Intra-state, inter-state and export clients
+            self.log(f"Step 1: Creating clients active through {self.year}")
+            intra = self.create_client("Invoice Intra", random_gstin("29"), "INR")
+            inter = self.create_client("Invoice Inter", random_gstin("07"), "INR")
+            export = self.create_client("Invoice Export", "", "USD")
+            if not intra or not inter or not export:
+                return False
+
+            # Step 2: First run and its tax split
+            first_month = f"{self.year}-05"
+            self.log(f"Step 2: Invoicing {first_month}")
+            run = self.run_month(first_month)
+            if not run:
+                return False
+            numbers = (run['first_number'], run['last_number'])
+            self.log(f"Numbers {numbers[0]} to {numbers[1]}")
+            half = round(AMOUNT * 0.09, 2)
+            ok = self.check_tax_split(run, {
+                intra['id']: ("CGST 9% + SGST 9%", half, half, 0.0),
+                inter['id']: ("IGST 18%", 0.0, 0.0, round(AMOUNT * 0.18, 2)),
+                export['id']: ("IGST 0% (export of services)", 0.0, 0.0, 0.0)
+            })
+
+            # Step 3: Delete the latest run and run again: same numbers
+            self.log("Step 3: Deleting and re-running the month")
+            response = self.delete_run(run['id'])
+            if response.status_code != 200:
+                self.log(f"Deleting the latest run failed: {response.text}", "ERROR")
+                return False
+            run = self.run_month(first_month)
+            if not run:
+                return False
+            if (run['first_number'], run['last_number']) != numbers:
+                self.log(f"Re-run took {run['first_number']} to {run['last_number']}, expected {numbers}", "ERROR")
+                ok = False
+
+            # Step 4: Once a later month is invoiced, the earlier run cannot go
+            self.log("Step 4: Deleting a run that is no longer the latest")
+            if not self.run_month(f"{self.year}-06"):
+                return False
+            response = self.delete_run(run['id'])
+            if response.status_code != 409:
+                self.log(f"Expected 409 deleting an earlier run, got {response.status_code}", "ERROR")
+                ok = False
+
+            # Step 5: Two runs at once for the same month: exactly one goes through
+            concurrent_month = f"{self.year}-07"
+            self.log(f"Step 5: Two concurrent runs for {concurrent_month}")
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                responses = list(executor.map(self.start_run, [concurrent_month] * 2))
+            codes = sorted(r.status_code for r in responses)
+            if codes != [200, 409]:
+                self.log(f"Expected one 200 and one 409, got {codes}", "ERROR")
+                ok = False
+            for response in responses:
+                if response.status_code == 200 and not self.wait_for_run(response.json()):
+                    ok = False
+
+            if ok:
+                self.log("✅ GST split correct; invoice numbers stay consecutive")
+            return ok
+
+        except Exception as e:
+            self.log(f"Invoice run test error: {str(e)}", "ERROR")
+            return False
+
+        finally:
+            # Latest first, so each deletion hands its numbers back
+            for run_id in reversed(list(self.runs)):
+                self.delete_run(run_id)
+            for client in self.clients:
+                self.session.delete(f"{BASE_URL}/clients/{client['id']}")
+
+def main():
+    tester = InvoiceRunTester()
+
+    if not tester.authenticate():
+        sys.exit(1)
+
+    if not tester.test_invoice_runs():
+        sys.exit(1)
+
+    print("\nInvoice run test passed!")
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
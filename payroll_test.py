@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Payroll Run Test
+Runs payroll for an unused month with one employee paid for the full month and
+one who joined mid-month, and checks the salary split, the pro-rating of gross
+and employer PF, and that running the month again (one after the other or two
+requests at once) is refused with 409.
+"""
+
+import random
+import requests
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+
+import pandas as pd
+
+# Configuration
+BASE_URL = "https://onefinance.preview.emergentagent.com/api"
+TEST_EMAIL = "vishnu@onedotfinance.com"
+TEST_PASSWORD = "12345678"
+ORG_ID = "org_cd4324ad"
+
+MONTHLY_GROSS = 56000.0
+EMPLOYER_PF_MONTHLY = 1800.0
+SALARY_SPLIT = {"basic": 0.50, "hra": 0.30, "special": 0.20}
+
+class PayrollTester:
+    def __init__(self):
+        self.token = None
+        self.user_id = None
+        self.session = requests.Session()
+        self.prefix = f"PAY{uuid.uuid4().hex[:5].upper()}"
+        # A far-off February nobody has run payroll for: 28 days
+        self.year = random.randint(2200, 2900)
+        self.month = f"{self.year}-02"
+        self.employees = []
+        self.runs = []
+
+    def log(self, message, level="INFO"):
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{timestamp}] {level}: {message}")
+
+    def authenticate(self):
+        """Authenticate with the API"""
+        self.log("=== AUTHENTICATION ===")
+
+        try:
+            login_data = {
+                "org_id": ORG_ID,
+                "email": TEST_EMAIL,
+                "password": TEST_PASSWORD
+            }
+            response = self.session.post(f"{BASE_URL}/auth/login", json=login_data)
+            if response.status_code != 200:
+                self.log(f"Login failed: {response.text}", "ERROR")
+                return False
+
+            otp_data = {
+                "email": TEST_EMAIL,
+                "otp": response.json().get('otp')
+            }
+            response = self.session.post(f"{BASE_URL}/auth/verify-otp", json=otp_data)
+            if response.status_code != 200:
+                self.log(f"OTP verification failed: {response.text}", "ERROR")
+                return False
+
+            self.token = response.json().get('token')
+            self.user_id = response.json()['user']['id']
+            self.session.headers.update({'Authorization': f'Bearer {self.token}'})
+            self.log("Authentication successful")
+            return True
+
+        except Exception as e:
+            self.log(f"Authentication error: {str(e)}", "ERROR")
+            return False
+
+    def create_employee(self, suffix, doj):
+        emp_id = f"{self.prefix}{suffix}"
+        response = self.session.post(f"{BASE_URL}/employees", json={
+            "doj": doj,
+            "work_email": f"{emp_id.lower()}@company.com",
+            "emp_id": emp_id,
+            "first_name": "Payroll",
+            "last_name": suffix,
+            "father_name": "Father",
+            "dob": "1995-03-20",
+            "mobile": "9876543210",
+            "personal_email": f"{emp_id.lower()}@email.com",
+            "pan": "ABCDE1234F",
+            "aadhar": "123456789012",
+            "uan": "UAN123",
+            "pf_account_no": "PF123",
+            "bank_name": "HDFC Bank",
+            "account_no": "001234567890",
+            "ifsc": "HDFC0001234",
+            "branch": "Main Branch",
+            "address": "123 Street, Area",
+            "pincode": "110001",
+            "city": "Delhi",
+            "monthly_gross_inr": MONTHLY_GROSS,
+            "department": "PPC",
+            "approver_user_id": self.user_id
+        })
+        if response.status_code != 200:
+            self.log(f"Employee creation failed: {response.text}", "ERROR")
+            return None
+        self.employees.append(response.json())
+        return emp_id
+
+    def run_payroll(self, month):
+        # Separate request per thread; requests.Session is not thread safe
+        return requests.post(
+            f"{BASE_URL}/payroll/runs",
+            json={"month": month},
+            headers={'Authorization': f'Bearer {self.token}'}
+        )
+
+    def expected(self, paid_days, days_in_month):
+        gross = round(MONTHLY_GROSS * paid_days / days_in_month, 2)
+        basic = round(gross * SALARY_SPLIT['basic'], 2)
+        hra = round(gross * SALARY_SPLIT['hra'], 2)
+        employer_pf = round(EMPLOYER_PF_MONTHLY * paid_days / days_in_month, 2)
+        return {
+            "paid_days": paid_days,
+            "gross": gross,
+            "basic": basic,
+            "hra": hra,
+            "special": round(gross - basic - hra, 2),
+            "employer_pf": employer_pf,
+            "ctc": round(gross + employer_pf, 2)
+        }
+
+    def test_payroll_run(self):
+        """Test payslip amounts and the one-run-per-month rule"""
+        self.log("=== PAYROLL RUN ===")
+
+        try:
+            # Step 1: One employee joined before the month, one on the 15th
+            self.log(f"Step 1: Creating employees for {self.month}")
+            full = self.create_employee("F", f"{self.year - 1}-06-01")
+            joiner = self.create_employee("J", f"{self.year}-02-15")
+            if not full or not joiner:
+                return False
+
+            # Step 2: Run payroll and read the payslips back
+            self.log("Step 2: Running payroll")
+            response = self.run_payroll(self.month)
+            if response.status_code != 200:
+                self.log(f"Payroll run failed: {response.text}", "ERROR")
+                return False
+            run = response.json()
+            self.runs.append(run['id'])
+
+            response = self.session.get(f"{BASE_URL}/payroll/runs/{run['id']}/payslips")
+            payslips = pd.read_excel(BytesIO(response.content)).set_index('emp_id')
+
+            ok = True
+            for emp_id, expected in [(full, self.expected(28, 28)), (joiner, self.expected(14, 28))]:
+                if emp_id not in payslips.index:
+                    self.log(f"No payslip for {emp_id}", "ERROR")
+                    ok = False
+                    continue
+                payslip = payslips.loc[emp_id]
+                for field, value in expected.items():
+                    if abs(float(payslip[field]) - value) > 0.005:
+                        self.log(f"{emp_id} {field}: expected {value}, got {payslip[field]}", "ERROR")
+                        ok = False
+                if abs(payslip['basic'] + payslip['hra'] + payslip['special'] - payslip['gross']) > 0.005:
+                    self.log(f"{emp_id} components do not add up to gross", "ERROR")
+                    ok = False
+
+            # Step 3: The same month again is refused
+            self.log("Step 3: Running the same month again")
+            response = self.run_payroll(self.month)
+            if response.status_code != 409:
+                self.log(f"Expected 409 for a second run, got {response.status_code}", "ERROR")
+                ok = False
+
+            # Step 4: Two runs at once for a fresh month: exactly one goes through
+            concurrent_month = f"{self.year}-03"
+            self.log(f"Step 4: Two concurrent runs for {concurrent_month}")
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                responses = list(executor.map(self.run_payroll, [concurrent_month] * 2))
+            codes = sorted(r.status_code for r in responses)
+            self.runs.extend(r.json()['id'] for r in responses if r.status_code == 200)
+            if codes != [200, 409]:
+                self.log(f"Expected one 200 and one 409, got {codes}", "ERROR")
+                ok = False
+
+            if ok:
+                self.log("✅ Payslips split and pro-rated correctly; re-runs refused")
+            return ok
+
+        except Exception as e:
+            self.log(f"Payroll test error: {str(e)}", "ERROR")
+            return False
+
+        finally:
+            for run_id in self.runs:
+                self.session.delete(f"{BASE_URL}/payroll/runs/{run_id}")
+            for employee in self.employees:
+                self.session.delete(f"{BASE_URL}/employees/{employee['id']}")
+
+def main():
+    tester = PayrollTester()
+
+    if not tester.authenticate():
+        sys.exit(1)
+
+    if not tester.test_payroll_run():
+        sys.exit(1)
+
+    print("\nPayroll test passed!")
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
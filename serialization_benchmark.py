@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+List Response Serialisation Benchmark
+Times serialising 10k employee documents the way a response_model=List[Employee]
+endpoint does (validate + dump + json.dumps) against the trusted orjson fast path.
+Runs in-process; no server or database needed.
+"""
+
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+from typing import List
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'benchmark')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+from pydantic import TypeAdapter
+from server import Employee, trusted_response
+
+EMPLOYEE_COUNT = 10000
+ROUNDS = 5
+
+def log(message, level="INFO"):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{timestamp}] {level}: {message}")
+
+def make_employees(count):
+    return [
+        Employee(
+            org_id="org_bench",
+            doj="2024-01-15",
+            work_email=f"employee{i}@company.com",
+            emp_id=f"EMP{i:05d}",
+            first_name=f"First{i}",
+            last_name=f"Last{i}",
+            father_name=f"Father{i}",
+            dob="1995-03-20",
+            mobile="9876543210",
+            personal_email=f"personal{i}@email.com",
+            pan="ABCDE1234F",
+            aadhar="123456789012",
+            uan=f"UAN{i}",
+            pf_account_no=f"PF{i}",
+            bank_name="HDFC Bank",
+            account_no=uuid.uuid4().hex[:12],
+            ifsc="HDFC0001234",
+            branch="Main Branch",
+            address="123 Street, Area",
+            pincode="110001",
+            city="Delhi",
+            monthly_gross_inr=60000.0 + i,
+            department=["PPC", "SEO", "Content"][i % 3],
+            projects=[f"client_{i % 50:08d}"],
+            approver_user_id="user_approver"
+        ).model_dump()
+        for i in range(count)
+    ]
+
+def best_of(fn):
+    timings = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        body = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(body)
+
+def main():
+    docs = make_employees(EMPLOYEE_COUNT)
+    adapter = TypeAdapter(List[Employee])
+
+    def response_model_path():
+        # What FastAPI does for response_model=List[Employee] with JSONResponse
+        validated = adapter.validate_python([dict(d) for d in docs])
+        content = adapter.dump_python(validated, mode='json')
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode('utf-8')
+
+    def trusted_path():
+        return trusted_response([dict(d) for d in docs], Employee).body
+
+    log(f"Serialising {EMPLOYEE_COUNT} employees, best of {ROUNDS} rounds")
+    slow, slow_bytes = best_of(response_model_path)
+    fast, fast_bytes = best_of(trusted_path)
+
+    log(f"response_model + json: {slow * 1000:8.1f} ms  ({slow_bytes} bytes)")
+    log(f"trusted + orjson:      {fast * 1000:8.1f} ms  ({fast_bytes} bytes)")
+    log(f"Speedup: {slow / fast:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Stock Concurrency Stress Test
+Fires 200 parallel stock-outs at one product and checks that stock never drifts:
+final stock == initial stock - successful issues, never negative, and the ledger
+holds exactly one Stock Out row per successful issue.
+"""
+
+import requests
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Configuration
+BASE_URL = "https://onefinance.preview.emergentagent.com/api"
+TEST_EMAIL = "vishnu@onedotfinance.com"
+TEST_PASSWORD = "12345678"
+ORG_ID = "org_cd4324ad"
+
+PARALLEL_STOCK_OUTS = 200
+INITIAL_STOCK = 150  # Fewer units than requests, so some issues must be refused
+
+class StockConcurrencyTester:
+    def __init__(self):
+        self.token = None
+        self.session = requests.Session()
+        self.product_name = f"Stress Test Item {uuid.uuid4().hex[:6]}"
+
+    def log(self, message, level="INFO"):
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{timestamp}] {level}: {message}")
+
+    def authenticate(self):
+        """Authenticate with the API"""
+        self.log("=== AUTHENTICATION ===")
+
+        try:
+            login_data = {
+                "org_id": ORG_ID,
+                "email": TEST_EMAIL,
+                "password": TEST_PASSWORD
+            }
+            response = self.session.post(f"{BASE_URL}/auth/login", json=login_data)
+            if response.status_code != 200:
+                self.log(f"Login failed: {response.text}", "ERROR")
+                return False
+
+            otp_data = {
+                "email": TEST_EMAIL,
+                "otp": response.json().get('otp')
+            }
+            response = self.session.post(f"{BASE_URL}/auth/verify-otp", json=otp_data)
+            if response.status_code != 200:
+                self.log(f"OTP verification failed: {response.text}", "ERROR")
+                return False
+
+            self.token = response.json().get('token')
+            self.session.headers.update({'Authorization': f'Bearer {self.token}'})
+            self.log("Authentication successful")
+            return True
+
+        except Exception as e:
+            self.log(f"Authentication error: {str(e)}", "ERROR")
+            return False
+
+    def get_stock(self):
+        response = self.session.get(f"{BASE_URL}/stock-availability")
+        stock = next((s for s in response.json() if s.get('product_name') == self.product_name), None)
+        return stock['stock_available'] if stock else None
+
+    def stock_out_once(self, n):
+        stock_out_data = {
+            "product_name": self.product_name,
+            "quantity": 1,
+            "issued_to": f"Stress Worker {n}",
+            "email": "stress@test.com",
+            "date": datetime.now().strftime("%Y-%m-%d")
+        }
+        # Separate request per thread; requests.Session is not thread safe
+        response = requests.post(
+            f"{BASE_URL}/stock-out",
+            json=stock_out_data,
+            headers={'Authorization': f'Bearer {self.token}'}
+        )
+        return response.status_code
+
+    def test_parallel_stock_out(self):
+        """Test that parallel stock-outs never oversell or lose updates"""
+        self.log("=== PARALLEL STOCK OUT STRESS TEST ===")
+
+        try:
+            # Step 1: Seed stock
+            self.log(f"Step 1: Stock In {INITIAL_STOCK} units of {self.product_name}")
+            stock_in_data = {
+                "product_name": self.product_name,
+                "quantity": INITIAL_STOCK,
+                "price": 10.0,
+                "vendor_name": "Stress Vendor",
+                "email": "vendor@test.com",
+                "invoice_number": f"INV-{uuid.uuid4().hex[:6]}",
+                "date": datetime.now().strftime("%Y-%m-%d")
+            }
+            response = self.session.post(f"{BASE_URL}/stock-in", json=stock_in_data)
+            if response.status_code != 200:
+                self.log(f"Stock in failed: {response.text}", "ERROR")
+                return False
+
+            initial = self.get_stock()
+            self.log(f"Initial stock: {initial}")
+
+            # Step 2: Fire parallel stock-outs
+            self.log(f"Step 2: Firing {PARALLEL_STOCK_OUTS} parallel stock-outs of 1 unit")
+            with ThreadPoolExecutor(max_workers=50) as pool:
+                statuses = list(pool.map(self.stock_out_once, range(PARALLEL_STOCK_OUTS)))
+
+            succeeded = statuses.count(200)
+            refused = statuses.count(400)
+            other = len(statuses) - succeeded - refused
+            self.log(f"Succeeded: {succeeded}, refused (insufficient): {refused}, other: {other}")
+
+            # Step 3: Verify no drift
+            final = self.get_stock()
+            self.log(f"Step 3: Final stock: {final}")
+
+            transactions = self.session.get(f"{BASE_URL}/stock-transactions").json()
+            ledger_outs = [t for t in transactions
+                           if t.get('product_name') == self.product_name and t.get('type') == 'Stock Out']
+
+            ok = True
+            if other:
+                self.log(f"{other} stock-outs failed unexpectedly", "ERROR")
+                ok = False
+            if final < 0:
+                self.log(f"Stock went negative: {final}", "ERROR")
+                ok = False
+            if final != initial - succeeded:
+                self.log(f"Stock drift. Expected {initial - succeeded}, got {final}", "ERROR")
+                ok = False
+            if succeeded != min(initial, PARALLEL_STOCK_OUTS):
+                self.log(f"Expected {min(initial, PARALLEL_STOCK_OUTS)} successful issues, got {succeeded}", "ERROR")
+                ok = False
+            if len(ledger_outs) != succeeded:
+                self.log(f"Ledger mismatch. {len(ledger_outs)} Stock Out rows for {succeeded} successful issues", "ERROR")
+                ok = False
+
+            if ok:
+                self.log("✅ No drift under parallel stock-outs")
+            return ok
+
+        except Exception as e:
+            self.log(f"Stress test error: {str(e)}", "ERROR")
+            return False
+
+def main():
+    tester = StockConcurrencyTester()
+
+    if not tester.authenticate():
+        sys.exit(1)
+
+    if not tester.test_parallel_stock_out():
+        sys.exit(1)
+
+    print("\nStock concurrency test passed!")
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
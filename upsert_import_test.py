@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Upsert Import Test
+Creates an employee with gender and projects set in the app, re-uploads them in
+?mode=upsert from a sheet without those columns, and checks that the stored
+gender and projects survive while the sheet's columns are updated. A second
+identical upload must count the row as unchanged.
+"""
+
+import requests
+import sys
+import uuid
+from datetime import datetime
+from io import BytesIO
+
+import pandas as pd
+
+# Configuration
+BASE_URL = "https://onefinance.preview.emergentagent.com/api"
+TEST_EMAIL = "vishnu@onedotfinance.com"
+TEST_PASSWORD = "12345678"
+ORG_ID = "org_cd4324ad"
+
+class UpsertImportTester:
+    def __init__(self):
+        self.token = None
+        self.user_id = None
+        self.session = requests.Session()
+        self.emp_id = f"UPS{uuid.uuid4().hex[:6].upper()}"
+
+    def log(self, message, level="INFO"):
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{timestamp}] {level}: {message}")
+
+    def authenticate(self):
+        """Authenticate with the API"""
+        self.log("=== AUTHENTICATION ===")
+
+        try:
+            login_data = {
+                "org_id": ORG_ID,
+                "email": TEST_EMAIL,
+                "password": TEST_PASSWORD
+            }
+            response = self.session.post(f"{BASE_URL}/auth/login", json=login_data)
+            if response.status_code != 200:
+                self.log(f"Login failed: {response.text}", "ERROR")
+                return False
+
+            otp_data = {
+                "email": TEST_EMAIL,
+                "otp": response.json().get('otp')
+            }
+            response = self.session.post(f"{BASE_URL}/auth/verify-otp", json=otp_data)
+            if response.status_code != 200:
+                self.log(f"OTP verification failed: {response.text}", "ERROR")
+                return False
+
+            self.token = response.json().get('token')
+            self.user_id = response.json()['user']['id']
+            self.session.headers.update({'Authorization': f'Bearer {self.token}'})
+            self.log("Authentication successful")
+            return True
+
+        except Exception as e:
+            self.log(f"Authentication error: {str(e)}", "ERROR")
+            return False
+
+    def employee_row(self, monthly_gross):
+        return {
+            "doj": "2024-01-15",
+            "work_email": f"{self.emp_id.lower()}@company.com",
+            "emp_id": self.emp_id,
+            "first_name": "Upsert",
+            "last_name": "Test",
+            "father_name": "Father",
+            "dob": "1995-03-20",
+            "mobile": "9876543210",
+            "personal_email": f"{self.emp_id.lower()}@email.com",
+            "pan": "ABCDE1234F",
+            "aadhar": "123456789012",
+            "uan": "UAN123",
+            "pf_account_no": "PF123",
+            "bank_name": "HDFC Bank",
+            "account_no": "001234567890",
+            "ifsc": "HDFC0001234",
+            "branch": "Main Branch",
+            "address": "123 Street, Area",
+            "pincode": "110001",
+            "city": "Delhi",
+            "monthly_gross_inr": monthly_gross,
+            "department": "PPC",
+            "approver_user_id": self.user_id
+        }
+
+    def upload(self, monthly_gross):
+        # No gender or projects columns: the upsert must leave both alone
+        sheet = BytesIO()
+        pd.DataFrame([self.employee_row(monthly_gross)]).to_excel(sheet, index=False)
+        response = self.session.post(
+            f"{BASE_URL}/employees/import?mode=upsert",
+            files={'file': ('employees.xlsx', sheet.getvalue(),
+                            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
+        )
+        return response.json() if response.status_code == 200 else None
+
+    def get_employee(self):
+        response = self.session.get(f"{BASE_URL}/employees")
+        return next((e for e in response.json() if e.get('emp_id') == self.emp_id), None)
+
+    def test_upsert_keeps_missing_columns(self):
+        """Test that an upsert re-import only overwrites the sheet's columns"""
+        self.log("=== UPSERT IMPORT KEEPS UNSUPPLIED FIELDS ===")
+        employee = None
+
+        try:
+            # Step 1: Create the employee in the app with non-default gender and projects
+            self.log(f"Step 1: Creating employee {self.emp_id}")
+            response = self.session.post(f"{BASE_URL}/employees", json={
+                **self.employee_row(50000.0), "gender": "Female", "projects": ["client_upsert"]
+            })
+            if response.status_code != 200:
+                self.log(f"Employee creation failed: {response.text}", "ERROR")
+                return False
+            employee = response.json()
+
+            # Step 2: Re-upload with a new salary and no gender/projects columns
+            self.log("Step 2: Upserting a sheet without gender and projects")
+            result = self.upload(65000.0)
+            if not result:
+                self.log("Upsert import failed", "ERROR")
+                return False
+            self.log(f"Result: inserted {result.get('inserted')}, updated {result.get('updated')}, unchanged {result.get('unchanged')}")
+
+            ok = True
+            stored = self.get_employee()
+            if result.get('updated') != 1 or result.get('inserted') != 0:
+                self.log("Expected the row to update the existing employee", "ERROR")
+                ok = False
+            if stored.get('monthly_gross_inr') != 65000.0:
+                self.log(f"monthly_gross_inr not updated: {stored.get('monthly_gross_inr')}", "ERROR")
+                ok = False
+            if stored.get('gender') != 'Female':
+                self.log(f"gender overwritten: {stored.get('gender')}", "ERROR")
+                ok = False
+            if stored.get('projects') != ['client_upsert']:
+                self.log(f"projects overwritten: {stored.get('projects')}", "ERROR")
+                ok = False
+
+            # Step 3: The same sheet again changes nothing
+            self.log("Step 3: Uploading the same sheet again")
+            result = self.upload(65000.0)
+            if not result or result.get('unchanged') != 1 or result.get('updated') != 0:
+                self.log(f"Expected the row to be unchanged, got {result}", "ERROR")
+                ok = False
+
+            if ok:
+                self.log("✅ Upsert import kept gender and projects")
+            return ok
+
+        except Exception as e:
+            self.log(f"Upsert import test error: {str(e)}", "ERROR")
+            return False
+
+        finally:
+            if employee:
+                self.session.delete(f"{BASE_URL}/employees/{employee['id']}")
+
+def main():
+    tester = UpsertImportTester()
+
+    if not tester.authenticate():
+        sys.exit(1)
+
+    if not tester.test_upsert_keeps_missing_columns():
+        sys.exit(1)
+
+    print("\nUpsert import test passed!")
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()